@@ -1,8 +1,11 @@
 #!/usr/bin/env python3.12
 """Brain Notes — Notion Clone Backend with Docs, Projects, Knowledge Base"""
-import json, logging, os, sqlite3, uuid, functools, secrets
-from datetime import datetime, date
-from flask import Flask, request, jsonify, send_from_directory, session, g
+import base64, hashlib, json, logging, math, os, random, sqlite3, uuid, functools, secrets, threading, time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from flask import Flask, Response, request, jsonify, send_from_directory, session, g, stream_with_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -12,181 +15,15 @@ CORS(app, supports_credentials=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notes.db')
-
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+from db_pool import DB_PATH, get_db
+import db_pool
+import db_schema
+import mcp_client
+import notes_tools
 
 def init_db():
     with get_db() as conn:
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS pages (
-                id TEXT PRIMARY KEY,
-                title TEXT NOT NULL DEFAULT 'Untitled',
-                icon TEXT DEFAULT '',
-                cover TEXT DEFAULT '',
-                parent_id TEXT DEFAULT NULL,
-                workspace TEXT DEFAULT 'docs',
-                sort_order INTEGER DEFAULT 0,
-                is_favorite BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (parent_id) REFERENCES pages(id) ON DELETE SET NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS blocks (
-                id TEXT PRIMARY KEY,
-                page_id TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'text',
-                content TEXT DEFAULT '',
-                properties TEXT DEFAULT '{}',
-                sort_order INTEGER DEFAULT 0,
-                indent_level INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (page_id) REFERENCES pages(id) ON DELETE CASCADE
-            );
-
-            -- Databases (for Projects & Knowledge Base)
-            CREATE TABLE IF NOT EXISTS databases (
-                id TEXT PRIMARY KEY,
-                title TEXT NOT NULL DEFAULT 'Untitled Database',
-                icon TEXT DEFAULT '',
-                workspace TEXT DEFAULT 'projects',
-                description TEXT DEFAULT '',
-                properties_schema TEXT DEFAULT '[]',
-                default_view TEXT DEFAULT 'table',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-
-            -- Database items (rows)
-            CREATE TABLE IF NOT EXISTS db_items (
-                id TEXT PRIMARY KEY,
-                database_id TEXT NOT NULL,
-                title TEXT NOT NULL DEFAULT 'Untitled',
-                icon TEXT DEFAULT '',
-                properties TEXT DEFAULT '{}',
-                page_id TEXT DEFAULT NULL,
-                sort_order INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE,
-                FOREIGN KEY (page_id) REFERENCES pages(id) ON DELETE SET NULL
-            );
-
-            -- Database views
-            CREATE TABLE IF NOT EXISTS db_views (
-                id TEXT PRIMARY KEY,
-                database_id TEXT NOT NULL,
-                name TEXT NOT NULL DEFAULT 'Default',
-                type TEXT NOT NULL DEFAULT 'table',
-                config TEXT DEFAULT '{}',
-                sort_order INTEGER DEFAULT 0,
-                FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE
-            );
-
-            -- Project resources (files/directories linked to projects)
-            CREATE TABLE IF NOT EXISTS project_resources (
-                id TEXT PRIMARY KEY,
-                database_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                path TEXT NOT NULL,
-                resource_type TEXT NOT NULL DEFAULT 'directory',
-                qmd_collection TEXT DEFAULT '',
-                indexed_at TIMESTAMP DEFAULT NULL,
-                file_count INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE
-            );
-            CREATE INDEX IF NOT EXISTS idx_res_db ON project_resources(database_id);
-
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL DEFAULT 'default',
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_messages(session_id);
-
-            CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(
-                id, title, content='pages', content_rowid=rowid
-            );
-
-            CREATE VIRTUAL TABLE IF NOT EXISTS blocks_fts USING fts5(
-                id, content, content='blocks', content_rowid=rowid
-            );
-
-            -- Users
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE DEFAULT '',
-                password_hash TEXT NOT NULL,
-                display_name TEXT DEFAULT '',
-                role TEXT DEFAULT 'user',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-
-            -- Teams
-            CREATE TABLE IF NOT EXISTS teams (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT DEFAULT '',
-                created_by TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (created_by) REFERENCES users(id)
-            );
-
-            -- Team members
-            CREATE TABLE IF NOT EXISTS team_members (
-                team_id TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                role TEXT DEFAULT 'member',
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (team_id, user_id),
-                FOREIGN KEY (team_id) REFERENCES teams(id) ON DELETE CASCADE,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-
-            -- Permissions (granular sharing)
-            CREATE TABLE IF NOT EXISTS permissions (
-                id TEXT PRIMARY KEY,
-                resource_type TEXT NOT NULL,
-                resource_id TEXT NOT NULL,
-                grantee_type TEXT NOT NULL,
-                grantee_id TEXT NOT NULL,
-                permission TEXT NOT NULL,
-                granted_by TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (granted_by) REFERENCES users(id)
-            );
-            CREATE INDEX IF NOT EXISTS idx_perm_resource ON permissions(resource_type, resource_id);
-            CREATE INDEX IF NOT EXISTS idx_perm_grantee ON permissions(grantee_type, grantee_id);
-        """)
-        # Migrations
-        try:
-            conn.execute("SELECT workspace FROM pages LIMIT 1")
-        except sqlite3.OperationalError:
-            conn.execute("ALTER TABLE pages ADD COLUMN workspace TEXT DEFAULT 'docs'")
-        # Add owner columns to pages and databases
-        for table in ('pages', 'databases'):
-            try:
-                conn.execute(f"SELECT owner_id FROM {table} LIMIT 1")
-            except sqlite3.OperationalError:
-                conn.execute(f"ALTER TABLE {table} ADD COLUMN owner_id TEXT DEFAULT ''")
-                conn.execute(f"ALTER TABLE {table} ADD COLUMN owner_type TEXT DEFAULT 'user'")
-        # Add owner to chat_messages
-        try:
-            conn.execute("SELECT user_id FROM chat_messages LIMIT 1")
-        except sqlite3.OperationalError:
-            conn.execute("ALTER TABLE chat_messages ADD COLUMN user_id TEXT DEFAULT ''")
-        conn.commit()
+        db_schema.migrate(conn)
         # Create default admin if no users exist
         admin = conn.execute("SELECT id FROM users LIMIT 1").fetchone()
         if not admin:
@@ -216,14 +53,48 @@ init_db()
 
 # ── Auth ───────────────────────────────────────────────────────────────────
 
+# Session user cache: user_id → (expires_at, user record), LRU-bounded.
+# Entries are dropped explicitly when an account changes; the TTL bounds staleness otherwise.
+SESSION_USER_TTL = float(os.environ.get('SESSION_USER_TTL', '60'))
+SESSION_USER_CACHE_MAX = int(os.environ.get('SESSION_USER_CACHE_MAX', '1000'))
+_session_users = OrderedDict()
+_session_users_lock = threading.Lock()
+_session_user_stats = {'lookups': 0, 'avoided_lookups': 0, 'invalidations': 0}
+
+def invalidate_session_user(user_id):
+    """Forget the cached record for a user after their account changed."""
+    with _session_users_lock:
+        _session_users.pop(user_id, None)
+        _session_user_stats['invalidations'] += 1
+
+def session_user_cache_stats():
+    with _session_users_lock:
+        return dict(_session_user_stats, size=len(_session_users))
+
 def get_current_user():
     """Get the current logged-in user from session. Returns dict or None."""
     user_id = session.get('user_id')
     if not user_id:
         return None
+    now_ts = time.monotonic()
+    with _session_users_lock:
+        entry = _session_users.get(user_id)
+        if entry and entry[0] > now_ts:
+            _session_users.move_to_end(user_id)
+            _session_user_stats['avoided_lookups'] += 1
+            return dict(entry[1])
+        _session_user_stats['lookups'] += 1
     with get_db() as conn:
         row = conn.execute("SELECT id, username, email, display_name, role FROM users WHERE id=?", (user_id,)).fetchone()
-    return dict_row(row)
+    user = dict_row(row)
+    if user:
+        with _session_users_lock:
+            _session_users[user_id] = (now_ts + SESSION_USER_TTL, user)
+            _session_users.move_to_end(user_id)
+            while len(_session_users) > SESSION_USER_CACHE_MAX:
+                _session_users.popitem(last=False)
+        user = dict(user)
+    return user
 
 def login_required(f):
     """Decorator: require authentication. Sets g.user."""
@@ -255,80 +126,95 @@ def get_user_team_ids(user_id):
         rows = conn.execute("SELECT team_id FROM team_members WHERE user_id=?", (user_id,)).fetchall()
     return [r['team_id'] for r in rows]
 
+# Effective-access cache: (user_id, resource_type, resource_id) → permission rank.
+# Entries are dropped precisely when permissions, team membership or resources change.
+PERM_RANK = {'read': 1, 'write': 2, 'delete': 3}
+ACCESS_CACHE_MAX = int(os.environ.get('ACCESS_CACHE_MAX', '50000'))
+_access_cache = {}
+_access_by_user = {}
+_access_by_resource = {}
+_access_generation = 0
+_access_lock = threading.Lock()
+_access_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def _compute_access_rank(user_id, resource_type, resource_id):
+    """Highest permission rank a non-admin user holds on a resource, or None if it doesn't exist.
+    Trashed pages count as missing."""
+    live = "id=? AND deleted_at IS NULL" if resource_type == 'page' else "id=?"
+    table = 'pages' if resource_type == 'page' else 'databases'
+    with get_db() as conn:
+        if not conn.execute(f"SELECT 1 FROM {table} WHERE {live}", (resource_id,)).fetchone():
+            return None
+        row = conn.execute(
+            "SELECT level FROM effective_access WHERE user_id=? AND resource_type=? AND resource_id=?",
+            (user_id, resource_type, resource_id)
+        ).fetchone()
+    return row['level'] if row else 0
+
+def invalidate_access(user_id=None, resource_type=None, resource_id=None):
+    """Drop cached access entries for a user, a resource, or everything when called without arguments."""
+    global _access_generation
+    with _access_lock:
+        _access_generation += 1
+        _access_stats['invalidations'] += 1
+        if user_id is None and resource_id is None:
+            _access_cache.clear()
+            _access_by_user.clear()
+            _access_by_resource.clear()
+            return
+        keys = set()
+        if user_id is not None:
+            keys |= _access_by_user.pop(user_id, set())
+        if resource_id is not None:
+            keys |= _access_by_resource.pop((resource_type, resource_id), set())
+        for key in keys:
+            _access_cache.pop(key, None)
+            _access_by_user.get(key[0], set()).discard(key)
+            _access_by_resource.get(key[1:], set()).discard(key)
+
+def access_cache_stats():
+    with _access_lock:
+        s = dict(_access_stats, size=len(_access_cache))
+    total = s['hits'] + s['misses']
+    s['hit_rate'] = round(s['hits'] / total, 3) if total else 0.0
+    return s
+
 def can_access_resource(user, resource_type, resource_id, required_permission='read'):
     """Check if a user can access a resource. Admins can access everything."""
     if user['role'] == 'admin':
         return True
-    with get_db() as conn:
-        # Check ownership
-        table = 'pages' if resource_type == 'page' else 'databases'
-        row = conn.execute(f"SELECT owner_id, owner_type FROM {table} WHERE id=?", (resource_id,)).fetchone()
-        if not row:
+    key = (user['id'], resource_type, resource_id)
+    with _access_lock:
+        rank = _access_cache.get(key)
+        if rank is not None:
+            _access_stats['hits'] += 1
+        else:
+            _access_stats['misses'] += 1
+        generation = _access_generation
+    if rank is None:
+        rank = _compute_access_rank(user['id'], resource_type, resource_id)
+        if rank is None:
             return False
-        owner_id, owner_type = row['owner_id'], row['owner_type']
-        # User owns it directly
-        if owner_type == 'user' and owner_id == user['id']:
-            return True
-        # User is in the owning team
-        if owner_type == 'team':
-            member = conn.execute(
-                "SELECT role FROM team_members WHERE team_id=? AND user_id=?",
-                (owner_id, user['id'])
-            ).fetchone()
-            if member:
-                # Team owners/admins get full access, members get read+write
-                if member['role'] in ('owner', 'admin'):
-                    return True
-                if required_permission in ('read', 'write'):
-                    return True
-        # Check explicit permissions
-        perm_levels = {'read': ['read', 'write', 'delete'], 'write': ['write', 'delete'], 'delete': ['delete']}
-        valid_perms = perm_levels.get(required_permission, [required_permission])
-        placeholders = ','.join('?' * len(valid_perms))
-        # Direct user permission
-        perm = conn.execute(
-            f"SELECT id FROM permissions WHERE resource_type=? AND resource_id=? "
-            f"AND grantee_type='user' AND grantee_id=? AND permission IN ({placeholders})",
-            (resource_type, resource_id, user['id'], *valid_perms)
-        ).fetchone()
-        if perm:
-            return True
-        # Team-based permission
-        team_ids = get_user_team_ids(user['id'])
-        for tid in team_ids:
-            perm = conn.execute(
-                f"SELECT id FROM permissions WHERE resource_type=? AND resource_id=? "
-                f"AND grantee_type='team' AND grantee_id=? AND permission IN ({placeholders})",
-                (resource_type, resource_id, tid, *valid_perms)
-            ).fetchone()
-            if perm:
-                return True
-    return False
+        with _access_lock:
+            # Skip the store if an invalidation raced with the computation
+            if generation == _access_generation:
+                if len(_access_cache) >= ACCESS_CACHE_MAX:
+                    _access_cache.clear()
+                    _access_by_user.clear()
+                    _access_by_resource.clear()
+                _access_cache[key] = rank
+                _access_by_user.setdefault(key[0], set()).add(key)
+                _access_by_resource.setdefault(key[1:], set()).add(key)
+    return rank >= PERM_RANK.get(required_permission, PERM_RANK['delete'])
 
 def get_accessible_filter(user, table='pages'):
     """Return (WHERE clause, params) for filtering resources a user can access."""
     if user['role'] == 'admin':
         return "1=1", []
     resource_type = 'page' if table == 'pages' else 'database'
-    team_ids = get_user_team_ids(user['id'])
-    conditions = [f"({table}.owner_type='user' AND {table}.owner_id=?)"]
-    params = [user['id']]
-    for tid in team_ids:
-        conditions.append(f"({table}.owner_type='team' AND {table}.owner_id=?)")
-        params.append(tid)
-    # Include resources with explicit read+ permission
-    conditions.append(
-        f"({table}.id IN (SELECT resource_id FROM permissions WHERE resource_type=? "
-        f"AND grantee_type='user' AND grantee_id=? AND permission IN ('read','write','delete')))"
-    )
-    params.extend([resource_type, user['id']])
-    for tid in team_ids:
-        conditions.append(
-            f"({table}.id IN (SELECT resource_id FROM permissions WHERE resource_type=? "
-            f"AND grantee_type='team' AND grantee_id=? AND permission IN ('read','write','delete')))"
-        )
-        params.extend([resource_type, tid])
-    return " OR ".join(conditions), params
+    # effective_access already folds in ownership, team membership and grants
+    return (f"{table}.id IN (SELECT resource_id FROM effective_access WHERE user_id=? AND resource_type=?)",
+            [user['id'], resource_type])
 
 # ── Auth Routes ────────────────────────────────────────────────────────────
 
@@ -371,6 +257,7 @@ def change_password():
             return jsonify({'error': 'Wrong current password'}), 401
         conn.execute("UPDATE users SET password_hash=? WHERE id=?", (generate_password_hash(new_pw), g.user['id']))
         conn.commit()
+    invalidate_session_user(g.user['id'])
     return jsonify({'ok': True})
 
 # ── Admin: User Management ─────────────────────────────────────────────────
@@ -420,6 +307,7 @@ def admin_update_user(user_id):
         if 'password' in data and data['password']:
             conn.execute("UPDATE users SET password_hash=? WHERE id=?", (generate_password_hash(data['password']), user_id))
         conn.commit()
+    invalidate_session_user(user_id)
     return jsonify({'ok': True})
 
 @app.route('/api/admin/users/<user_id>', methods=['DELETE'])
@@ -432,8 +320,32 @@ def admin_delete_user(user_id):
         conn.execute("DELETE FROM permissions WHERE granted_by=? OR (grantee_type='user' AND grantee_id=?)", (user_id, user_id))
         conn.execute("DELETE FROM users WHERE id=?", (user_id,))
         conn.commit()
+    # Grants made by this user vanish too, so every cached entry may be stale
+    invalidate_access()
+    invalidate_session_user(user_id)
     return jsonify({'ok': True})
 
+@app.route('/api/admin/stats', methods=['GET'])
+@admin_required
+def admin_stats():
+    """Runtime counters for the connection layer and in-process caches."""
+    return jsonify({'db': db_pool.stats(), 'access_cache': access_cache_stats(),
+                    'session_users': session_user_cache_stats(), 'ordering': order_stats(),
+                    'trash': trash_stats(), 'content_snapshot': notes_tools.snapshot_stats(),
+                    'llm_clients': llm_client_stats(), 'chat_runs': chat_run_stats(),
+                    'chat_history': chat_history_stats(), 'ai_cache': ai_cache_stats(),
+                    'research_jobs': research_job_stats(),
+                    'mcp_sessions': mcp_client.session_stats()})
+
+@app.route('/api/admin/query-plans', methods=['GET'])
+@admin_required
+def admin_query_plans():
+    """Schema version and whether each hot query still uses its index."""
+    with get_db() as conn:
+        results = db_schema.check_query_plans(conn)
+        version = db_schema.schema_version(conn)
+    return jsonify({'schema_version': version, 'ok': all(r['ok'] for r in results), 'queries': results})
+
 # ── Teams ──────────────────────────────────────────────────────────────────
 
 @app.route('/api/teams', methods=['GET'])
@@ -447,16 +359,15 @@ def list_teams():
                 "SELECT t.* FROM teams t JOIN team_members tm ON t.id=tm.team_id WHERE tm.user_id=? ORDER BY t.name",
                 (g.user['id'],)
             ).fetchall()
-    teams = []
-    for r in rows:
-        t = dict_row(r)
-        with get_db() as conn:
+        teams = []
+        for r in rows:
+            t = dict_row(r)
             members = conn.execute(
                 "SELECT u.id, u.username, u.display_name, tm.role FROM team_members tm "
                 "JOIN users u ON u.id=tm.user_id WHERE tm.team_id=?", (t['id'],)
             ).fetchall()
-        t['members'] = [dict_row(m) for m in members]
-        teams.append(t)
+            t['members'] = [dict_row(m) for m in members]
+            teams.append(t)
     return jsonify(teams)
 
 @app.route('/api/teams', methods=['POST'])
@@ -477,6 +388,7 @@ def create_team():
             (team_id, g.user['id'], 'owner')
         )
         conn.commit()
+    invalidate_access(user_id=g.user['id'])
     return jsonify({'id': team_id, 'name': name}), 201
 
 @app.route('/api/teams/<team_id>', methods=['PUT'])
@@ -508,10 +420,15 @@ def delete_team(team_id):
         ).fetchone()
         if (not member or member['role'] != 'owner') and g.user['role'] != 'admin':
             return jsonify({'error': 'Only team owner or admin can delete'}), 403
+        member_ids = [r['user_id'] for r in conn.execute(
+            "SELECT user_id FROM team_members WHERE team_id=?", (team_id,)
+        ).fetchall()]
         conn.execute("DELETE FROM team_members WHERE team_id=?", (team_id,))
         conn.execute("DELETE FROM permissions WHERE grantee_type='team' AND grantee_id=?", (team_id,))
         conn.execute("DELETE FROM teams WHERE id=?", (team_id,))
         conn.commit()
+    for uid in member_ids:
+        invalidate_access(user_id=uid)
     return jsonify({'ok': True})
 
 @app.route('/api/teams/<team_id>/members', methods=['POST'])
@@ -536,6 +453,7 @@ def add_team_member(team_id):
             conn.commit()
         except sqlite3.IntegrityError:
             return jsonify({'error': 'Already a member or invalid user'}), 409
+    invalidate_access(user_id=user_id)
     return jsonify({'ok': True}), 201
 
 @app.route('/api/teams/<team_id>/members/<user_id>', methods=['PUT'])
@@ -553,6 +471,7 @@ def update_team_member(team_id, user_id):
             role = 'member'
         conn.execute("UPDATE team_members SET role=? WHERE team_id=? AND user_id=?", (role, team_id, user_id))
         conn.commit()
+    invalidate_access(user_id=user_id)
     return jsonify({'ok': True})
 
 @app.route('/api/teams/<team_id>/members/<user_id>', methods=['DELETE'])
@@ -566,6 +485,7 @@ def remove_team_member(team_id, user_id):
             return jsonify({'error': 'Not authorized'}), 403
         conn.execute("DELETE FROM team_members WHERE team_id=? AND user_id=?", (team_id, user_id))
         conn.commit()
+    invalidate_access(user_id=user_id)
     return jsonify({'ok': True})
 
 # ── Permissions (Sharing) ──────────────────────────────────────────────────
@@ -613,6 +533,7 @@ def grant_permission():
             (perm_id, resource_type, resource_id, grantee_type, grantee_id, permission, g.user['id'])
         )
         conn.commit()
+    invalidate_access(resource_type=resource_type, resource_id=resource_id)
     return jsonify({'id': perm_id}), 201
 
 @app.route('/api/permissions/<perm_id>', methods=['DELETE'])
@@ -628,8 +549,117 @@ def revoke_permission(perm_id):
                 return jsonify({'error': 'Not authorized'}), 403
         conn.execute("DELETE FROM permissions WHERE id=?", (perm_id,))
         conn.commit()
+    invalidate_access(resource_type=perm['resource_type'], resource_id=perm['resource_id'])
     return jsonify({'ok': True})
 
+# ── Ordering Keys ──────────────────────────────────────────────────────────
+# blocks, pages and db_items use a fractional sort_order: a row placed between two
+# siblings takes the midpoint of their keys, so an insert or move writes one row.
+# When a gap gets too narrow the sibling group is renumbered 1..n — inline if no key
+# fits at all (ties, exhausted float precision), otherwise on a background thread.
+
+ORDER_KEY_MIN_GAP = 1e-6
+
+_rebalance_lock = threading.Lock()
+_rebalance_pending = set()
+_rebalance_worker = None
+_order_stats = {'inline_rebalances': 0, 'background_rebalances': 0}
+
+def _order_scope_sql(scope):
+    return ' AND '.join(f"{col} IS ?" for col in scope), list(scope.values())
+
+def page_order_scope(parent_id, workspace):
+    """Sibling group of a page: its parent's children, or the workspace's root pages."""
+    return {'parent_id': parent_id} if parent_id else {'parent_id': None, 'workspace': workspace}
+
+def order_key_last(conn, table, scope):
+    """sort_order that places a new row after every sibling in `scope`."""
+    where, params = _order_scope_sql(scope)
+    last = conn.execute(f"SELECT MAX(sort_order) FROM {table} WHERE {where}", params).fetchone()[0]
+    return 1 if last is None else math.floor(last) + 1
+
+def order_key_after(conn, table, scope, after_id=None, exclude_id=None):
+    """sort_order for a row placed right after `after_id`, or first in `scope` if it is None.
+    An `after_id` that isn't in the scope places the row last. `exclude_id` is the row
+    being moved, so it doesn't count as its own neighbour."""
+    where, params = _order_scope_sql(scope)
+    for _ in range(2):
+        if after_id:
+            row = conn.execute(
+                f"SELECT sort_order FROM {table} WHERE id=? AND {where}", (after_id, *params)
+            ).fetchone()
+            if row is None:
+                return order_key_last(conn, table, scope)
+            lo = row[0]
+            tied = conn.execute(
+                f"SELECT 1 FROM {table} WHERE {where} AND sort_order=? AND id NOT IN (?,?) LIMIT 1",
+                (*params, lo, after_id, exclude_id or '')
+            ).fetchone()
+            hi = conn.execute(
+                f"SELECT MIN(sort_order) FROM {table} WHERE {where} AND sort_order>? AND id IS NOT ?",
+                (*params, lo, exclude_id)
+            ).fetchone()[0]
+            if hi is None and not tied:
+                return math.floor(lo) + 1
+            key = None if tied else (lo + hi) / 2
+            if key is not None and lo < key < hi:
+                if hi - lo < ORDER_KEY_MIN_GAP:
+                    schedule_rebalance(table, scope)
+                return key
+        else:
+            hi = conn.execute(
+                f"SELECT MIN(sort_order) FROM {table} WHERE {where} AND id IS NOT ?", (*params, exclude_id)
+            ).fetchone()[0]
+            return 1 if hi is None else math.ceil(hi) - 1
+        # No key fits between the neighbours: renumber the group and try again
+        rebalance_order(conn, table, scope)
+        with _rebalance_lock:
+            _order_stats['inline_rebalances'] += 1
+    raise RuntimeError(f"could not allocate a sort_order in {table}")
+
+def rebalance_order(conn, table, scope):
+    """Renumber a sibling group 1..n in its current order, writing only rows that change."""
+    where, params = _order_scope_sql(scope)
+    conn.execute(f"""
+        UPDATE {table} SET sort_order = ranked.pos
+        FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY sort_order, rowid) AS pos
+              FROM {table} WHERE {where}) AS ranked
+        WHERE {table}.id = ranked.id AND {table}.sort_order IS NOT ranked.pos
+    """, params)
+
+def schedule_rebalance(table, scope):
+    """Queue a sibling group whose gaps are getting narrow for renumbering off the request path."""
+    global _rebalance_worker
+    with _rebalance_lock:
+        _rebalance_pending.add((table, tuple(scope.items())))
+        if _rebalance_worker is None:
+            _rebalance_worker = threading.Thread(target=_run_rebalances, name='order-rebalance', daemon=True)
+            _rebalance_worker.start()
+
+def _run_rebalances():
+    global _rebalance_worker
+    try:
+        while True:
+            with _rebalance_lock:
+                if not _rebalance_pending:
+                    _rebalance_worker = None
+                    return
+                table, scope = _rebalance_pending.pop()
+            try:
+                with get_db() as conn:
+                    rebalance_order(conn, table, dict(scope))
+                    conn.commit()
+                with _rebalance_lock:
+                    _order_stats['background_rebalances'] += 1
+            except sqlite3.Error:
+                logger.exception(f"Rebalancing {table} {scope} failed")
+    finally:
+        db_pool.close_thread_connection()
+
+def order_stats():
+    with _rebalance_lock:
+        return dict(_order_stats, pending=len(_rebalance_pending))
+
 # ── Pages ──────────────────────────────────────────────────────────────────
 
 @app.route('/website')
@@ -660,7 +690,7 @@ def list_pages():
     owner = request.args.get('owner')  # optional: filter by team id
     access_filter, access_params = get_accessible_filter(g.user, 'pages')
     with get_db() as conn:
-        where = [f"({access_filter})"]
+        where = [f"({access_filter})", "pages.deleted_at IS NULL"]
         params = list(access_params)
         if workspace:
             where.append("pages.workspace=?")
@@ -672,6 +702,86 @@ def list_pages():
         rows = conn.execute(sql, params).fetchall()
     return jsonify([dict_row(r) for r in rows])
 
+PAGE_TREE_FIELDS = "id, title, icon, parent_id, sort_order, is_favorite"
+PAGE_TREE_DEFAULT_DEPTH = 3
+PAGE_TREE_MAX_DEPTH = 32
+
+@app.route('/api/pages/tree', methods=['GET'])
+@login_required
+def page_tree():
+    """Sidebar hierarchy as nested nodes carrying only PAGE_TREE_FIELDS.
+
+    Levels deeper than `depth` are left out; their parents have has_children set and
+    no `children` key, and the client fetches them with ?parent_id=<id>. The ETag is
+    derived from the trigger-maintained 'page_tree' counter, so an unchanged sidebar
+    revalidates with a 304 without running the tree query."""
+    workspace = request.args.get('workspace')
+    owner = request.args.get('owner')
+    parent_id = request.args.get('parent_id')
+    depth = min(max(request.args.get('depth', PAGE_TREE_DEFAULT_DEPTH, type=int), 1), PAGE_TREE_MAX_DEPTH)
+    with get_db() as conn:
+        version = conn.execute("SELECT value FROM change_counters WHERE name='page_tree'").fetchone()[0]
+        etag = hashlib.sha1(
+            f"{version}:{g.user['id']}:{g.user['role']}:{request.query_string.decode()}".encode()
+        ).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
+
+        access_filter, access_params = get_accessible_filter(g.user, 'pages')
+        where = [f"({access_filter})", "pages.deleted_at IS NULL"]
+        params = list(access_params)
+        if workspace:
+            where.append("pages.workspace=?")
+            params.append(workspace)
+        if owner:
+            where.append("pages.owner_id=? AND pages.owner_type='team'")
+            params.append(owner)
+        if parent_id:
+            root, root_params = "v.parent_id=?", [parent_id]
+        else:
+            # Pages whose parent the user can't see are shown at the top level
+            root, root_params = "v.parent_id IS NULL OR v.parent_id NOT IN (SELECT id FROM visible)", []
+        rows = conn.execute(f"""
+            WITH RECURSIVE visible AS (
+                SELECT {PAGE_TREE_FIELDS} FROM pages WHERE {' AND '.join(where)}
+            ), tree(id, depth) AS (
+                SELECT v.id, 0 FROM visible v WHERE {root}
+                UNION
+                SELECT v.id, tree.depth + 1 FROM visible v JOIN tree ON v.parent_id = tree.id
+                WHERE tree.depth + 1 < ?
+            )
+            SELECT v.*, tree.depth,
+                   EXISTS (SELECT 1 FROM visible k WHERE k.parent_id = v.id) AS has_children
+            FROM tree JOIN visible v ON v.id = tree.id
+            ORDER BY tree.depth, v.sort_order
+        """, (*params, *root_params, depth)).fetchall()
+
+        nodes, roots = {}, []
+        for r in rows:
+            node = {k: r[k] for k in ('id', 'title', 'icon', 'parent_id', 'sort_order', 'is_favorite', 'has_children')}
+            node['has_children'] = bool(node['has_children'])
+            if r['depth'] < depth - 1:
+                node['children'] = []
+            nodes[node['id']] = node
+            if r['depth'] == 0:
+                roots.append(node)
+            else:
+                nodes[r['parent_id']]['children'].append(node)
+        result = {'pages': roots}
+        if not parent_id:
+            favorites = conn.execute(
+                f"SELECT {PAGE_TREE_FIELDS} FROM pages WHERE {' AND '.join(where)} AND is_favorite=1 ORDER BY sort_order",
+                params
+            ).fetchall()
+            result['favorites'] = [dict_row(f) for f in favorites]
+    resp = jsonify(result)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
 @app.route('/api/pages', methods=['POST'])
 @login_required
 def create_page():
@@ -692,19 +802,10 @@ def create_page():
         owner_id = g.user['id']
     
     with get_db() as conn:
-        if parent_id:
-            max_order = conn.execute(
-                "SELECT COALESCE(MAX(sort_order),0) FROM pages WHERE parent_id=?", (parent_id,)
-            ).fetchone()[0]
-        else:
-            max_order = conn.execute(
-                "SELECT COALESCE(MAX(sort_order),0) FROM pages WHERE parent_id IS NULL AND workspace=?",
-                (workspace,)
-            ).fetchone()[0]
-        
+        sort_order = order_key_last(conn, 'pages', page_order_scope(parent_id, workspace))
         conn.execute(
             "INSERT INTO pages (id, title, icon, parent_id, workspace, sort_order, owner_id, owner_type) VALUES (?,?,?,?,?,?,?,?)",
-            (page_id, title, icon, parent_id, workspace, max_order + 1, owner_id, owner_type)
+            (page_id, title, icon, parent_id, workspace, sort_order, owner_id, owner_type)
         )
         block_id = gen_id()
         conn.execute(
@@ -721,14 +822,14 @@ def get_page(page_id):
     if not can_access_resource(g.user, 'page', page_id, 'read'):
         return jsonify({'error': 'Access denied'}), 403
     with get_db() as conn:
-        page = conn.execute("SELECT * FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT * FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return jsonify({'error': 'Not found'}), 404
         blocks = conn.execute(
             "SELECT * FROM blocks WHERE page_id=? ORDER BY sort_order", (page_id,)
         ).fetchall()
         children = conn.execute(
-            "SELECT id, title, icon FROM pages WHERE parent_id=? ORDER BY sort_order", (page_id,)
+            "SELECT id, title, icon FROM pages WHERE parent_id=? AND deleted_at IS NULL ORDER BY sort_order", (page_id,)
         ).fetchall()
     result = dict_row(page)
     result['blocks'] = [dict_row(b) for b in blocks]
@@ -742,7 +843,7 @@ def update_page(page_id):
         return jsonify({'error': 'Access denied'}), 403
     data = request.get_json(force=True)
     with get_db() as conn:
-        page = conn.execute("SELECT * FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT * FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return jsonify({'error': 'Not found'}), 404
         
@@ -764,34 +865,134 @@ def update_page(page_id):
 @app.route('/api/pages/<page_id>', methods=['DELETE'])
 @login_required
 def delete_page(page_id):
+    """Move the page and its sub-pages to the trash; the purger removes them later."""
     if not can_access_resource(g.user, 'page', page_id, 'delete'):
         return jsonify({'error': 'Access denied'}), 403
     with get_db() as conn:
-        children = conn.execute("SELECT id FROM pages WHERE parent_id=?", (page_id,)).fetchall()
-        for child in children:
-            delete_page_recursive(conn, child['id'])
-        conn.execute("DELETE FROM blocks WHERE page_id=?", (page_id,))
-        conn.execute("DELETE FROM permissions WHERE resource_type='page' AND resource_id=?", (page_id,))
-        conn.execute("DELETE FROM pages WHERE id=?", (page_id,))
+        if not conn.execute("SELECT 1 FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone():
+            return jsonify({'error': 'Not found'}), 404
+        trashed = notes_tools.trash_page(conn, page_id)
         conn.commit()
-    return jsonify({'ok': True})
+    for pid in trashed:
+        invalidate_access(resource_type='page', resource_id=pid)
+    return jsonify({'ok': True, 'trashed': len(trashed)})
+
+# ── Trash ──────────────────────────────────────────────────────────────────
+# Trashed pages stay restorable for TRASH_RETENTION_DAYS; a daemon thread then
+# hard-deletes them TRASH_PURGE_CHUNK pages per transaction so it never holds
+# the write lock for long.
+
+TRASH_RETENTION_DAYS = float(os.environ.get('TRASH_RETENTION_DAYS', '30'))
+TRASH_PURGE_INTERVAL = float(os.environ.get('TRASH_PURGE_INTERVAL', '300'))
+TRASH_PURGE_CHUNK = int(os.environ.get('TRASH_PURGE_CHUNK', '200'))
+# deleted_at given to pages emptied from the trash, so the next purge pass takes them
+PURGE_NOW = '1970-01-01 00:00:00'
+
+_purge_wake = threading.Event()
+_purge_stats = {'runs': 0, 'purged': 0}
+
+def _trash_filter(user):
+    """WHERE clause for trashed pages the user may restore or purge (delete rights)."""
+    if user['role'] == 'admin':
+        return "1=1", []
+    return ("p.id IN (SELECT resource_id FROM effective_access WHERE user_id=? AND resource_type='page' AND level>=?)",
+            [user['id'], PERM_RANK['delete']])
+
+def purge_trash():
+    """Remove pages whose retention has expired, one bounded chunk at a time."""
+    cutoff = (datetime.utcnow() - timedelta(days=TRASH_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    total = 0
+    while True:
+        purged = notes_tools.purge_trash_chunk(cutoff, TRASH_PURGE_CHUNK)
+        total += purged
+        if purged < TRASH_PURGE_CHUNK:
+            break
+        time.sleep(0.05)  # let queued writers in between chunks
+    _purge_stats['runs'] += 1
+    _purge_stats['purged'] += total
+    if total:
+        logger.info(f"Purged {total} trashed pages")
+    return total
+
+def _purge_loop():
+    while True:
+        _purge_wake.wait(TRASH_PURGE_INTERVAL)
+        _purge_wake.clear()
+        try:
+            purge_trash()
+        except sqlite3.Error:
+            logger.exception("Trash purge failed")
+
+def trash_stats():
+    return dict(_purge_stats, retention_days=TRASH_RETENTION_DAYS)
+
+threading.Thread(target=_purge_loop, name='trash-purger', daemon=True).start()
+
+@app.route('/api/trash', methods=['GET'])
+@login_required
+def list_trash():
+    """Trashed page subtrees the user can restore, newest first."""
+    trash_filter, trash_params = _trash_filter(g.user)
+    with get_db() as conn:
+        rows = conn.execute(f"""
+            SELECT p.id, p.title, p.icon, p.workspace, p.parent_id, p.deleted_at,
+                   (SELECT COUNT(*) FROM pages d WHERE d.deleted_root = p.id AND d.deleted_at IS NOT NULL) AS page_count
+            FROM pages p
+            WHERE p.deleted_at IS NOT NULL AND p.deleted_at > ? AND p.deleted_root = p.id AND {trash_filter}
+            ORDER BY p.deleted_at DESC
+        """, (PURGE_NOW, *trash_params)).fetchall()
+    return jsonify([dict_row(r) for r in rows])
 
-def delete_page_recursive(conn, page_id):
-    children = conn.execute("SELECT id FROM pages WHERE parent_id=?", (page_id,)).fetchall()
-    for child in children:
-        delete_page_recursive(conn, child['id'])
-    conn.execute("DELETE FROM blocks WHERE page_id=?", (page_id,))
-    conn.execute("DELETE FROM permissions WHERE resource_type='page' AND resource_id=?", (page_id,))
-    conn.execute("DELETE FROM pages WHERE id=?", (page_id,))
+@app.route('/api/trash/<page_id>/restore', methods=['POST'])
+@login_required
+def restore_trash(page_id):
+    trash_filter, trash_params = _trash_filter(g.user)
+    with get_db() as conn:
+        if not conn.execute(
+            f"SELECT 1 FROM pages p WHERE p.id=? AND p.deleted_root = p.id AND p.deleted_at > ? AND {trash_filter}",
+            (page_id, PURGE_NOW, *trash_params)
+        ).fetchone():
+            return jsonify({'error': 'Not found'}), 404
+        restored = notes_tools.restore_page(conn, page_id)
+        conn.commit()
+    for pid in restored:
+        invalidate_access(resource_type='page', resource_id=pid)
+    return jsonify({'ok': True, 'restored': len(restored)})
+
+@app.route('/api/trash/<page_id>', methods=['DELETE'])
+@login_required
+def purge_trash_page(page_id):
+    """Delete a trashed subtree for good; the purger picks it up right away."""
+    trash_filter, trash_params = _trash_filter(g.user)
+    with get_db() as conn:
+        cur = conn.execute(
+            f"UPDATE pages SET deleted_at=? WHERE deleted_root=? AND deleted_at IS NOT NULL AND EXISTS "
+            f"(SELECT 1 FROM pages p WHERE p.id=? AND p.deleted_root = p.id AND {trash_filter})",
+            (PURGE_NOW, page_id, page_id, *trash_params)
+        )
+        conn.commit()
+    if not cur.rowcount:
+        return jsonify({'error': 'Not found'}), 404
+    _purge_wake.set()
+    return jsonify({'ok': True})
 
 @app.route('/api/pages/reorder', methods=['PUT'])
 @login_required
 def reorder_pages():
+    """Move one page ({id, after_id}) among its siblings, or rewrite a full {order} list."""
     data = request.get_json(force=True)
     order = data.get('order', [])
     with get_db() as conn:
-        for idx, pid in enumerate(order):
-            conn.execute("UPDATE pages SET sort_order=? WHERE id=?", (idx, pid))
+        if data.get('id'):
+            page = conn.execute("SELECT parent_id, workspace FROM pages WHERE id=?", (data['id'],)).fetchone()
+            if not page:
+                return jsonify({'error': 'Not found'}), 404
+            sort_order = order_key_after(conn, 'pages', page_order_scope(page['parent_id'], page['workspace']),
+                                         data.get('after_id'), exclude_id=data['id'])
+            conn.execute("UPDATE pages SET sort_order=? WHERE id=?", (sort_order, data['id']))
+        else:
+            conn.executemany("UPDATE pages SET sort_order=? WHERE id=?",
+                             [(idx, pid) for idx, pid in enumerate(order)])
         conn.commit()
     return jsonify({'ok': True})
 
@@ -806,6 +1007,12 @@ def get_blocks(page_id):
         ).fetchall()
     return jsonify([dict_row(r) for r in rows])
 
+def _block_insert_order(conn, page_id, after_id=None):
+    """sort_order for a new block placed right after `after_id`, or at the end of the page."""
+    if after_id:
+        return order_key_after(conn, 'blocks', {'page_id': page_id}, after_id)
+    return order_key_last(conn, 'blocks', {'page_id': page_id})
+
 @app.route('/api/pages/<page_id>/blocks', methods=['POST'])
 @login_required
 def create_block(page_id):
@@ -818,23 +1025,7 @@ def create_block(page_id):
     indent = data.get('indent_level', 0)
     
     with get_db() as conn:
-        if after_id:
-            after_block = conn.execute("SELECT sort_order FROM blocks WHERE id=?", (after_id,)).fetchone()
-            if after_block:
-                sort_order = after_block['sort_order'] + 1
-                conn.execute(
-                    "UPDATE blocks SET sort_order = sort_order + 1 WHERE page_id=? AND sort_order >= ?",
-                    (page_id, sort_order)
-                )
-            else:
-                sort_order = conn.execute(
-                    "SELECT COALESCE(MAX(sort_order),0)+1 FROM blocks WHERE page_id=?", (page_id,)
-                ).fetchone()[0]
-        else:
-            sort_order = conn.execute(
-                "SELECT COALESCE(MAX(sort_order),0)+1 FROM blocks WHERE page_id=?", (page_id,)
-            ).fetchone()[0]
-        
+        sort_order = _block_insert_order(conn, page_id, after_id)
         conn.execute(
             "INSERT INTO blocks (id, page_id, type, content, properties, sort_order, indent_level) VALUES (?,?,?,?,?,?,?)",
             (block_id, page_id, block_type, content, properties, sort_order, indent)
@@ -881,14 +1072,102 @@ def delete_block(block_id):
             conn.commit()
     return jsonify({'ok': True})
 
+BATCH_BLOCK_OPS = ('create', 'update', 'delete', 'move')
+
+def _batch_op_error(op):
+    """Why a batch op is malformed, or None if its fields have the right types."""
+    if not isinstance(op, dict) or op.get('op') not in BATCH_BLOCK_OPS:
+        return f"ops must be a list of {{op: {'|'.join(BATCH_BLOCK_OPS)}, ...}}"
+    if op['op'] != 'create' or 'id' in op:
+        if not isinstance(op.get('id'), str) or not op['id']:
+            return f"{op['op']} op needs a string id"
+    for field in ('type', 'content'):
+        if field in op and not isinstance(op[field], str):
+            return f"{field} must be a string"
+    if op.get('after_id') is not None and not isinstance(op['after_id'], str):
+        return "after_id must be a string or null"
+    for field in ('sort_order', 'indent_level'):
+        if field in op and (isinstance(op[field], bool) or not isinstance(op[field], (int, float))):
+            return f"{field} must be a number"
+    if 'properties' in op and not isinstance(op['properties'], dict):
+        return "properties must be an object"
+    return None
+
+@app.route('/api/pages/<page_id>/blocks/batch', methods=['POST'])
+@login_required
+def batch_blocks(page_id):
+    """Apply a list of block create/update/delete/move ops in one transaction.
+    Used by the editor to flush coalesced autosaves in a single request."""
+    if not can_access_resource(g.user, 'page', page_id, 'write'):
+        return jsonify({'error': 'Access denied'}), 403
+    data = request.get_json(force=True, silent=True)
+    ops = data.get('ops', []) if isinstance(data, dict) else None
+    if not isinstance(ops, list):
+        return jsonify({'error': 'Body must be an object with an ops list'}), 400
+    error = next(filter(None, map(_batch_op_error, ops)), None)
+    if error:
+        return jsonify({'error': error}), 400
+    results = []
+    try:
+        with get_db() as conn:
+            if not conn.execute("SELECT 1 FROM pages WHERE id=?", (page_id,)).fetchone():
+                return jsonify({'error': 'Not found'}), 404
+            for op in ops:
+                kind, block_id = op['op'], op.get('id')
+                if kind == 'create':
+                    block_id = block_id or gen_id()
+                    sort_order = _block_insert_order(conn, page_id, op.get('after_id'))
+                    conn.execute(
+                        "INSERT INTO blocks (id, page_id, type, content, properties, sort_order, indent_level) VALUES (?,?,?,?,?,?,?)",
+                        (block_id, page_id, op.get('type', 'text'), op.get('content', ''),
+                         json.dumps(op.get('properties', {})), sort_order, op.get('indent_level', 0))
+                    )
+                    results.append({'op': kind, 'id': block_id, 'ok': True})
+                    continue
+                if not conn.execute("SELECT 1 FROM blocks WHERE id=? AND page_id=?", (block_id, page_id)).fetchone():
+                    results.append({'op': kind, 'id': block_id, 'ok': False, 'error': 'Not found'})
+                    continue
+                if kind == 'update':
+                    updates, params = [], []
+                    for field in ['type', 'content', 'sort_order', 'indent_level']:
+                        if field in op:
+                            updates.append(f"{field}=?")
+                            params.append(op[field])
+                    if 'properties' in op:
+                        updates.append("properties=?")
+                        params.append(json.dumps(op['properties']))
+                    if updates:
+                        conn.execute(f"UPDATE blocks SET {','.join(updates)} WHERE id=?", (*params, block_id))
+                elif kind == 'delete':
+                    conn.execute("DELETE FROM blocks WHERE id=?", (block_id,))
+                elif kind == 'move':
+                    # after_id null/empty moves the block to the top of the page
+                    sort_order = order_key_after(conn, 'blocks', {'page_id': page_id},
+                                                 op.get('after_id'), exclude_id=block_id)
+                    conn.execute("UPDATE blocks SET sort_order=? WHERE id=?", (sort_order, block_id))
+                results.append({'op': kind, 'id': block_id, 'ok': True})
+            if ops:
+                conn.execute("UPDATE pages SET updated_at=? WHERE id=?", (now(), page_id))
+            conn.commit()
+    except sqlite3.IntegrityError as e:
+        # The whole batch was rolled back
+        return jsonify({'error': f'Batch rejected: {e}'}), 409
+    return jsonify({'results': results})
+
 @app.route('/api/pages/<page_id>/blocks/reorder', methods=['PUT'])
 @login_required
 def reorder_blocks(page_id):
+    """Move one block ({id, after_id}; no after_id = top of page), or rewrite a full {order} list."""
     data = request.get_json(force=True)
     order = data.get('order', [])
     with get_db() as conn:
-        for idx, bid in enumerate(order):
-            conn.execute("UPDATE blocks SET sort_order=? WHERE id=? AND page_id=?", (idx, bid, page_id))
+        if data.get('id'):
+            sort_order = order_key_after(conn, 'blocks', {'page_id': page_id},
+                                         data.get('after_id'), exclude_id=data['id'])
+            conn.execute("UPDATE blocks SET sort_order=? WHERE id=? AND page_id=?", (sort_order, data['id'], page_id))
+        else:
+            conn.executemany("UPDATE blocks SET sort_order=? WHERE id=? AND page_id=?",
+                             [(idx, bid, page_id) for idx, bid in enumerate(order)])
         conn.execute("UPDATE pages SET updated_at=? WHERE id=?", (now(), page_id))
         conn.commit()
     return jsonify({'ok': True})
@@ -909,19 +1188,23 @@ def list_databases():
         rows = conn.execute(
             f"SELECT * FROM databases WHERE {' AND '.join(where)} ORDER BY updated_at DESC", params
         ).fetchall()
+        # Fetch views for all listed databases in one query instead of one per database
+        views_by_db = {}
+        db_ids = [r['id'] for r in rows]
+        if db_ids:
+            placeholders = ','.join('?' * len(db_ids))
+            views = conn.execute(
+                f"SELECT * FROM db_views WHERE database_id IN ({placeholders}) ORDER BY sort_order", db_ids
+            ).fetchall()
+            for v in views:
+                vd = dict_row(v)
+                vd['config'] = json.loads(vd['config']) if vd['config'] else {}
+                views_by_db.setdefault(vd['database_id'], []).append(vd)
     result = []
     for r in rows:
         d = dict_row(r)
         d['properties_schema'] = json.loads(d['properties_schema']) if d['properties_schema'] else []
-        return_views = []
-        with get_db() as conn2:
-            views = conn2.execute(
-                "SELECT * FROM db_views WHERE database_id=? ORDER BY sort_order", (d['id'],)
-            ).fetchall()
-            return_views = [dict_row(v) for v in views]
-            for v in return_views:
-                v['config'] = json.loads(v['config']) if v['config'] else {}
-        d['views'] = return_views
+        d['views'] = views_by_db.get(d['id'], [])
         result.append(d)
     return jsonify(result)
 
@@ -1025,9 +1308,13 @@ def get_database(db_id):
         db = conn.execute("SELECT * FROM databases WHERE id=?", (db_id,)).fetchone()
         if not db:
             return jsonify({'error': 'Not found'}), 404
-        items = conn.execute(
-            "SELECT * FROM db_items WHERE database_id=? ORDER BY sort_order, created_at", (db_id,)
-        ).fetchall()
+        # ?items=0 skips the rows; the UI pages through them with /items/query instead
+        if request.args.get('items') == '0':
+            items = []
+        else:
+            items = conn.execute(
+                "SELECT * FROM db_items WHERE database_id=? ORDER BY sort_order, created_at", (db_id,)
+            ).fetchall()
         views = conn.execute(
             "SELECT * FROM db_views WHERE database_id=? ORDER BY sort_order", (db_id,)
         ).fetchall()
@@ -1078,15 +1365,14 @@ def delete_database(db_id):
         return jsonify({'error': 'Access denied'}), 403
     with get_db() as conn:
         # Delete associated pages for items
-        items = conn.execute("SELECT page_id FROM db_items WHERE database_id=? AND page_id IS NOT NULL", (db_id,)).fetchall()
-        for item in items:
-            if item['page_id']:
-                conn.execute("DELETE FROM blocks WHERE page_id=?", (item['page_id'],))
-                conn.execute("DELETE FROM pages WHERE id=?", (item['page_id'],))
+        item_pages = "SELECT page_id FROM db_items WHERE database_id=? AND page_id IS NOT NULL"
+        conn.execute(f"DELETE FROM blocks WHERE page_id IN ({item_pages})", (db_id,))
+        conn.execute(f"DELETE FROM pages WHERE id IN ({item_pages})", (db_id,))
         conn.execute("DELETE FROM db_items WHERE database_id=?", (db_id,))
         conn.execute("DELETE FROM db_views WHERE database_id=?", (db_id,))
         conn.execute("DELETE FROM databases WHERE id=?", (db_id,))
         conn.commit()
+    invalidate_access(resource_type='database', resource_id=db_id)
     return jsonify({'ok': True})
 
 # ── Database Items ─────────────────────────────────────────────────────────
@@ -1101,9 +1387,7 @@ def create_db_item(db_id):
     properties = data.get('properties', {})
     
     with get_db() as conn:
-        max_order = conn.execute(
-            "SELECT COALESCE(MAX(sort_order),0) FROM db_items WHERE database_id=?", (db_id,)
-        ).fetchone()[0]
+        sort_order = order_key_last(conn, 'db_items', {'database_id': db_id})
         
         # Create associated page for item content
         page_id = gen_id()
@@ -1119,7 +1403,7 @@ def create_db_item(db_id):
         
         conn.execute(
             "INSERT INTO db_items (id, database_id, title, icon, properties, page_id, sort_order) VALUES (?,?,?,?,?,?,?)",
-            (item_id, db_id, title, icon, json.dumps(properties), page_id, max_order + 1)
+            (item_id, db_id, title, icon, json.dumps(properties), page_id, sort_order)
         )
         conn.execute("UPDATE databases SET updated_at=? WHERE id=?", (now(), db_id))
         conn.commit()
@@ -1178,14 +1462,270 @@ def delete_db_item(db_id, item_id):
 @app.route('/api/databases/<db_id>/items/reorder', methods=['PUT'])
 @login_required
 def reorder_db_items(db_id):
+    """Move one item ({id, after_id}; no after_id = first), or rewrite a full {order} list."""
     data = request.get_json(force=True)
     order = data.get('order', [])
     with get_db() as conn:
-        for idx, item_id in enumerate(order):
-            conn.execute("UPDATE db_items SET sort_order=? WHERE id=?", (idx, item_id))
+        if data.get('id'):
+            sort_order = order_key_after(conn, 'db_items', {'database_id': db_id},
+                                         data.get('after_id'), exclude_id=data['id'])
+            conn.execute("UPDATE db_items SET sort_order=? WHERE id=? AND database_id=?", (sort_order, data['id'], db_id))
+        else:
+            conn.executemany("UPDATE db_items SET sort_order=? WHERE id=?",
+                             [(idx, item_id) for idx, item_id in enumerate(order)])
         conn.commit()
     return jsonify({'ok': True})
 
+# ── Database Item Queries ──────────────────────────────────────────────────
+# A view's config holds {"filters": [...], "sorts": [...], "group_by": prop_id}.
+# query_db_items() compiles it to SQL over json_extract(properties, ...) and returns
+# one keyset-paginated page, so opening a large database never ships the whole table.
+#   filters: [{"property": "<prop id or title/created_at/updated_at/sort_order>", "op": "eq", "value": ...}]
+#   sorts:   [{"property": "<prop id or column>", "direction": "asc" | "desc"}]
+
+ITEM_COLUMNS = ('title', 'created_at', 'updated_at', 'sort_order')
+ITEM_FILTER_OPS = {
+    'eq': "{expr} = ?",
+    'neq': "{expr} IS NOT ?",
+    'gt': "{expr} > ?",
+    'gte': "{expr} >= ?",
+    'lt': "{expr} < ?",
+    'lte': "{expr} <= ?",
+    'contains': "instr(lower({expr}), lower(?)) > 0",
+    'not_contains': "instr(lower(IFNULL({expr}, '')), lower(?)) = 0",
+    'empty': "IFNULL({expr}, '') = ''",
+    'not_empty': "IFNULL({expr}, '') != ''",
+}
+ITEM_PAGE_DEFAULT = 50
+ITEM_PAGE_MAX = 500
+ANY_GROUP = object()
+
+def item_property_sql(prop, schema):
+    """(SQL expression, params) for a view property: an item column or a properties JSON field."""
+    if prop in ITEM_COLUMNS:
+        return f"db_items.{prop}", []
+    if not isinstance(prop, str) or '"' in prop or not any(p.get('id') == prop for p in schema):
+        raise ValueError(f"Unknown property: {prop}")
+    return "json_extract(db_items.properties, ?)", [f'$."{prop}"']
+
+def _config_entries(config, key):
+    """config[key] as a list of dicts (filters, sorts); ValueError otherwise."""
+    entries = config.get(key) or []
+    if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+        raise ValueError(f"{key} must be a list of objects")
+    return entries
+
+def _scalar(value, what):
+    """`value` if SQLite can bind it as a plain value; ValueError otherwise."""
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        raise ValueError(f"{what} must be a string, number, boolean or null")
+    return value
+
+def item_filter_sql(config, schema, group=ANY_GROUP):
+    """WHERE fragments and params for a view's filters, optionally narrowed to one
+    group_by value (group=None selects items with no value or an unknown option)."""
+    where, params = [], []
+    for f in _config_entries(config, 'filters'):
+        expr, expr_params = item_property_sql(f.get('property'), schema)
+        op = f.get('op', 'eq')
+        if not isinstance(op, str):
+            raise ValueError("Filter op must be a string")
+        if op == 'in':
+            values = f.get('value') or []
+            if not isinstance(values, list):
+                raise ValueError("'in' filter value must be a list")
+            values = [_scalar(v, "'in' filter values") for v in values]
+            where.append(f"{expr} IN ({','.join('?' * len(values))})" if values else "0")
+            params += expr_params + values
+        elif op in ('empty', 'not_empty'):
+            where.append(ITEM_FILTER_OPS[op].format(expr=expr))
+            params += expr_params
+        elif op in ITEM_FILTER_OPS:
+            where.append(ITEM_FILTER_OPS[op].format(expr=expr))
+            params += expr_params + [_scalar(f.get('value'), f"'{op}' filter value")]
+        else:
+            raise ValueError(f"Unknown filter op: {op}")
+    group_by = config.get('group_by')
+    if group is not ANY_GROUP and group_by:
+        expr, expr_params = item_property_sql(group_by, schema)
+        if group is None:
+            prop = next((p for p in schema if p.get('id') == group_by), {})
+            options = [o['name'] for o in prop.get('options') or []]
+            if options:
+                where.append(f"({expr} IS NULL OR {expr} NOT IN ({','.join('?' * len(options))}))")
+                params += expr_params + expr_params + options
+        else:
+            where.append(f"{expr} = ?")
+            params += expr_params + [_scalar(group, "group")]
+    return where, params
+
+def _item_order_terms(config, schema):
+    """[(expr, params, descending)] — user sorts (nulls last), then sort_order, then id."""
+    terms = []
+    for srt in _config_entries(config, 'sorts'):
+        expr, expr_params = item_property_sql(srt.get('property'), schema)
+        terms.append((f"{expr} IS NULL", expr_params, False))
+        terms.append((expr, expr_params, str(srt.get('direction', 'asc')).lower() == 'desc'))
+    terms.append(("db_items.sort_order", [], False))
+    terms.append(("db_items.id", [], False))
+    return terms
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Cursor does not match this query")
+    return values
+
+def query_db_items(conn, db_id, schema, config, limit=ITEM_PAGE_DEFAULT, cursor=None, group=ANY_GROUP):
+    """One page of a database's items under a view config. Returns (items, next_cursor).
+    Pagination is keyset-based: the cursor holds the last row's sort key, so page N costs
+    the same as page 1. Raises ValueError for unknown properties, ops or bad cursors."""
+    where, params = item_filter_sql(config, schema, group)
+    where.insert(0, "db_items.database_id=?")
+    params.insert(0, db_id)
+    terms = _item_order_terms(config, schema)
+    if cursor:
+        values = _decode_cursor(cursor, len(terms))
+        after, after_params = [], []
+        for i, (expr, expr_params, desc) in enumerate(terms):
+            parts, part_params = [], []
+            for j in range(i):
+                parts.append(f"({terms[j][0]}) IS ?")
+                part_params += terms[j][1] + [values[j]]
+            parts.append(f"({expr}) {'<' if desc else '>'} ?")
+            part_params += expr_params + [values[i]]
+            after.append(f"({' AND '.join(parts)})")
+            after_params += part_params
+        where.append(f"({' OR '.join(after)})")
+        params += after_params
+    select_keys = ', '.join(f"{expr} AS _k{i}" for i, (expr, _, _) in enumerate(terms))
+    select_params = [p for _, expr_params, _ in terms for p in expr_params]
+    order_by = ', '.join(f"{expr} {'DESC' if desc else 'ASC'}" for expr, _, desc in terms)
+    rows = conn.execute(
+        f"SELECT db_items.*, {select_keys} FROM db_items WHERE {' AND '.join(where)} ORDER BY {order_by} LIMIT ?",
+        (*select_params, *params, *select_params, limit + 1)
+    ).fetchall()
+    items = []
+    for row in rows[:limit]:
+        item = {k: row[k] for k in row.keys() if not k.startswith('_k')}
+        item['properties'] = json.loads(item['properties']) if item['properties'] else {}
+        items.append(item)
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = _encode_cursor([last[f'_k{i}'] for i in range(len(terms))])
+    return items, next_cursor
+
+def _view_config(conn, db_id, data):
+    """Config of data['view_id'] (if any) with filters/sorts/group_by from the request on top.
+    Returns (schema, config), or None if the database or view doesn't exist."""
+    db = conn.execute("SELECT properties_schema FROM databases WHERE id=?", (db_id,)).fetchone()
+    if not db:
+        return None
+    schema = json.loads(db['properties_schema']) if db['properties_schema'] else []
+    config = {}
+    if data.get('view_id'):
+        view = conn.execute("SELECT config FROM db_views WHERE id=? AND database_id=?",
+                            (data['view_id'], db_id)).fetchone()
+        if not view:
+            return None
+        config = json.loads(view['config']) if view['config'] else {}
+    for key in ('filters', 'sorts', 'group_by'):
+        if key in data:
+            config[key] = data[key]
+    return schema, config
+
+@app.route('/api/databases/<db_id>/items/query', methods=['POST'])
+@login_required
+def query_db_items_route(db_id):
+    """A page of items filtered, sorted and (optionally) narrowed to one board group in SQL."""
+    if not can_access_resource(g.user, 'database', db_id, 'read'):
+        return jsonify({'error': 'Access denied'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = min(max(int(data.get('limit') or ITEM_PAGE_DEFAULT), 1), ITEM_PAGE_MAX)
+    except (ValueError, TypeError):
+        return jsonify({'error': f"Invalid limit: {data.get('limit')!r}"}), 400
+    group = data['group'] if 'group' in data else ANY_GROUP
+    with get_db() as conn:
+        found = _view_config(conn, db_id, data)
+        if found is None:
+            return jsonify({'error': 'Not found'}), 404
+        schema, config = found
+        try:
+            items, next_cursor = query_db_items(conn, db_id, schema, config, limit, data.get('cursor'), group)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+ITEM_AGGREGATES = ('sum', 'min', 'max')
+
+@app.route('/api/databases/<db_id>/views/<view_id>/groups', methods=['GET'])
+@login_required
+def db_view_groups(db_id, view_id):
+    """Per-option item counts for a board view's group_by property, computed with one
+    GROUP BY over the view's filters. ?sum=/min=/max=<prop id> (repeatable) add
+    per-group aggregates of numeric or date properties. Items with no value or an
+    option that no longer exists are folded into the `value: null` group."""
+    if not can_access_resource(g.user, 'database', db_id, 'read'):
+        return jsonify({'error': 'Access denied'}), 403
+    args = {'view_id': view_id}
+    if request.args.get('group_by'):
+        args['group_by'] = request.args['group_by']
+    with get_db() as conn:
+        found = _view_config(conn, db_id, args)
+        if found is None:
+            return jsonify({'error': 'Not found'}), 404
+        schema, config = found
+        group_by = config.get('group_by')
+        try:
+            if not group_by:
+                raise ValueError("View has no group_by property")
+            group_expr, group_params = item_property_sql(group_by, schema)
+            where, params = item_filter_sql(config, schema)
+            columns, column_params, aggregates = [], [], []
+            for agg in ITEM_AGGREGATES:
+                for prop in request.args.getlist(agg):
+                    expr, expr_params = item_property_sql(prop, schema)
+                    columns.append(f"{agg.upper()}({expr}) AS _a{len(aggregates)}")
+                    column_params += expr_params
+                    aggregates.append((agg, prop))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        rows = conn.execute(
+            f"SELECT {group_expr} AS grp, COUNT(*) AS count{''.join(', ' + c for c in columns)} "
+            f"FROM db_items WHERE {' AND '.join(['db_items.database_id=?'] + where)} GROUP BY grp",
+            (*group_params, *column_params, db_id, *params)
+        ).fetchall()
+
+    prop = next((p for p in schema if p.get('id') == group_by), {})
+    groups = {o['name']: {'value': o['name'], 'color': o.get('color'), 'count': 0} for o in prop.get('options') or []}
+    groups[None] = {'value': None, 'color': None, 'count': 0}
+    for g_ in groups.values():
+        for agg in ITEM_AGGREGATES:
+            g_[agg] = {}
+    for r in rows:
+        target = groups.get(r['grp']) if r['grp'] in groups else groups[None]
+        target['count'] += r['count']
+        for i, (agg, prop_id) in enumerate(aggregates):
+            value, current = r[f'_a{i}'], target[agg].get(prop_id)
+            if value is None:
+                continue
+            if current is None:
+                target[agg][prop_id] = value
+            elif agg == 'sum':
+                target[agg][prop_id] = current + value
+            else:
+                target[agg][prop_id] = min(current, value) if agg == 'min' else max(current, value)
+    return jsonify({'group_by': group_by, 'total': sum(g_['count'] for g_ in groups.values()),
+                    'groups': list(groups.values())})
+
 # ── Database Views ─────────────────────────────────────────────────────────
 
 @app.route('/api/databases/<db_id>/views', methods=['POST'])
@@ -1385,40 +1925,106 @@ def search():
     q = request.args.get('q', '').strip()
     if not q:
         return jsonify([])
-    with get_db() as conn:
-        pages = conn.execute(
-            "SELECT id, title, icon, parent_id, workspace FROM pages WHERE title LIKE ? AND workspace != '_db_item' LIMIT 20",
-            (f'%{q}%',)
-        ).fetchall()
-        blocks = conn.execute(
-            """SELECT b.page_id, b.content, p.title, p.icon, p.workspace
-               FROM blocks b JOIN pages p ON b.page_id = p.id 
-               WHERE b.content LIKE ? AND p.workspace != '_db_item' LIMIT 20""",
-            (f'%{q}%',)
-        ).fetchall()
-        db_items = conn.execute(
-            """SELECT i.id, i.title, i.icon, i.database_id, d.title as db_title
-               FROM db_items i JOIN databases d ON i.database_id = d.id
-               WHERE i.title LIKE ? LIMIT 10""",
-            (f'%{q}%',)
-        ).fetchall()
+    # Matches in snippets are wrapped in \x02…\x03 so the client can highlight after escaping
+    found = notes_tools.fts_search(q, mark=('\x02', '\x03'))
     
     results = []
     seen = set()
-    for p in pages:
+    for p in found['pages']:
         seen.add(p['id'])
         results.append({'type': 'page', 'page_id': p['id'], 'title': p['title'], 
                        'icon': p['icon'], 'workspace': p['workspace']})
-    for b in blocks:
+    for b in found['blocks']:
         if b['page_id'] not in seen:
             seen.add(b['page_id'])
             results.append({'type': 'block', 'page_id': b['page_id'], 'title': b['title'],
-                          'icon': b['icon'], 'snippet': b['content'][:100], 'workspace': b['workspace']})
-    for i in db_items:
+                          'icon': b['icon'], 'snippet': b['snippet'], 'workspace': b['workspace']})
+    for i in found['items']:
         results.append({'type': 'db_item', 'item_id': i['id'], 'title': i['title'],
                        'icon': i['icon'], 'database_id': i['database_id'], 'db_title': i['db_title']})
     return jsonify(results)
 
+@app.route('/api/admin/search/rebuild', methods=['POST'])
+@admin_required
+def admin_rebuild_search():
+    """Rebuild the FTS5 search index from pages, blocks and db_items."""
+    return jsonify(json.loads(notes_tools.rebuild_search_index()))
+
+# ── AI Response Cache ──────────────────────────────────────────────────────
+# Inline and block actions are cached in ai_response_cache, keyed on a hash of
+# (model, action, language, system prompt, prompt text). Entries expire after
+# AI_CACHE_TTL seconds; past AI_CACHE_MAX_ENTRIES the least recently used go.
+# Requests with "no_cache": true skip the lookup but still store the new answer.
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', str(7 * 86400)))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '5000'))
+_ai_cache_lock = threading.Lock()
+_ai_cache_stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0, 'evictions': 0}
+
+def _ai_cache_count(name, delta=1):
+    with _ai_cache_lock:
+        _ai_cache_stats[name] += delta
+
+def cached_completion(api_config, system, prompt, action, language='', bypass=False):
+    """call_claude() for a single prompt, answered from the response cache when possible.
+    Returns (text, cached)."""
+    key = hashlib.sha256(json.dumps(
+        [api_config.get('model', CHAT_CONFIG['model']), action, language, system, prompt]
+    ).encode()).hexdigest()
+    now_ts = time.time()
+    if bypass:
+        _ai_cache_count('bypassed')
+    else:
+        with get_db() as conn:
+            row = conn.execute(
+                "SELECT result FROM ai_response_cache WHERE key=? AND created_at>?", (key, now_ts - AI_CACHE_TTL)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE ai_response_cache SET last_used=?, hits=hits+1 WHERE key=?", (now_ts, key))
+                conn.commit()
+        if row:
+            _ai_cache_count('hits')
+            return row['result'], True
+        _ai_cache_count('misses')
+
+    result = call_claude(api_config, system, [{"role": "user", "content": prompt}])
+    text = ''.join(b['text'] for b in result.get('content', []) if b.get('type') == 'text').strip()
+    if not text:
+        return text, False
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO ai_response_cache (key, action, result, created_at, last_used) "
+            "VALUES (?,?,?,?,?)", (key, action, text, now_ts, now_ts)
+        )
+        evicted = conn.execute("DELETE FROM ai_response_cache WHERE created_at<=?",
+                               (now_ts - AI_CACHE_TTL,)).rowcount
+        overflow = conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0] - AI_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            evicted += conn.execute(
+                "DELETE FROM ai_response_cache WHERE key IN "
+                "(SELECT key FROM ai_response_cache ORDER BY last_used LIMIT ?)", (overflow,)
+            ).rowcount
+        conn.commit()
+    _ai_cache_count('stores')
+    _ai_cache_count('evictions', evicted)
+    return text, False
+
+def ai_cache_stats():
+    with get_db() as conn:
+        entries = conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0]
+    with _ai_cache_lock:
+        lookups = _ai_cache_stats['hits'] + _ai_cache_stats['misses']
+        return dict(_ai_cache_stats, entries=entries, max_entries=AI_CACHE_MAX_ENTRIES, ttl=AI_CACHE_TTL,
+                    hit_rate=round(_ai_cache_stats['hits'] / lookups, 3) if lookups else None)
+
+@app.route('/api/admin/ai-cache', methods=['DELETE'])
+@admin_required
+def admin_clear_ai_cache():
+    """Drop every cached AI action response."""
+    with get_db() as conn:
+        removed = conn.execute("DELETE FROM ai_response_cache").rowcount
+        conn.commit()
+    return jsonify({'ok': True, 'removed': removed})
+
 # ── AI Inline & Block Actions ──────────────────────────────────────────────
 
 @app.route('/api/ai/inline', methods=['POST'])
@@ -1454,15 +2060,11 @@ def ai_inline():
     
     try:
         api_config = get_api_config()
-        result = call_claude(api_config, 'You are a helpful writing assistant. Follow instructions precisely. Be concise.', 
-                           [{"role": "user", "content": prompt}])
+        response_text, cached = cached_completion(
+            api_config, 'You are a helpful writing assistant. Follow instructions precisely. Be concise.',
+            prompt, action, language, bypass=bool(data.get('no_cache')))
         
-        response_text = ''
-        for block in result.get('content', []):
-            if block.get('type') == 'text':
-                response_text += block['text']
-        
-        return jsonify({'result': response_text.strip(), 'action': action})
+        return jsonify({'result': response_text, 'action': action, 'cached': cached})
     except Exception as e:
         logger.error(f"AI inline error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1510,33 +2112,32 @@ def ai_block():
     
     try:
         api_config = get_api_config()
-        result = call_claude(api_config, 'You are a helpful writing assistant integrated into a note-taking app. Be concise and well-structured.',
-                           [{"role": "user", "content": ai_prompt}])
-        
-        response_text = ''
-        for block in result.get('content', []):
-            if block.get('type') == 'text':
-                response_text += block['text']
+        response_text, cached = cached_completion(
+            api_config, 'You are a helpful writing assistant integrated into a note-taking app. Be concise and well-structured.',
+            ai_prompt, action, language, bypass=bool(data.get('no_cache')))
         
-        return jsonify({'result': response_text.strip(), 'action': action})
+        return jsonify({'result': response_text, 'action': action, 'cached': cached})
     except Exception as e:
         logger.error(f"AI block error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/ai/research', methods=['POST'])
-def ai_research():
-    """AI Research — generate a comprehensive research page on a topic."""
-    data = request.get_json(force=True)
-    topic = data.get('topic', '').strip()
-    title = data.get('title', '').strip()
-    
-    if not topic:
-        return jsonify({'error': 'No topic provided'}), 400
-    
-    try:
-        api_config = get_api_config()
-        prompt = f"""Research the following topic thoroughly and create a comprehensive, well-structured report.
+# ── Research Jobs ──────────────────────────────────────────────────────────
+# Research is submitted as a job (research_jobs) and runs on a bounded pool of
+# RESEARCH_WORKERS threads, so a long report never holds an HTTP request open.
+# Jobs go queued → running → done | failed | cancelled. A job cancelled while
+# running finishes its upstream call but creates no page. Jobs cut off by a
+# restart are queued again on startup.
+RESEARCH_WORKERS = int(os.environ.get('RESEARCH_WORKERS', '2'))
+RESEARCH_FINAL = ('done', 'failed', 'cancelled')
+
+_research_executor = ThreadPoolExecutor(max_workers=RESEARCH_WORKERS, thread_name_prefix='research')
+_research_cancel = {}      # job_id -> threading.Event, while queued or running
+_research_lock = threading.Lock()
+
+def generate_research(api_config, topic, title=''):
+    """Ask the model for a report on `topic`. Returns (page title, blocks)."""
+    prompt = f"""Research the following topic thoroughly and create a comprehensive, well-structured report.
 
 Topic: {topic}
 
@@ -1552,77 +2153,174 @@ Be factual, thorough, and cite specific information where possible.
 
 IMPORTANT: Start directly with the content. Do NOT include meta-commentary like "I will analyze...", "Let me research...", "Now I have enough data...", "Here is my report...", thinking-out-loud, or preambles. Just the report itself."""
 
-        result = call_claude(api_config, 
-                           'You are a research assistant. Provide thorough, well-structured research reports. Use your knowledge to be as comprehensive as possible.',
-                           [{"role": "user", "content": prompt}])
-        
-        response_text = ''
-        for block in result.get('content', []):
-            if block.get('type') == 'text':
-                response_text += block['text']
-        
-        # Strip meta-commentary lines from response
-        filtered_lines = []
-        skip_patterns = re.compile(
-            r'^(I will |I\'ll |Let me |Now I |Here is |Here\'s |Below is |I have |'
-            r'Ich werde |Lass mich |Hier ist |Jetzt habe |Nun werde |'
-            r'I\'m going to |Allow me |I am now |Based on my |After analyzing)',
-            re.IGNORECASE
+    result = call_claude(api_config,
+                         'You are a research assistant. Provide thorough, well-structured research reports. Use your knowledge to be as comprehensive as possible.',
+                         [{"role": "user", "content": prompt}])
+    
+    response_text = ''
+    for block in result.get('content', []):
+        if block.get('type') == 'text':
+            response_text += block['text']
+    
+    # Strip meta-commentary lines from response
+    filtered_lines = []
+    skip_patterns = re.compile(
+        r'^(I will |I\'ll |Let me |Now I |Here is |Here\'s |Below is |I have |'
+        r'Ich werde |Lass mich |Hier ist |Jetzt habe |Nun werde |'
+        r'I\'m going to |Allow me |I am now |Based on my |After analyzing)',
+        re.IGNORECASE
+    )
+    for line in response_text.strip().split('\n'):
+        if line.strip() and skip_patterns.match(line.strip()) and len(line.strip()) < 200:
+            continue
+        filtered_lines.append(line)
+    response_text = '\n'.join(filtered_lines)
+    
+    # Parse markdown into blocks
+    blocks = parse_markdown_to_blocks(response_text.strip())
+    
+    # Use provided title, or extract from first heading, or truncate topic
+    short_title = title
+    if not short_title:
+        for block in blocks:
+            if block['type'] in ('h1', 'h2') and block['content']:
+                t = re.sub(r'<[^>]+>', '', block['content']).strip()
+                if len(t) <= 80:
+                    short_title = t
+                    blocks = [b for b in blocks if b is not block]
+                break
+    if not short_title:
+        short_title = topic.split('.')[0].split('\n')[0][:60].strip()
+    
+    return short_title, blocks
+
+def create_research_page(topic, short_title, blocks):
+    """Create the research page (topic quote, divider, report) in one transaction."""
+    page_id = gen_id()
+    rows = [(gen_id(), page_id, 'quote', md_inline(topic), 0), (gen_id(), page_id, 'divider', '', 1)]
+    rows += [(gen_id(), page_id, block['type'], block['content'], i + 2) for i, block in enumerate(blocks)]
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO pages (id, title, icon, workspace, sort_order) VALUES (?,?,?,'docs',0)",
+            (page_id, short_title, 'search')
         )
-        for line in response_text.strip().split('\n'):
-            if line.strip() and skip_patterns.match(line.strip()) and len(line.strip()) < 200:
-                continue
-            filtered_lines.append(line)
-        response_text = '\n'.join(filtered_lines)
-        
-        # Parse markdown into blocks
-        blocks = parse_markdown_to_blocks(response_text.strip())
-        
-        # Use provided title, or extract from first heading, or truncate topic
-        short_title = title
-        if not short_title:
-            for block in blocks:
-                if block['type'] in ('h1', 'h2') and block['content']:
-                    t = re.sub(r'<[^>]+>', '', block['content']).strip()
-                    if len(t) <= 80:
-                        short_title = t
-                        blocks = [b for b in blocks if b is not block]
-                    break
-        if not short_title:
-            short_title = topic.split('.')[0].split('\n')[0][:60].strip()
-        
-        # Create page: short title, then prompt as subtitle, then research content
-        page_id = gen_id()
-        with get_db() as conn:
-            conn.execute(
-                "INSERT INTO pages (id, title, icon, workspace, sort_order) VALUES (?,?,?,'docs',0)",
-                (page_id, short_title, 'search')
-            )
-            # Insert prompt as first block (light text)
-            prompt_bid = gen_id()
-            conn.execute(
-                "INSERT INTO blocks (id, page_id, type, content, sort_order) VALUES (?,?,?,?,?)",
-                (prompt_bid, page_id, 'quote', md_inline(topic), 0)
-            )
-            # Insert divider
-            div_bid = gen_id()
-            conn.execute(
-                "INSERT INTO blocks (id, page_id, type, content, sort_order) VALUES (?,?,?,?,?)",
-                (div_bid, page_id, 'divider', '', 1)
-            )
-            # Insert research blocks
-            for i, block in enumerate(blocks):
-                bid = gen_id()
-                conn.execute(
-                    "INSERT INTO blocks (id, page_id, type, content, sort_order) VALUES (?,?,?,?,?)",
-                    (bid, page_id, block['type'], block['content'], i + 2)
-                )
-            conn.commit()
-        
-        return jsonify({'page_id': page_id, 'title': short_title, 'blocks': len(blocks) + 2})
+        conn.executemany(
+            "INSERT INTO blocks (id, page_id, type, content, sort_order) VALUES (?,?,?,?,?)", rows
+        )
+        conn.commit()
+    return {'page_id': page_id, 'title': short_title, 'blocks': len(rows)}
+
+def _research_status(job_id, status, result=None, error=None, only_from=None):
+    """Move a job to `status`; with only_from, only if it is currently in one of those states.
+    Returns whether the row changed."""
+    sql = ("UPDATE research_jobs SET status=?, result=COALESCE(?, result), error=COALESCE(?, error), "
+           "updated_at=CURRENT_TIMESTAMP WHERE id=?")
+    params = [status, json.dumps(result) if result is not None else None, error, job_id]
+    if only_from:
+        sql += f" AND status IN ({','.join('?' * len(only_from))})"
+        params += only_from
+    with get_db() as conn:
+        changed = conn.execute(sql, params).rowcount
+        conn.commit()
+    if status in RESEARCH_FINAL:
+        with _research_lock:
+            _research_cancel.pop(job_id, None)
+    return bool(changed)
+
+def _execute_research(job_id, api_config, topic, title):
+    with _research_lock:
+        cancel = _research_cancel.get(job_id)
+    if cancel is None or cancel.is_set() or not _research_status(job_id, 'running', only_from=('queued',)):
+        return
+    try:
+        short_title, blocks = generate_research(api_config, topic, title)
+        if cancel.is_set():
+            return _research_status(job_id, 'cancelled', only_from=('running',))
+        _research_status(job_id, 'done', result=create_research_page(topic, short_title, blocks),
+                         only_from=('running',))
     except Exception as e:
-        logger.error(f"AI research error: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error(f"Research job {job_id} failed: {e}")
+        _research_status(job_id, 'failed', error=str(e), only_from=('running',))
+
+def submit_research(job_id, topic, title):
+    with _research_lock:
+        _research_cancel[job_id] = threading.Event()
+    _research_executor.submit(_execute_research, job_id, get_api_config(), topic, title)
+
+def _recover_research_jobs():
+    """Queue again the jobs a restart interrupted; their upstream call starts over."""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT id, topic, title FROM research_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+        ).fetchall()
+        conn.execute("UPDATE research_jobs SET status='queued' WHERE status='running'")
+        conn.commit()
+    for row in rows:
+        submit_research(row['id'], row['topic'], row['title'])
+
+def research_job_stats():
+    with get_db() as conn:
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM research_jobs WHERE status IN ('queued', 'running') GROUP BY status"
+        ).fetchall())
+    return {'workers': RESEARCH_WORKERS, 'queued': counts.get('queued', 0), 'running': counts.get('running', 0)}
+
+def _research_job_json(row):
+    job = dict(row)
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+@app.route('/api/ai/research', methods=['POST'])
+def ai_research():
+    """AI Research — queue a job that generates a research page on a topic."""
+    data = request.get_json(force=True)
+    topic = data.get('topic', '').strip()
+    title = data.get('title', '').strip()
+    
+    if not topic:
+        return jsonify({'error': 'No topic provided'}), 400
+    
+    user = get_current_user()
+    job_id = str(uuid.uuid4())
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO research_jobs (id, user_id, topic, title) VALUES (?,?,?,?)",
+            (job_id, user['id'] if user else '', topic, title)
+        )
+        conn.commit()
+    submit_research(job_id, topic, title)
+    return jsonify({'id': job_id, 'status': 'queued'}), 202
+
+@app.route('/api/ai/research/<job_id>', methods=['GET'])
+def get_research_job(job_id):
+    """Status of a research job; `result` is set once it is done."""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM research_jobs WHERE id=?", (job_id,)).fetchone()
+    if not row:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_research_job_json(row))
+
+@app.route('/api/ai/research/<job_id>/result', methods=['GET'])
+def get_research_result(job_id):
+    """The created page of a finished research job: {page_id, title, blocks}."""
+    with get_db() as conn:
+        row = conn.execute("SELECT status, result, error FROM research_jobs WHERE id=?", (job_id,)).fetchone()
+    if not row:
+        return jsonify({'error': 'Job not found'}), 404
+    if row['status'] != 'done':
+        return jsonify({'error': row['error'] or f"Job is {row['status']}", 'status': row['status']}), 409
+    return jsonify(json.loads(row['result']))
+
+@app.route('/api/ai/research/<job_id>/cancel', methods=['POST'])
+def cancel_research_job(job_id):
+    """Cancel a queued or running research job."""
+    with _research_lock:
+        cancel = _research_cancel.get(job_id)
+    if cancel:
+        cancel.set()
+    if not _research_status(job_id, 'cancelled', only_from=('queued', 'running')):
+        return jsonify({'error': 'Job not found or already finished'}), 409
+    return jsonify({'id': job_id, 'status': 'cancelled'})
 
 
 def md_inline(text):
@@ -1708,9 +2406,88 @@ def parse_markdown_to_blocks(text):
     return blocks if blocks else [{'type': 'text', 'content': md_inline(text)}]
 
 
+# ── Page Translation ───────────────────────────────────────────────────────
+# A page is split into block-aligned chunks of at most TRANSLATE_CHUNK_TOKENS and
+# the chunks are translated concurrently on a shared pool of TRANSLATE_WORKERS.
+# Each chunk is sent as a JSON object {block_id: text} and the answer is mapped
+# back by block id. The new page is created up front and each chunk's blocks are
+# inserted as soon as it finishes; a chunk that fails keeps its original text.
+# Job progress is held in memory for TRANSLATE_JOB_KEEP seconds after it ends.
+TRANSLATE_WORKERS = int(os.environ.get('TRANSLATE_WORKERS', '4'))
+TRANSLATE_CHUNK_TOKENS = int(os.environ.get('TRANSLATE_CHUNK_TOKENS', '1500'))
+TRANSLATE_JOB_KEEP = 3600
+
+_translate_executor = ThreadPoolExecutor(max_workers=TRANSLATE_WORKERS, thread_name_prefix='translate')
+_translate_jobs = {}       # job_id -> progress dict (see translate_page)
+_translate_jobs_lock = threading.Lock()
+
+def translation_chunks(blocks, budget=None):
+    """Split blocks that have text into consecutive chunks of at most `budget` tokens."""
+    budget = TRANSLATE_CHUNK_TOKENS if budget is None else budget
+    chunks, current, used = [], [], 0
+    for block in blocks:
+        if not block['content']:
+            continue
+        cost = estimate_tokens(block['content'])
+        if current and used + cost > budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(block)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _translate_chunk(api_config, language, chunk):
+    """{block_id: translated text} for one chunk; ids missing from the answer are omitted."""
+    source = json.dumps({b['id']: b['content'] for b in chunk}, ensure_ascii=False)
+    prompt = f"""Translate the values of this JSON object to {language}.
+Keep every key unchanged and keep any markdown or HTML markup intact.
+Return ONLY the JSON object.
+
+{source}"""
+    result = call_claude(api_config, 'You are a translator. Translate precisely, keeping structure markers intact.',
+                         [{"role": "user", "content": prompt}])
+    text = ''.join(b['text'] for b in result.get('content', []) if b.get('type') == 'text')
+    start, end = text.find('{'), text.rfind('}')
+    translated = json.loads(text[start:end + 1]) if start >= 0 else {}
+    return {b['id']: translated[b['id']] for b in chunk if isinstance(translated.get(b['id']), str)}
+
+def _run_translate_chunk(job_id, api_config, language, new_page_id, chunk):
+    translated, error = {}, None
+    try:
+        translated = _translate_chunk(api_config, language, chunk)
+    except Exception as e:
+        logger.error(f"Translate chunk for {new_page_id} failed: {e}")
+        error = str(e)
+    try:
+        with get_db() as conn:
+            conn.executemany(
+                "INSERT INTO blocks (id, page_id, type, content, properties, sort_order, indent_level) VALUES (?,?,?,?,?,?,?)",
+                [(gen_id(), new_page_id, b['type'], translated.get(b['id'], b['content']), b['properties'],
+                  b['sort_order'], b['indent_level']) for b in chunk]
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Writing translated chunk to {new_page_id} failed: {e}")
+        translated, error = {}, str(e)
+    finally:
+        with _translate_jobs_lock:
+            job = _translate_jobs[job_id]
+            job['done_chunks'] += 1
+            job['translated_blocks'] += len(translated)
+            job['untranslated_blocks'] += len(chunk) - len(translated)
+            if error:
+                job['failed_chunks'] += 1
+                job['error'] = error
+            if job['done_chunks'] == job['chunks']:
+                job['status'] = 'done'
+                job['finished'] = time.time()
+
 @app.route('/api/ai/translate-page', methods=['POST'])
 def translate_page():
-    """Translate entire page to a language and create a new page."""
+    """Translate an entire page into a new page. Returns at once with a job id;
+    blocks appear on the new page as their chunks finish."""
     data = request.get_json(force=True)
     page_id = data.get('page_id', '')
     language = data.get('language', 'English')
@@ -1719,71 +2496,55 @@ def translate_page():
         return jsonify({'error': 'No page_id'}), 400
     
     with get_db() as conn:
-        page = conn.execute("SELECT * FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT * FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return jsonify({'error': 'Page not found'}), 404
         blocks = conn.execute(
             "SELECT * FROM blocks WHERE page_id=? ORDER BY sort_order", (page_id,)
         ).fetchall()
     
-    # Collect all text content
-    content_parts = []
-    for b in blocks:
-        if b['content']:
-            content_parts.append(f"[{b['type']}] {b['content']}")
+    api_config = get_api_config()
+    chunks = translation_chunks(blocks)
+    new_page_id = gen_id()
+    translated_title = f"{page['title']} ({language})"
     
-    try:
-        api_config = get_api_config()
-        prompt = f"""Translate the following content to {language}. 
-Maintain the exact same structure. Each line starts with [type] prefix — keep those prefixes unchanged.
-Return ONLY the translated lines, one per line, with the same [type] prefixes.
-
-{chr(10).join(content_parts)}"""
+    # Blocks without text (dividers, empty lines) need no translation
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO pages (id, title, icon, workspace, sort_order) VALUES (?,?,?,?,0)",
+            (new_page_id, translated_title, page['icon'], page['workspace'] or 'docs')
+        )
+        conn.executemany(
+            "INSERT INTO blocks (id, page_id, type, content, properties, sort_order, indent_level) VALUES (?,?,?,?,?,?,?)",
+            [(gen_id(), new_page_id, b['type'], b['content'], b['properties'], b['sort_order'], b['indent_level'])
+             for b in blocks if not b['content']]
+        )
+        conn.commit()
+    
+    job_id = str(uuid.uuid4())
+    with _translate_jobs_lock:
+        cutoff = time.time() - TRANSLATE_JOB_KEEP
+        for jid in [jid for jid, j in _translate_jobs.items() if j['finished'] and j['finished'] < cutoff]:
+            del _translate_jobs[jid]
+        _translate_jobs[job_id] = {
+            'id': job_id, 'page_id': new_page_id, 'source_page_id': page_id, 'language': language,
+            'status': 'running' if chunks else 'done', 'chunks': len(chunks), 'done_chunks': 0,
+            'failed_chunks': 0, 'translated_blocks': 0, 'untranslated_blocks': 0, 'error': None,
+            'started': time.time(), 'finished': None if chunks else time.time(),
+        }
+    for chunk in chunks:
+        _translate_executor.submit(_run_translate_chunk, job_id, api_config, language, new_page_id, chunk)
+    
+    return jsonify({'page_id': new_page_id, 'title': translated_title, 'job_id': job_id, 'chunks': len(chunks)}), 202
 
-        result = call_claude(api_config, 'You are a translator. Translate precisely, keeping structure markers intact.',
-                           [{"role": "user", "content": prompt}])
-        
-        response_text = ''
-        for block in result.get('content', []):
-            if block.get('type') == 'text':
-                response_text += block['text']
-        
-        # Parse response back to blocks
-        new_page_id = gen_id()
-        translated_title = f"{page['title']} ({language})"
-        
-        with get_db() as conn:
-            conn.execute(
-                "INSERT INTO pages (id, title, icon, workspace, sort_order) VALUES (?,?,?,?,0)",
-                (new_page_id, translated_title, page['icon'], page['workspace'] or 'docs')
-            )
-            
-            translated_lines = response_text.strip().split('\n')
-            original_blocks = list(blocks)
-            
-            for i, ob in enumerate(original_blocks):
-                bid = gen_id()
-                # Try to match translated line
-                content = ob['content']
-                if i < len(translated_lines):
-                    tl = translated_lines[i]
-                    # Strip [type] prefix if present
-                    m = re.match(r'\[(\w+)\]\s*(.*)', tl)
-                    if m:
-                        content = m.group(2)
-                    else:
-                        content = tl
-                
-                conn.execute(
-                    "INSERT INTO blocks (id, page_id, type, content, properties, sort_order, indent_level) VALUES (?,?,?,?,?,?,?)",
-                    (bid, new_page_id, ob['type'], content, ob['properties'], ob['sort_order'], ob['indent_level'])
-                )
-            conn.commit()
-        
-        return jsonify({'page_id': new_page_id, 'title': translated_title})
-    except Exception as e:
-        logger.error(f"AI translate page error: {e}")
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/ai/translate-page/<job_id>', methods=['GET'])
+def translate_page_progress(job_id):
+    """Progress of a page translation job."""
+    with _translate_jobs_lock:
+        job = _translate_jobs.get(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(dict(job, progress=round(job['done_chunks'] / job['chunks'], 3) if job['chunks'] else 1.0))
 
 
 # ── AI Chat Agent ──────────────────────────────────────────────────────────
@@ -1834,6 +2595,7 @@ def get_api_config():
     for prov in config.get('providers', []):
         if prov['id'] == provider_id:
             return {
+                'provider_id': prov['id'],
                 'base_url': prov.get('base_url', ''),
                 'api_key': prov.get('api_key', ''),
                 'model': model_id,
@@ -1843,12 +2605,179 @@ def get_api_config():
     if config.get('providers'):
         prov = config['providers'][0]
         return {
+            'provider_id': prov['id'],
             'base_url': prov.get('base_url', ''),
             'api_key': prov.get('api_key', ''),
             'model': model_id or (prov['models'][0]['id'] if prov.get('models') else ''),
             'api_type': prov.get('api_type', 'openai'),
         }
-    return {'base_url': '', 'api_key': '', 'model': '', 'api_type': 'openai'}
+    return {'provider_id': '', 'base_url': '', 'api_key': '', 'model': '', 'api_type': 'openai'}
+
+# ── LLM HTTP Clients ───────────────────────────────────────────────────────
+# One long-lived httpx.Client per provider in llm_config.json, so every step of a
+# tool loop reuses pooled keep-alive connections instead of a fresh TCP/TLS
+# handshake. Requests that hit 429/5xx or a transport error are retried with
+# jittered exponential backoff (honouring Retry-After).
+
+LLM_POOL_MAX_CONNECTIONS = int(os.environ.get('LLM_POOL_MAX_CONNECTIONS', '10'))
+LLM_POOL_KEEPALIVE = int(os.environ.get('LLM_POOL_KEEPALIVE', '5'))
+LLM_HTTP2 = os.environ.get('LLM_HTTP2', '0') == '1'
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+LLM_RETRY_BASE = float(os.environ.get('LLM_RETRY_BASE', '0.5'))
+LLM_RETRY_MAX = 8.0
+LLM_RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
+
+# A replaced or closed client leaves _llm_clients at once but is only closed when
+# its last in-flight request finishes, so live streams are never cut off.
+_llm_clients = {}          # key -> {'client', 'base_url', 'stats', 'retired'}
+_llm_clients_lock = threading.Lock()
+
+def _new_llm_client():
+    limits = httpx.Limits(max_connections=LLM_POOL_MAX_CONNECTIONS,
+                          max_keepalive_connections=LLM_POOL_KEEPALIVE, keepalive_expiry=60)
+    if LLM_HTTP2:
+        try:
+            return httpx.Client(limits=limits, http2=True)
+        except ImportError:
+            logger.warning("LLM_HTTP2=1 but the h2 package is not installed; using HTTP/1.1")
+    return httpx.Client(limits=limits)
+
+def llm_client_key(provider_id, base_url):
+    """Pool key: the llm_config.json provider id, or the base URL for ad-hoc endpoints."""
+    if not provider_id:
+        provider_id = next((p['id'] for p in _load_llm_config().get('providers', [])
+                            if p.get('base_url', '').rstrip('/') == base_url.rstrip('/')), '')
+    return provider_id or base_url.rstrip('/')
+
+def _retire_llm_entry(entry):
+    """Mark a client dropped from _llm_clients; True if it can be closed now.
+    Callers hold _llm_clients_lock and close the client after releasing it."""
+    entry['retired'] = True
+    return entry['stats']['in_flight'] == 0
+
+def _llm_entry(key, base_url, acquire=False):
+    """The pooled client for `key`, replaced if the provider's base URL changed.
+    With acquire=True the entry's in_flight count is taken under the same lock;
+    pair it with _release_llm_entry()."""
+    base_url = base_url.rstrip('/')
+    stale = None
+    with _llm_clients_lock:
+        entry = _llm_clients.get(key)
+        if entry and entry['base_url'] != base_url:
+            del _llm_clients[key]
+            stale = entry if _retire_llm_entry(entry) else None
+            entry = None
+        if entry is None:
+            entry = _llm_clients[key] = {
+                'client': _new_llm_client(), 'base_url': base_url, 'retired': False,
+                'stats': {'requests': 0, 'retries': 0, 'errors': 0, 'in_flight': 0, 'peak_in_flight': 0,
+                          'prompt_tokens': 0, 'output_tokens': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0},
+            }
+        if acquire:
+            stats = entry['stats']
+            stats['in_flight'] += 1
+            stats['peak_in_flight'] = max(stats['peak_in_flight'], stats['in_flight'])
+    if stale:
+        stale['client'].close()
+    return entry
+
+def _release_llm_entry(entry):
+    """End a request on `entry`; closes the client if it was retired and this was its last."""
+    with _llm_clients_lock:
+        entry['stats']['in_flight'] -= 1
+        close = entry['retired'] and entry['stats']['in_flight'] == 0
+    if close:
+        entry['client'].close()
+
+def close_llm_client(key):
+    """Drop a provider's client; requests still using it finish first."""
+    with _llm_clients_lock:
+        entry = _llm_clients.pop(key, None)
+        close = entry is not None and _retire_llm_entry(entry)
+    if close:
+        entry['client'].close()
+
+def _llm_count(entry, name, delta=1):
+    with _llm_clients_lock:
+        stats = entry['stats']
+        stats[name] += delta
+        stats['peak_in_flight'] = max(stats['peak_in_flight'], stats['in_flight'])
+
+def record_llm_usage(api_config, usage):
+    """Add a response's token usage to its provider's counters. Anthropic reports
+    cache reads/writes apart from input_tokens; OpenAI-compatible APIs include cached
+    tokens in prompt_tokens."""
+    if not usage:
+        return
+    read = usage.get('cache_read_input_tokens') or (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    write = usage.get('cache_creation_input_tokens') or 0
+    prompt = usage['prompt_tokens'] if 'prompt_tokens' in usage else (usage.get('input_tokens') or 0) + read + write
+    key = llm_client_key(api_config.get('provider_id'), api_config.get('base_url', ''))
+    entry = _llm_entry(key, api_config.get('base_url', ''))
+    with _llm_clients_lock:
+        stats = entry['stats']
+        stats['prompt_tokens'] += prompt
+        stats['output_tokens'] += usage.get('output_tokens', usage.get('completion_tokens')) or 0
+        stats['cache_read_tokens'] += read
+        stats['cache_write_tokens'] += write
+
+def _retry_delay(attempt, response=None):
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_RETRY_MAX, LLM_RETRY_BASE * 2 ** attempt))
+
+@contextmanager
+def llm_request(api_config, url, timeout=300, stream=False, **kwargs):
+    """POST to an LLM provider through its pooled client, retrying 429/5xx and
+    connection failures. Yields the response; with stream=True the body is read
+    by the caller, and retries only happen before any of it is consumed."""
+    key = llm_client_key(api_config.get('provider_id'), api_config.get('base_url', ''))
+    entry = _llm_entry(key, api_config.get('base_url', ''), acquire=True)
+    client = entry['client']
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            _llm_count(entry, 'requests')
+            try:
+                response = client.send(client.build_request('POST', url, timeout=timeout, **kwargs), stream=stream)
+            except httpx.TransportError:
+                if attempt == LLM_MAX_RETRIES:
+                    _llm_count(entry, 'errors')
+                    raise
+                _llm_count(entry, 'retries')
+                time.sleep(_retry_delay(attempt))
+                continue
+            if response.status_code in LLM_RETRY_STATUSES and attempt < LLM_MAX_RETRIES:
+                response.close()
+                _llm_count(entry, 'retries')
+                time.sleep(_retry_delay(attempt, response))
+                continue
+            if response.is_error:
+                _llm_count(entry, 'errors')
+            try:
+                yield response
+            finally:
+                response.close()
+            return
+    finally:
+        _release_llm_entry(entry)
+
+def llm_client_stats():
+    """Per-provider request/retry/token counters, prompt cache hit rate and pool utilisation."""
+    with _llm_clients_lock:
+        result = {}
+        for key, entry in _llm_clients.items():
+            pool = getattr(getattr(entry['client'], '_transport', None), '_pool', None)
+            connections = getattr(pool, 'connections', None)
+            result[key] = dict(entry['stats'], max_connections=LLM_POOL_MAX_CONNECTIONS,
+                               open_connections=len(connections) if connections is not None else None,
+                               utilisation=round(entry['stats']['peak_in_flight'] / LLM_POOL_MAX_CONNECTIONS, 3),
+                               cache_hit_rate=round(entry['stats']['cache_read_tokens'] / entry['stats']['prompt_tokens'], 3)
+                               if entry['stats']['prompt_tokens'] else None)
+        return result
 
 # Initialize runtime chat config from saved defaults
 _init_config = _load_llm_config()
@@ -1858,61 +2787,169 @@ CHAT_CONFIG = {
     'thinking': _init_config.get('default_thinking', 'off'),
 }
 
-# Gather all content from the app for RAG context
-def gather_all_content():
-    """Build a comprehensive context string of all app content."""
-    sections = []
+# ── Chat Context Retrieval ─────────────────────────────────────────────────
+# Instead of pasting the whole workspace into the system prompt, each chat message
+# pulls FTS candidates for its words, merges them into one chunk per page or item,
+# ranks chunks by normalised bm25 blended with a local term-vector cosine, and keeps
+# the top-k that fit the token budget.
+
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', '6000'))
+CHAT_CONTEXT_TOP_K = int(os.environ.get('CHAT_CONTEXT_TOP_K', '12'))
+CHAT_CONTEXT_CANDIDATES = int(os.environ.get('CHAT_CONTEXT_CANDIDATES', '60'))
+CHAT_CONTEXT_VECTOR_WEIGHT = float(os.environ.get('CHAT_CONTEXT_VECTOR_WEIGHT', '0.3'))
+CHAT_CHUNK_CHARS = 1200
+CHAT_OUTLINE_PAGES = 50
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for context budgets."""
+    return len(text) // 4 + 1
+
+def _term_vector(text):
+    return Counter(re.findall(r'\w+', text.lower()))
+
+def _cosine(a, b):
+    dot = sum(v * b.get(k, 0) for k, v in a.items())
+    if not dot:
+        return 0.0
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+def _context_chunks(conn, user, query):
+    """FTS candidates for `query` merged into {key: chunk}; each chunk keeps the best
+    bm25 of its hits, normalised per FTS table so 1.0 is that table's top match."""
+    match = notes_tools.fts_query(query, any_word=True)
+    if not match:
+        return {}
+    page_where, page_params = get_accessible_filter(user, 'pages')
+    db_where, db_params = get_accessible_filter(user, 'databases')
+    limit = CHAT_CONTEXT_CANDIDATES
+    block_hits = conn.execute(
+        f"""SELECT b.page_id, b.content, bm25(blocks_fts, 0.0, 1.0) AS rank,
+                   pages.title AS page_title, pages.workspace,
+                   i.id AS item_id, i.title AS item_title, i.database_id, databases.title AS db_title
+            FROM blocks_fts f JOIN blocks b ON b.rowid = f.rowid
+            JOIN pages ON pages.id = b.page_id
+            LEFT JOIN db_items i ON pages.workspace = '_db_item' AND i.page_id = pages.id
+            LEFT JOIN databases ON databases.id = i.database_id
+            WHERE blocks_fts MATCH ? AND pages.deleted_at IS NULL
+              AND ((pages.workspace != '_db_item' AND {page_where})
+                   OR (i.id IS NOT NULL AND {db_where}))
+            ORDER BY rank LIMIT ?""",
+        (f'{{content}} : ({match})', *page_params, *db_params, limit)
+    ).fetchall()
+    page_hits = conn.execute(
+        f"""SELECT pages.id, pages.title, bm25(pages_fts, 0.0, 1.0) AS rank
+            FROM pages_fts f JOIN pages ON pages.rowid = f.rowid
+            WHERE pages_fts MATCH ? AND pages.workspace != '_db_item' AND pages.deleted_at IS NULL
+              AND {page_where}
+            ORDER BY rank LIMIT ?""",
+        (f'{{title}} : ({match})', *page_params, limit)
+    ).fetchall()
+    item_hits = conn.execute(
+        f"""SELECT i.id, i.title, i.properties, i.database_id, databases.title AS db_title,
+                   databases.properties_schema, bm25(db_items_fts, 0.0, 1.0) AS rank
+            FROM db_items_fts f JOIN db_items i ON i.rowid = f.rowid
+            JOIN databases ON databases.id = i.database_id
+            WHERE db_items_fts MATCH ? AND {db_where}
+            ORDER BY rank LIMIT ?""",
+        (f'{{title}} : ({match})', *db_params, limit)
+    ).fetchall()
+
+    # Title-only hits carry the opening blocks of the page as their text
+    openings = {}
+    if page_hits:
+        ids = [r['id'] for r in page_hits]
+        for r in conn.execute(
+            f"""SELECT page_id, content FROM (
+                    SELECT page_id, content, ROW_NUMBER() OVER (PARTITION BY page_id ORDER BY sort_order) AS n
+                    FROM blocks WHERE page_id IN ({','.join('?' * len(ids))}) AND content != '')
+                WHERE n <= 20""", ids
+        ):
+            openings.setdefault(r['page_id'], []).append(r['content'])
+
+    chunks = {}
+    def add(key, heading, text, rank, best):
+        score = rank / best if best else 0.0
+        chunk = chunks.setdefault(key, {'key': key, 'heading': heading, 'parts': [], 'bm25': 0.0})
+        chunk['bm25'] = max(chunk['bm25'], score)
+        if text and text not in chunk['parts'] and sum(map(len, chunk['parts'])) < CHAT_CHUNK_CHARS:
+            chunk['parts'].append(text)
+
+    best = min((r['rank'] for r in block_hits), default=0)
+    for r in block_hits:
+        if r['item_id']:
+            add(f"item:{r['item_id']}", f"{r['db_title']} item: {r['item_title']} (id: {r['item_id']}, database_id: {r['database_id']})",
+                r['content'], r['rank'], best)
+        else:
+            add(f"page:{r['page_id']}", f"Page: {r['page_title']} (id: {r['page_id']})", r['content'], r['rank'], best)
+    best = min((r['rank'] for r in page_hits), default=0)
+    for r in page_hits:
+        add(f"page:{r['id']}", f"Page: {r['title']} (id: {r['id']})",
+            '\n'.join(openings.get(r['id'], [])) or '[Empty page]', r['rank'], best)
+    best = min((r['rank'] for r in item_hits), default=0)
+    for r in item_hits:
+        schema = json.loads(r['properties_schema']) if r['properties_schema'] else []
+        names = {p['id']: p['name'] for p in schema}
+        props = json.loads(r['properties']) if r['properties'] else {}
+        prop_str = ', '.join(f"{names.get(k, k)}: {v}" for k, v in props.items() if v)
+        add(f"item:{r['id']}", f"{r['db_title']} item: {r['title']} (id: {r['id']}, database_id: {r['database_id']})",
+            f"[{prop_str}]" if prop_str else '', r['rank'], best)
+    return chunks
+
+def _context_outline(conn, user):
+    """Titles and ids of the user's databases and most recently edited pages."""
+    page_where, page_params = get_accessible_filter(user, 'pages')
+    db_where, db_params = get_accessible_filter(user, 'databases')
+    dbs = conn.execute(
+        f"SELECT id, title, workspace FROM databases WHERE {db_where} ORDER BY updated_at DESC", db_params
+    ).fetchall()
+    pages = conn.execute(
+        f"""SELECT id, title FROM pages WHERE (workspace='docs' OR workspace IS NULL)
+            AND deleted_at IS NULL AND {page_where} ORDER BY updated_at DESC LIMIT ?""",
+        (*page_params, CHAT_OUTLINE_PAGES)
+    ).fetchall()
+    lines = []
+    if pages:
+        lines.append("Recent pages: " + '; '.join(f"{p['title']} (id: {p['id']})" for p in pages))
+    for db in dbs:
+        label = 'Project' if db['workspace'] == 'projects' else 'Knowledge base'
+        lines.append(f"{label}: {db['title']} (id: {db['id']})")
+    return '\n'.join(lines)
+
+def retrieve_context(user, query, budget=None, top_k=None):
+    """Context for a chat message: a short outline of the workspace plus the top-k
+    chunks most relevant to `query` that fit in `budget` tokens."""
+    budget = CHAT_CONTEXT_TOKENS if budget is None else budget
+    top_k = CHAT_CONTEXT_TOP_K if top_k is None else top_k
     with get_db() as conn:
-        # Docs
-        pages = conn.execute(
-            "SELECT * FROM pages WHERE workspace='docs' OR workspace IS NULL ORDER BY updated_at DESC"
-        ).fetchall()
-        if pages:
-            sections.append("## DOCS (Pages)")
-            for p in pages:
-                blocks = conn.execute(
-                    "SELECT type, content FROM blocks WHERE page_id=? ORDER BY sort_order", (p['id'],)
-                ).fetchall()
-                content = '\n'.join(
-                    b['content'] for b in blocks if b['content'] and b['type'] not in ('divider',)
-                )
-                if content.strip():
-                    sections.append(f"\n### Page: {p['title']} (id: {p['id']})\n{content}")
-                else:
-                    sections.append(f"\n### Page: {p['title']} (id: {p['id']})\n[Empty page]")
-        
-        # Databases (Projects + Wiki)
-        dbs = conn.execute("SELECT * FROM databases ORDER BY updated_at DESC").fetchall()
-        for db in dbs:
-            db_dict = dict_row(db)
-            schema = json.loads(db_dict['properties_schema']) if db_dict['properties_schema'] else []
-            items = conn.execute(
-                "SELECT * FROM db_items WHERE database_id=? ORDER BY sort_order", (db_dict['id'],)
-            ).fetchall()
-            
-            ws_label = 'PROJECT' if db_dict['workspace'] == 'projects' else 'KNOWLEDGE BASE'
-            sections.append(f"\n## {ws_label}: {db_dict['title']} (id: {db_dict['id']})")
-            if db_dict.get('description'):
-                sections.append(f"Description: {db_dict['description']}")
-            sections.append(f"Properties: {', '.join(p['name']+' ('+p['type']+')' for p in schema)}")
-            
-            for item in items:
-                item_dict = dict_row(item)
-                props = json.loads(item_dict['properties']) if item_dict['properties'] else {}
-                prop_str = ', '.join(f"{next((s['name'] for s in schema if s['id']==k), k)}: {v}" 
-                                    for k, v in props.items() if v)
-                sections.append(f"  - {item_dict['title']} (id: {item_dict['id']}) [{prop_str}]")
-                # Get item page content if exists
-                if item_dict.get('page_id'):
-                    blocks = conn.execute(
-                        "SELECT type, content FROM blocks WHERE page_id=? ORDER BY sort_order",
-                        (item_dict['page_id'],)
-                    ).fetchall()
-                    content = '\n    '.join(b['content'] for b in blocks if b['content'])
-                    if content.strip():
-                        sections.append(f"    Content: {content}")
-    
-    return '\n'.join(sections) if sections else "[No content in the app yet]"
+        outline = _context_outline(conn, user)
+        chunks = list(_context_chunks(conn, user, query).values())
+    qvec = _term_vector(query)
+    weight = CHAT_CONTEXT_VECTOR_WEIGHT
+    for chunk in chunks:
+        chunk['text'] = '\n'.join(chunk['parts'])[:CHAT_CHUNK_CHARS]
+        chunk['vector'] = _cosine(qvec, _term_vector(chunk['heading'] + '\n' + chunk['text'])) if weight else 0.0
+        chunk['score'] = (1 - weight) * chunk['bm25'] + weight * chunk['vector']
+    chunks.sort(key=lambda c: c['score'], reverse=True)
+
+    sections = [f"## Workspace Outline\n{outline}"] if outline else []
+    used = sum(map(estimate_tokens, sections))
+    picked = []
+    for chunk in chunks:
+        if len(picked) >= top_k:
+            break
+        block = f"### {chunk['heading']}\n{chunk['text']}"
+        cost = estimate_tokens(block)
+        if used + cost > budget:
+            continue
+        picked.append(chunk)
+        sections.append(block)
+        used += cost
+    logger.info("Chat context: %d/%d chunks, ~%d tokens; %s", len(picked), len(chunks), used,
+                ', '.join(f"{c['key']}={c['score']:.3f} (bm25 {c['bm25']:.3f}, vec {c['vector']:.3f})"
+                          for c in picked))
+    if not picked:
+        sections.append("[No content matched this message — use search_content or get_page_content to look further]")
+    return '\n\n'.join(sections)
 
 # Tool definitions for the agent
 TOOLS = [
@@ -2043,41 +3080,207 @@ TOOLS = [
 ]
 
 def execute_tool(name, input_data):
-    """Execute a tool call via the MCP server (stdio protocol).
-    All tool logic lives in mcp_server.py → notes_tools.py."""
+    """Execute a tool call through mcp_client: in-process on notes_tools.py by
+    default, or over persistent MCP stdio sessions when MCP_TOOL_MODE=subprocess."""
     from mcp_client import call_tool
     return call_tool(name, input_data)
 
+# ── Tool Scheduling ────────────────────────────────────────────────────────
+# When one model turn asks for several tools, consecutive read-only calls run
+# together on a small thread pool. Any other tool is treated as a write and runs
+# alone, in order, so reads never overtake an earlier write (or vice versa).
+# Results always come back in the order the calls were made.
+
+READ_ONLY_TOOLS = {
+    'search_content', 'search_notes', 'list_pages', 'get_page_content', 'get_page',
+    'list_databases', 'get_database_items', 'list_resources', 'search_resources', 'get_all_content',
+}
+TOOL_WORKERS = int(os.environ.get('TOOL_WORKERS', '4'))
+
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='tool')
 
-# Chat history stored in memory (per-session, resets on restart)
-chat_histories = {}
+def _execute_logged(name, input_data):
+    logger.info(f"Tool call: {name}({json.dumps(input_data)[:200]})")
+    return execute_tool(name, input_data)
+
+def tool_batches(calls):
+    """Split [(name, input), ...] into runs of consecutive reads and single writes."""
+    batch = []
+    for call in calls:
+        if call[0] in READ_ONLY_TOOLS:
+            batch.append(call)
+            continue
+        if batch:
+            yield batch
+            batch = []
+        yield [call]
+    if batch:
+        yield batch
+
+def execute_tool_batch(batch):
+    """Results for one batch from tool_batches(), in call order."""
+    if len(batch) == 1:
+        return [_execute_logged(*batch[0])]
+    return list(_tool_executor.map(lambda call: _execute_logged(*call), batch))
+
+def execute_tool_calls(calls):
+    """Execute one turn's tool calls with concurrent reads; results in call order."""
+    results = []
+    for batch in tool_batches(calls):
+        results.extend(execute_tool_batch(batch))
+    return results
+
+
+# ── Chat History ───────────────────────────────────────────────────────────
+# Per-session histories are cached in an LRU of CHAT_HISTORY_CACHE_MAX sessions.
+# A turn sends the newest messages that fit CHAT_HISTORY_TOKENS, plus the session's
+# rolling summary. Once the stored messages exceed that budget, a background step
+# folds the oldest ones into the summary (chat_summaries) until half the budget
+# remains, and range-deletes them from chat_messages. If summarizing fails, messages
+# beyond CHAT_HISTORY_MAX_MESSAGES are dropped anyway so a session stays bounded.
+CHAT_HISTORY_CACHE_MAX = int(os.environ.get('CHAT_HISTORY_CACHE_MAX', '200'))
+CHAT_HISTORY_TOKENS = int(os.environ.get('CHAT_HISTORY_TOKENS', '8000'))
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get('CHAT_HISTORY_MAX_MESSAGES', '200'))
+CHAT_SUMMARY_TOKENS = 1024
+
+_chat_histories = OrderedDict()   # session_id -> {'ids', 'messages', 'summary', 'compacting'}
+_chat_histories_lock = threading.Lock()
+_chat_history_stats = {'loads': 0, 'evictions': 0, 'compactions': 0, 'compaction_failures': 0,
+                       'folded_messages': 0, 'dropped_messages': 0}
+_history_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-history')
+
+def _message_tokens(msg):
+    content = msg['content']
+    return estimate_tokens(content if isinstance(content, str) else json.dumps(content))
 
 def _load_chat_history(session_id):
-    """Load chat history from DB into memory cache."""
-    if session_id not in chat_histories:
-        with get_db() as conn:
-            rows = conn.execute(
-                "SELECT role, content FROM chat_messages WHERE session_id=? ORDER BY id",
-                (session_id,)
-            ).fetchall()
-            chat_histories[session_id] = [{"role": r['role'], "content": r['content']} for r in rows]
-    return chat_histories[session_id]
+    """The cached history entry for a session, loading it from the DB on a miss.
+    Callers hold _chat_histories_lock."""
+    entry = _chat_histories.get(session_id)
+    if entry is not None:
+        _chat_histories.move_to_end(session_id)
+        return entry
+    with get_db() as conn:
+        summary = conn.execute(
+            "SELECT summary FROM chat_summaries WHERE session_id=?", (session_id,)
+        ).fetchone()
+        rows = conn.execute(
+            "SELECT id, role, content FROM chat_messages WHERE session_id=? ORDER BY id",
+            (session_id,)
+        ).fetchall()
+    entry = _chat_histories[session_id] = {
+        'ids': [r['id'] for r in rows],
+        'messages': [{"role": r['role'], "content": r['content']} for r in rows],
+        'summary': summary['summary'] if summary else '',
+        'compacting': False,
+    }
+    _chat_history_stats['loads'] += 1
+    while len(_chat_histories) > CHAT_HISTORY_CACHE_MAX:
+        _chat_histories.popitem(last=False)
+        _chat_history_stats['evictions'] += 1
+    return entry
+
+def _history_window(entry):
+    """The newest messages that fit CHAT_HISTORY_TOKENS, starting with a user turn."""
+    used, start = 0, len(entry['messages'])
+    for i in range(len(entry['messages']) - 1, -1, -1):
+        used += _message_tokens(entry['messages'][i])
+        if used > CHAT_HISTORY_TOKENS and start < len(entry['messages']):
+            break
+        start = i
+    while start < len(entry['messages']) - 1 and entry['messages'][start]['role'] != 'user':
+        start += 1
+    return list(entry['messages'][start:])
 
 def _save_chat_message(session_id, role, content):
-    """Persist a single chat message to DB."""
-    with get_db() as conn:
-        conn.execute(
-            "INSERT INTO chat_messages (session_id, role, content) VALUES (?,?,?)",
-            (session_id, role, content)
-        )
-        conn.commit()
+    """Persist a chat message and append it to the session's cached history."""
+    with _chat_histories_lock:
+        entry = _load_chat_history(session_id)
+        with get_db() as conn:
+            message_id = conn.execute(
+                "INSERT INTO chat_messages (session_id, role, content) VALUES (?,?,?)",
+                (session_id, role, content)
+            ).lastrowid
+            conn.commit()
+        entry['ids'].append(message_id)
+        entry['messages'].append({"role": role, "content": content})
+        total = sum(map(_message_tokens, entry['messages']))
+        if (total > CHAT_HISTORY_TOKENS or len(entry['messages']) > CHAT_HISTORY_MAX_MESSAGES) \
+                and not entry['compacting']:
+            entry['compacting'] = True
+            _history_executor.submit(_compact_chat_history, session_id, entry)
+
+def _compact_chat_history(session_id, entry):
+    """Fold a session's oldest messages into its rolling summary, then delete them."""
+    try:
+        with _chat_histories_lock:
+            keep, used = len(entry['messages']), 0
+            while keep > 0 and used + _message_tokens(entry['messages'][keep - 1]) <= CHAT_HISTORY_TOKENS // 2:
+                keep -= 1
+                used += _message_tokens(entry['messages'][keep])
+            fold = max(len(entry['messages']) - keep, 1)
+            folded = list(entry['messages'][:fold])
+            upto_id = entry['ids'][fold - 1]
+            summary = entry['summary']
+        transcript = '\n\n'.join(f"{m['role']}: {m['content'] if isinstance(m['content'], str) else json.dumps(m['content'])}"
+                                 for m in folded)
+        try:
+            result = call_claude(
+                get_api_config(),
+                'You maintain a running summary of a conversation between a user and the Brain Notes AI. '
+                'Keep facts, decisions, open tasks and the ids of pages or items that were created or edited. '
+                'Return ONLY the updated summary.',
+                [{"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\n"
+                                             f"Messages to fold in:\n{transcript}"}],
+                max_tokens=CHAT_SUMMARY_TOKENS,
+            )
+            summary = ''.join(b.get('text', '') for b in result.get('content', []) if b.get('type') == 'text').strip()
+            stat = 'folded_messages'
+        except Exception as e:
+            logger.warning(f"Chat history summary for {session_id} failed: {e}")
+            with _chat_histories_lock:
+                _chat_history_stats['compaction_failures'] += 1
+                overflow = len(entry['messages']) - CHAT_HISTORY_MAX_MESSAGES
+            if overflow <= 0:
+                return
+            # Keep the old summary; drop only the messages over the hard cap
+            fold = min(fold, overflow)
+            upto_id = entry['ids'][fold - 1]
+            stat = 'dropped_messages'
+        with _chat_histories_lock:
+            if _chat_histories.get(session_id) is not entry:
+                return      # cleared or evicted meanwhile; it reloads from the DB
+            with get_db() as conn:
+                conn.execute(
+                    "INSERT INTO chat_summaries (session_id, summary, upto_id) VALUES (?,?,?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET summary=excluded.summary, "
+                    "upto_id=excluded.upto_id, updated_at=CURRENT_TIMESTAMP",
+                    (session_id, summary, upto_id)
+                )
+                conn.execute("DELETE FROM chat_messages WHERE session_id=? AND id<=?", (session_id, upto_id))
+                conn.commit()
+            del entry['ids'][:fold], entry['messages'][:fold]
+            entry['summary'] = summary
+            _chat_history_stats['compactions'] += 1
+            _chat_history_stats[stat] += fold
+    finally:
+        with _chat_histories_lock:
+            entry['compacting'] = False
 
 def _clear_chat_history(session_id):
-    """Clear chat history from DB and memory."""
-    with get_db() as conn:
-        conn.execute("DELETE FROM chat_messages WHERE session_id=?", (session_id,))
-        conn.commit()
-    chat_histories.pop(session_id, None)
+    """Clear chat history and its summary from DB and memory."""
+    with _chat_histories_lock:
+        with get_db() as conn:
+            conn.execute("DELETE FROM chat_messages WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM chat_summaries WHERE session_id=?", (session_id,))
+            conn.commit()
+        _chat_histories.pop(session_id, None)
+
+def chat_history_stats():
+    with _chat_histories_lock:
+        return dict(_chat_history_stats, sessions=len(_chat_histories),
+                    messages=sum(len(e['messages']) for e in _chat_histories.values()),
+                    compacting=sum(e['compacting'] for e in _chat_histories.values()))
 
 @app.route('/api/chat/config', methods=['GET'])
 def get_chat_config():
@@ -2165,6 +3368,7 @@ def update_provider(provider_id):
             if 'api_type' in data: prov['api_type'] = data['api_type']
             if 'models' in data: prov['models'] = data['models']
             _save_llm_config(config)
+            close_llm_client(provider_id)
             return jsonify(prov)
     return jsonify({'error': 'Provider not found'}), 404
 
@@ -2173,6 +3377,7 @@ def delete_provider(provider_id):
     config = _load_llm_config()
     config['providers'] = [p for p in config.get('providers', []) if p['id'] != provider_id]
     _save_llm_config(config)
+    close_llm_client(provider_id)
     return jsonify({'ok': True})
 
 @app.route('/api/llm/test', methods=['POST'])
@@ -2188,8 +3393,7 @@ def test_provider():
             url = f"{base_url}/v1/messages"
             headers = {'x-api-key': api_key, 'content-type': 'application/json', 'anthropic-version': '2023-06-01'}
             body = {'model': model, 'max_tokens': 20, 'messages': [{'role': 'user', 'content': 'Say "ok"'}]}
-            with httpx.Client(timeout=15) as client:
-                r = client.post(url, headers=headers, json=body)
+            with llm_request({'base_url': base_url}, url, timeout=15, headers=headers, json=body) as r:
                 r.raise_for_status()
                 resp = r.json()
             text = ' '.join(b.get('text', '') for b in resp.get('content', []) if b.get('type') == 'text')
@@ -2197,8 +3401,7 @@ def test_provider():
             url = f"{base_url}/chat/completions"
             headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
             body = {'model': model, 'max_tokens': 20, 'messages': [{'role': 'user', 'content': 'Say "ok"'}]}
-            with httpx.Client(timeout=15) as client:
-                r = client.post(url, headers=headers, json=body)
+            with llm_request({'base_url': base_url}, url, timeout=15, headers=headers, json=body) as r:
                 r.raise_for_status()
                 resp = r.json()
             text = resp.get('choices', [{}])[0].get('message', {}).get('content', '')
@@ -2206,31 +3409,9 @@ def test_provider():
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)}), 400
 
-@app.route('/api/chat', methods=['POST'])
-@login_required
-def chat():
-    data = request.get_json(force=True)
-    message = data.get('message', '').strip()
-    session_id = data.get('session_id', 'default')
-    
-    if not message:
-        return jsonify({'error': 'Empty message'}), 400
-    
-    api_config = get_api_config()
-    if not api_config['api_key']:
-        return jsonify({'error': 'No API key configured'}), 500
-    
-    # Get or create chat history (loads from DB if not cached)
-    history = _load_chat_history(session_id)
-    
-    # Build context
-    all_content = gather_all_content()
-    
-    system_prompt = f"""You are Brain Notes AI — an intelligent assistant embedded in a note-taking application.
+CHAT_SYSTEM_PROMPT = """You are Brain Notes AI — an intelligent assistant embedded in a note-taking application.
 You have full access to all content in the app and can create, edit, search, and manage pages, projects, and knowledge base items.
-
-## Current App Content
-{all_content}
+The part of the app most relevant to the user's message is given after these instructions; search for anything else you need.
 
 ## How Actions Work (IMPORTANT!)
 You DO have the ability to perform actions. Actions are NOT separate tools or function calls.
@@ -2242,34 +3423,34 @@ You can include multiple action blocks. Always include a human-readable explanat
 
 ### create_page — Create a new page
 ```action
-{{"action":"create_page","title":"Page Title","icon":"lucide-icon-name","blocks":[{{"type":"h1","content":"Heading"}},{{"type":"bullet","content":"Item 1"}},{{"type":"todo","content":"Task 1"}}]}}
+{"action":"create_page","title":"Page Title","icon":"lucide-icon-name","blocks":[{"type":"h1","content":"Heading"},{"type":"bullet","content":"Item 1"},{"type":"todo","content":"Task 1"}]}
 ```
 Block types: text, h1, h2, h3, bullet, numbered, todo, quote, callout, code, divider
 
 ### edit_page — Edit an existing page (change title, icon, replace or append blocks)
 To REPLACE all content on a page (rewrite it):
 ```action
-{{"action":"edit_page","page_id":"THE_PAGE_ID","title":"New Title","replace_blocks":[{{"type":"h1","content":"New Heading"}},{{"type":"text","content":"New content"}}]}}
+{"action":"edit_page","page_id":"THE_PAGE_ID","title":"New Title","replace_blocks":[{"type":"h1","content":"New Heading"},{"type":"text","content":"New content"}]}
 ```
 To APPEND content at the end of a page:
 ```action
-{{"action":"edit_page","page_id":"THE_PAGE_ID","append_blocks":[{{"type":"text","content":"Added text"}}]}}
+{"action":"edit_page","page_id":"THE_PAGE_ID","append_blocks":[{"type":"text","content":"Added text"}]}
 ```
-You can set title, icon, replace_blocks, and/or append_blocks. Use the page_id from the content listing above.
+You can set title, icon, replace_blocks, and/or append_blocks. Use the page_id from the app content below.
 
 ### create_project_item — Add an item to a database/project
 ```action
-{{"action":"create_project_item","database_id":"id","title":"Item Title","properties":{{"prop_id":"value"}}}}
+{"action":"create_project_item","database_id":"id","title":"Item Title","properties":{"prop_id":"value"}}
 ```
 
 ### create_database — Create a new database
 ```action
-{{"action":"create_database","title":"DB Title","workspace":"projects|wiki","description":"..."}}
+{"action":"create_database","title":"DB Title","workspace":"projects|wiki","description":"..."}
 ```
 
 ### delete_page — Delete a page
 ```action
-{{"action":"delete_page","page_id":"id"}}
+{"action":"delete_page","page_id":"id"}
 ```
 
 ## Guidelines
@@ -2281,31 +3462,38 @@ You can set title, icon, replace_blocks, and/or append_blocks. Use the page_id f
 - For analysis tasks, create a well-structured page with the results
 - NEVER say "I don't have that tool" — all actions listed above work by including the JSON block in your response
 """
+
+def _start_chat_turn(data, user):
+    """Validate a chat request and record the user message. Returns
+    (api_config, session_id, history, system_prompt) or an error response tuple."""
+    message = data.get('message', '').strip()
+    session_id = data.get('session_id', 'default')
     
-    # Add user message to history (memory + DB)
-    history.append({"role": "user", "content": message})
-    _save_chat_message(session_id, "user", message)
+    if not message:
+        return jsonify({'error': 'Empty message'}), 400
     
-    # Keep history manageable (last 20 messages)
-    if len(history) > 20:
-        history = history[-20:]
-        chat_histories[session_id] = history
-        # Trim DB too — keep only the last 20
-        with get_db() as conn:
-            conn.execute(
-                "DELETE FROM chat_messages WHERE session_id=? AND id NOT IN "
-                "(SELECT id FROM chat_messages WHERE session_id=? ORDER BY id DESC LIMIT 20)",
-                (session_id, session_id)
-            )
-            conn.commit()
+    api_config = get_api_config()
+    if not api_config['api_key']:
+        return jsonify({'error': 'No API key configured'}), 500
     
-    # Call LLM — use native tool_use for Anthropic/MiniMax, fallback to gateway for others
-    try:
-        response = call_llm_with_tools(api_config, system_prompt, history)
-    except Exception as e:
-        logger.error(f"LLM API error: {e}")
-        return jsonify({'error': str(e)}), 500
+    # Build context from the parts of the workspace relevant to this message
+    all_content = retrieve_context(user, message)
     
+    # Stable instructions first, per-turn context last, so providers can cache the prefix
+    system_prompt = [CHAT_SYSTEM_PROMPT, f"## Relevant App Content\n{all_content}\n"]
+    
+    # Add user message to history (memory + DB), then send the window that fits the budget
+    _save_chat_message(session_id, "user", message)
+    with _chat_histories_lock:
+        entry = _load_chat_history(session_id)
+        history = _history_window(entry)
+        summary = entry['summary']
+    if summary:
+        system_prompt[-1] += f"\n## Earlier in This Conversation (summary)\n{summary}\n"
+    return api_config, session_id, history, system_prompt
+
+def _finish_chat_turn(session_id, response):
+    """Run text-based action blocks, store the assistant reply and build the chat payload."""
     # Extract text
     text_parts = []
     for block in response.get('content', []):
@@ -2334,22 +3522,245 @@ You can set title, icon, replace_blocks, and/or append_blocks. Use the page_id f
     # Clean action blocks from the displayed message
     assistant_message = action_pattern.sub('', full_response).strip()
     
-    history.append({"role": "assistant", "content": full_response})
-    chat_histories[session_id] = history
     _save_chat_message(session_id, "assistant", full_response)
     
-    return jsonify({
+    return {
         'response': assistant_message,
         'tool_results': tool_results,
         'model': CHAT_CONFIG['model'],
-    })
+    }
+
+@app.route('/api/chat', methods=['POST'])
+@login_required
+def chat():
+    turn = _start_chat_turn(request.get_json(force=True), g.user)
+    if not isinstance(turn[0], dict):
+        return turn
+    api_config, session_id, history, system_prompt = turn
+    
+    # Call LLM — use native tool_use for Anthropic/MiniMax, fallback to gateway for others
+    try:
+        response = call_llm_with_tools(api_config, system_prompt, history)
+    except Exception as e:
+        logger.error(f"LLM API error: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify(_finish_chat_turn(session_id, response))
+
+# ── Chat Runs ──────────────────────────────────────────────────────────────
+# A chat turn submitted as a run goes to a bounded thread pool (CHAT_RUN_WORKERS
+# is the global concurrency limit), so the request that starts it returns at once.
+# Live events are kept in memory for polling/streaming; status and the final
+# payload are written to chat_runs, so a finished run outlives a restart.
+
+CHAT_RUN_WORKERS = int(os.environ.get('CHAT_RUN_WORKERS', '4'))
+CHAT_RUN_KEEP = 600        # seconds a finished run's live events stay in memory
+CHAT_RUN_FINAL = ('done', 'error', 'cancelled')
+
+_run_executor = ThreadPoolExecutor(max_workers=CHAT_RUN_WORKERS, thread_name_prefix='chat-run')
+_runs = {}                 # run_id -> {'events', 'status', 'cancel', 'user_id', 'finished'}
+_runs_cond = threading.Condition()
+
+def _recover_chat_runs():
+    """Runs cut off by a restart can't resume their upstream call; mark them failed."""
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE chat_runs SET status='error', error='Interrupted by a server restart', "
+            "updated_at=CURRENT_TIMESTAMP WHERE status IN ('queued', 'running')"
+        )
+
+_recover_chat_runs()
+
+def _run_status(run_id, status, result=None, error=None):
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE chat_runs SET status=?, result=COALESCE(?, result), error=COALESCE(?, error), "
+            "updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (status, json.dumps(result) if result is not None else None, error, run_id)
+        )
+    with _runs_cond:
+        live = _runs.get(run_id)
+        if live:
+            live['status'] = status
+            if status in CHAT_RUN_FINAL:
+                event = {'type': status}
+                if result is not None:
+                    event.update(result)
+                if error:
+                    event['error'] = error
+                live['events'].append(event)
+                live['finished'] = time.time()
+        _runs_cond.notify_all()
+
+def _push_run_event(run_id, event):
+    with _runs_cond:
+        _runs[run_id]['events'].append(event)
+        _runs_cond.notify_all()
+
+def _execute_run(run_id, api_config, session_id, history, system_prompt):
+    live = _runs[run_id]
+    if live['cancel'].is_set():
+        return _run_status(run_id, 'cancelled')
+    _run_status(run_id, 'running')
+    stream = stream_llm_with_tools(api_config, system_prompt, history)
+    try:
+        for event in stream:
+            if live['cancel'].is_set():
+                stream.close()
+                return _run_status(run_id, 'cancelled')
+            if event['type'] == 'done':
+                return _run_status(run_id, 'done', result=_finish_chat_turn(session_id, event['response']))
+            _push_run_event(run_id, event)
+    except Exception as e:
+        logger.error(f"Chat run {run_id} failed: {e}")
+        _run_status(run_id, 'error', error=str(e))
+
+def submit_chat_run(data, user):
+    """Start a chat turn in the background. Returns the run row or an error response tuple."""
+    turn = _start_chat_turn(data, user)
+    if not isinstance(turn[0], dict):
+        return turn
+    api_config, session_id, history, system_prompt = turn
+    run_id = str(uuid.uuid4())
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO chat_runs (id, session_id, user_id, message) VALUES (?, ?, ?, ?)",
+            (run_id, session_id, user['id'], data.get('message', '').strip())
+        )
+    with _runs_cond:
+        cutoff = time.time() - CHAT_RUN_KEEP
+        for rid in [rid for rid, r in _runs.items() if r['finished'] and r['finished'] < cutoff]:
+            del _runs[rid]
+        _runs[run_id] = {'events': [], 'status': 'queued', 'cancel': threading.Event(),
+                         'user_id': user['id'], 'finished': None}
+    _run_executor.submit(_execute_run, run_id, api_config, session_id, history, system_prompt)
+    return {'id': run_id, 'session_id': session_id, 'status': 'queued'}
+
+def chat_run_stats():
+    with _runs_cond:
+        statuses = Counter(r['status'] for r in _runs.values())
+    return {'workers': CHAT_RUN_WORKERS, 'queued': statuses['queued'], 'running': statuses['running'],
+            'in_memory': sum(statuses.values())}
+
+def _get_run(run_id):
+    """The chat_runs row for run_id if the current user may see it, else None."""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM chat_runs WHERE id=?", (run_id,)).fetchone()
+    if not row or (row['user_id'] != g.user['id'] and g.user['role'] != 'admin'):
+        return None
+    return row
+
+def _run_events(run_id, row, after):
+    """Events after index `after`: live ones from memory, or the final event from
+    the stored row once the run has left memory (e.g. after a restart)."""
+    with _runs_cond:
+        live = _runs.get(run_id)
+        if live:
+            return live['events'][after:], live['status']
+    if row['status'] not in CHAT_RUN_FINAL:
+        return [], row['status']
+    event = {'type': row['status']}
+    if row['result']:
+        event.update(json.loads(row['result']))
+    if row['error']:
+        event['error'] = row['error']
+    return ([event] if after == 0 else []), row['status']
+
+@app.route('/api/chat/runs', methods=['POST'])
+@login_required
+def create_chat_run():
+    run = submit_chat_run(request.get_json(force=True), g.user)
+    if not isinstance(run, dict):
+        return run
+    return jsonify(run), 202
+
+@app.route('/api/chat/runs/<run_id>', methods=['GET'])
+@login_required
+def get_chat_run(run_id):
+    """Run status plus the events after ?after=N (0-based index into the event list)."""
+    row = _get_run(run_id)
+    if not row:
+        return jsonify({'error': 'Not found'}), 404
+    after = max(request.args.get('after', 0, type=int), 0)
+    events, status = _run_events(run_id, row, after)
+    return jsonify({'id': run_id, 'session_id': row['session_id'], 'status': status,
+                    'events': events, 'next': after + len(events),
+                    'result': json.loads(row['result']) if row['result'] else None, 'error': row['error']})
+
+@app.route('/api/chat/runs/<run_id>/cancel', methods=['POST'])
+@login_required
+def cancel_chat_run(run_id):
+    row = _get_run(run_id)
+    if not row:
+        return jsonify({'error': 'Not found'}), 404
+    with _runs_cond:
+        live = _runs.get(run_id)
+    if not live or live['status'] in CHAT_RUN_FINAL:
+        return jsonify({'id': run_id, 'status': row['status']})
+    live['cancel'].set()
+    return jsonify({'id': run_id, 'status': 'cancelling'})
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _stream_run(run_id, row, after=0):
+    """SSE of a run's events from index `after` until it finishes. Disconnecting
+    only stops the stream; the run keeps going."""
+    def generate():
+        index, current = after, row
+        while True:
+            with _runs_cond:
+                live = _runs.get(run_id)
+                if live and len(live['events']) <= index and live['status'] not in CHAT_RUN_FINAL:
+                    _runs_cond.wait(15)
+                elif not live and current['status'] not in CHAT_RUN_FINAL:
+                    _runs_cond.wait(1)
+            if not live:
+                # Not in this process's memory: follow the stored row instead
+                with get_db() as conn:
+                    current = conn.execute("SELECT * FROM chat_runs WHERE id=?", (run_id,)).fetchone()
+            events, status = _run_events(run_id, current, index)
+            for event in events:
+                event = dict(event)
+                yield _sse(event.pop('type'), event)
+            index += len(events)
+            if status in CHAT_RUN_FINAL and not events:
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/chat/runs/<run_id>/events', methods=['GET'])
+@login_required
+def chat_run_events(run_id):
+    row = _get_run(run_id)
+    if not row:
+        return jsonify({'error': 'Not found'}), 404
+    return _stream_run(run_id, row, max(request.args.get('after', 0, type=int), 0))
+
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """Same turn as /api/chat, submitted as a run and streamed as Server-Sent Events:
+    `text` deltas, `tool_start`/`tool_result` around each tool call, then `done`
+    with the /api/chat payload (or `error`/`cancelled`)."""
+    run = submit_chat_run(request.get_json(force=True), g.user)
+    if not isinstance(run, dict):
+        return run
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM chat_runs WHERE id=?", (run['id'],)).fetchone()
+    response = _stream_run(run['id'], row)
+    response.headers['X-Chat-Run-Id'] = run['id']
+    return response
 
 
 @app.route('/api/chat/history', methods=['GET'])
 @login_required
 def get_chat_history():
     session_id = request.args.get('session_id', 'default')
-    history = _load_chat_history(session_id)
+    with _chat_histories_lock:
+        history = list(_load_chat_history(session_id)['messages'])
     # Flatten to simple messages
     messages = []
     for msg in history:
@@ -2500,6 +3911,101 @@ NATIVE_TOOLS = [
 ]
 
 
+# ── Prompt Caching ─────────────────────────────────────────────────────────
+# `system` may be a string or a list of parts ordered stable → volatile (the chat
+# passes [CHAT_SYSTEM_PROMPT, per-turn context]). Anthropic requests get
+# cache_control breakpoints on the tool schemas, the last stable system part and
+# the conversation tail, so each tool-loop step re-reads the previous prefix.
+# OpenAI-compatible requests send the same parts in the same order, which keeps
+# the prefix byte-identical for automatic prefix caching.
+LLM_PROMPT_CACHE = os.environ.get('LLM_PROMPT_CACHE', '1') != '0'
+CACHE_BREAKPOINT = {'type': 'ephemeral'}
+
+def _system_parts(system):
+    return [system] if isinstance(system, str) else [part for part in system if part]
+
+def _anthropic_tools(tools):
+    result = [{
+        "name": t['name'],
+        "description": t.get('description', ''),
+        "input_schema": t.get('input_schema', {"type": "object", "properties": {}}),
+    } for t in (tools or NATIVE_TOOLS)]
+    if LLM_PROMPT_CACHE and result:
+        result[-1]['cache_control'] = CACHE_BREAKPOINT
+    return result
+
+def _anthropic_system(system):
+    """System text blocks; the last stable part carries a cache breakpoint."""
+    parts = _system_parts(system)
+    blocks = [{"type": "text", "text": part} for part in parts]
+    if LLM_PROMPT_CACHE and blocks:
+        blocks[max(len(blocks) - 2, 0)]['cache_control'] = CACHE_BREAKPOINT
+    return blocks
+
+def _anthropic_cached_messages(messages):
+    """Copy of `messages` whose last content block carries a cache breakpoint."""
+    if not LLM_PROMPT_CACHE or not messages:
+        return messages
+    last = messages[-1]
+    content = last['content']
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    if not content:
+        return messages
+    content = [*content[:-1], {**content[-1], 'cache_control': CACHE_BREAKPOINT}]
+    return [*messages[:-1], {**last, 'content': content}]
+
+def _openai_tools(tools):
+    return [{
+        "type": "function",
+        "function": {
+            "name": t['name'],
+            "description": t.get('description', ''),
+            "parameters": t.get('input_schema', {"type": "object", "properties": {}}),
+        }
+    } for t in (tools or NATIVE_TOOLS)]
+
+def _openai_messages(system, messages):
+    """One system message (stable parts first), then the string-content history."""
+    oai_messages = [{"role": "system", "content": '\n'.join(_system_parts(system))}]
+    for msg in messages:
+        if isinstance(msg.get('content'), str):
+            oai_messages.append({"role": msg['role'], "content": msg['content']})
+    return oai_messages
+
+
+def call_claude(api_config, system, messages, max_tokens=None):
+    """Plain completion without tools for the AI text actions. Returns the same
+    {'content': [{'type': 'text', 'text'}], 'stop_reason'} shape as call_llm_with_tools()."""
+    base_url = api_config['base_url'].rstrip('/')
+    model = api_config.get('model', CHAT_CONFIG['model'])
+    max_tokens = max_tokens or CHAT_CONFIG.get('max_tokens', 4096)
+    if api_config.get('api_type', 'openai') == 'anthropic':
+        url = f"{base_url}/v1/messages"
+        headers = {'x-api-key': api_config['api_key'], 'content-type': 'application/json',
+                   'anthropic-version': '2023-06-01'}
+        body = {'model': model, 'max_tokens': max_tokens, 'system': '\n'.join(_system_parts(system)),
+                'messages': messages}
+        with llm_request(api_config, url, headers=headers, json=body) as r:
+            r.raise_for_status()
+            resp = r.json()
+        record_llm_usage(api_config, resp.get('usage'))
+        text = '\n'.join(b['text'] for b in resp.get('content', []) if b.get('type') == 'text')
+        return {'content': [{"type": "text", "text": text}], 'stop_reason': resp.get('stop_reason', 'end_turn')}
+
+    url = f"{base_url}/chat/completions"
+    headers = {'Authorization': f"Bearer {api_config['api_key']}", 'Content-Type': 'application/json'}
+    body = {'model': model, 'max_tokens': max_tokens,
+            'messages': [{"role": "system", "content": '\n'.join(_system_parts(system))}, *messages]}
+    with llm_request(api_config, url, headers=headers, json=body) as r:
+        r.raise_for_status()
+        resp = r.json()
+    record_llm_usage(api_config, resp.get('usage'))
+    choice = resp.get('choices', [{}])[0]
+    text = re.sub(r'<think>.*?</think>\s*', '', choice.get('message', {}).get('content', '') or '', flags=re.DOTALL)
+    return {'content': [{"type": "text", "text": text.strip()}], 'stop_reason': choice.get('finish_reason', 'stop')}
+
+
 def call_llm_with_tools(api_config, system, messages, tools=None, max_loops=5):
     """Call LLM with tool-use loop. Supports OpenAI and Anthropic APIs."""
     api_type = api_config.get('api_type', 'openai')
@@ -2523,23 +4029,9 @@ def _call_openai_with_tools(api_config, system, messages, tools=None, max_loops=
         'Content-Type': 'application/json',
     }
 
-    # Build OpenAI-format messages
-    oai_messages = [{"role": "system", "content": system}]
-    for msg in messages:
-        if isinstance(msg.get('content'), str):
-            oai_messages.append({"role": msg['role'], "content": msg['content']})
-
-    # Convert tool schemas to OpenAI format
-    oai_tools = []
-    for t in (tools or NATIVE_TOOLS):
-        oai_tools.append({
-            "type": "function",
-            "function": {
-                "name": t['name'],
-                "description": t.get('description', ''),
-                "parameters": t.get('input_schema', {"type": "object", "properties": {}}),
-            }
-        })
+    # Build OpenAI-format messages and tool schemas (stable prefix first)
+    oai_messages = _openai_messages(system, messages)
+    oai_tools = _openai_tools(tools)
 
     tool_results_all = []
 
@@ -2551,10 +4043,10 @@ def _call_openai_with_tools(api_config, system, messages, tools=None, max_loops=
             'tools': oai_tools,
         }
 
-        with httpx.Client(timeout=300) as client:
-            r = client.post(url, headers=headers, json=body)
+        with llm_request(api_config, url, headers=headers, json=body) as r:
             r.raise_for_status()
             resp = r.json()
+        record_llm_usage(api_config, resp.get('usage'))
 
         choice = resp.get('choices', [{}])[0]
         msg = choice.get('message', {})
@@ -2572,22 +4064,20 @@ def _call_openai_with_tools(api_config, system, messages, tools=None, max_loops=
         tool_calls = msg.get('tool_calls', [])
         oai_messages.append(msg)
 
+        calls = []
         for tc in tool_calls:
             func = tc.get('function', {})
-            tool_name = func.get('name', '')
             try:
                 tool_input = json.loads(func.get('arguments', '{}'))
             except json.JSONDecodeError:
                 tool_input = {}
-            tool_id = tc.get('id', '')
+            calls.append((func.get('name', ''), tool_input))
 
-            logger.info(f"Tool call: {tool_name}({json.dumps(tool_input)[:200]})")
-            result = execute_tool(tool_name, tool_input)
+        for tc, (tool_name, tool_input), result in zip(tool_calls, calls, execute_tool_calls(calls)):
             tool_results_all.append({"tool": tool_name, "input": tool_input, "result": result})
-
             oai_messages.append({
                 "role": "tool",
-                "tool_call_id": tool_id,
+                "tool_call_id": tc.get('id', ''),
                 "content": str(result),
             })
 
@@ -2613,13 +4103,8 @@ def _call_anthropic_with_tools(api_config, system, messages, tools=None, max_loo
     }
 
     # Anthropic tools use input_schema directly
-    anthropic_tools = []
-    for t in (tools or NATIVE_TOOLS):
-        anthropic_tools.append({
-            "name": t['name'],
-            "description": t.get('description', ''),
-            "input_schema": t.get('input_schema', {"type": "object", "properties": {}}),
-        })
+    anthropic_tools = _anthropic_tools(tools)
+    anthropic_system = _anthropic_system(system)
 
     # Convert messages to Anthropic format
     anthropic_messages = []
@@ -2633,8 +4118,8 @@ def _call_anthropic_with_tools(api_config, system, messages, tools=None, max_loo
         body = {
             'model': model,
             'max_tokens': CHAT_CONFIG.get('max_tokens', 4096),
-            'system': system,
-            'messages': anthropic_messages,
+            'system': anthropic_system,
+            'messages': _anthropic_cached_messages(anthropic_messages),
             'tools': anthropic_tools,
         }
 
@@ -2644,10 +4129,10 @@ def _call_anthropic_with_tools(api_config, system, messages, tools=None, max_loo
             thinking_budget = {'minimal': 1024, 'low': 2048, 'medium': 5000, 'high': 10000}.get(thinking, 5000)
             body['thinking'] = {'type': 'enabled', 'budget_tokens': thinking_budget}
 
-        with httpx.Client(timeout=300) as client:
-            r = client.post(url, headers=headers, json=body)
+        with llm_request(api_config, url, headers=headers, json=body) as r:
             r.raise_for_status()
             resp = r.json()
+        record_llm_usage(api_config, resp.get('usage'))
 
         content = resp.get('content', [])
         has_tool_use = any(b.get('type') == 'tool_use' for b in content)
@@ -2661,22 +4146,16 @@ def _call_anthropic_with_tools(api_config, system, messages, tools=None, max_loo
             }
 
         # Execute tool calls
+        tool_uses = [b for b in content if b.get('type') == 'tool_use']
+        calls = [(b['name'], b['input']) for b in tool_uses]
         tool_use_results = []
-        for block in content:
-            if block.get('type') == 'tool_use':
-                tool_name = block['name']
-                tool_input = block['input']
-                tool_id = block['id']
-
-                logger.info(f"Tool call: {tool_name}({json.dumps(tool_input)[:200]})")
-                result = execute_tool(tool_name, tool_input)
-                tool_results_all.append({"tool": tool_name, "input": tool_input, "result": result})
-
-                tool_use_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_id,
-                    "content": str(result),
-                })
+        for block, (tool_name, tool_input), result in zip(tool_uses, calls, execute_tool_calls(calls)):
+            tool_results_all.append({"tool": tool_name, "input": tool_input, "result": result})
+            tool_use_results.append({
+                "type": "tool_result",
+                "tool_use_id": block['id'],
+                "content": str(result),
+            })
 
         anthropic_messages.append({"role": "assistant", "content": content})
         anthropic_messages.append({"role": "user", "content": tool_use_results})
@@ -2688,6 +4167,245 @@ def _call_anthropic_with_tools(api_config, system, messages, tools=None, max_loo
     }
 
 
+# ── Streaming Tool Loop ────────────────────────────────────────────────────
+# Same loops as above with `stream: true` upstream. Each generator yields
+# {'type': 'text', 'delta'}, {'type': 'tool_start', 'tool', 'input'},
+# {'type': 'tool_result', 'tool', 'input', 'result'} and finally
+# {'type': 'done', 'response'} where response matches call_llm_with_tools().
+
+def stream_llm_with_tools(api_config, system, messages, tools=None, max_loops=5):
+    """Streaming counterpart of call_llm_with_tools()."""
+    if api_config.get('api_type', 'openai') == 'anthropic':
+        return _stream_anthropic_with_tools(api_config, system, messages, tools, max_loops)
+    return _stream_openai_with_tools(api_config, system, messages, tools, max_loops)
+
+
+def _sse_data(response):
+    """Parsed JSON payloads of an upstream SSE response's `data:` lines."""
+    for line in response.iter_lines():
+        if not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            return
+        if payload:
+            yield json.loads(payload)
+
+
+def _think_filter():
+    """feed(delta) -> the visible part of a text stream, hiding <think>…</think>
+    spans even when a tag is split across deltas."""
+    state = {'buf': '', 'inside': False}
+
+    def feed(delta):
+        buf, out = state['buf'] + delta, []
+        while buf:
+            tag = '</think>' if state['inside'] else '<think>'
+            i = buf.find(tag)
+            if i >= 0:
+                if not state['inside']:
+                    out.append(buf[:i])
+                buf = buf[i + len(tag):]
+                state['inside'] = not state['inside']
+                if not state['inside']:
+                    buf = buf.lstrip()
+                continue
+            keep = next((k for k in range(len(tag) - 1, 0, -1) if buf.endswith(tag[:k])), 0)
+            if not state['inside']:
+                out.append(buf[:len(buf) - keep])
+            buf = buf[len(buf) - keep:] if keep else ''
+            break
+        state['buf'] = buf
+        return ''.join(out)
+    return feed
+
+
+def _tool_call_events(calls, tool_results_all):
+    """Execute one turn's tool calls batch by batch (see tool_batches), yielding
+    start/result events; returns the results in call order."""
+    results = []
+    for batch in tool_batches(calls):
+        for tool_name, tool_input in batch:
+            yield {'type': 'tool_start', 'tool': tool_name, 'input': tool_input}
+        for (tool_name, tool_input), result in zip(batch, execute_tool_batch(batch)):
+            tool_results_all.append({"tool": tool_name, "input": tool_input, "result": result})
+            yield {'type': 'tool_result', 'tool': tool_name, 'input': tool_input, 'result': result}
+            results.append(result)
+    return results
+
+
+def _stream_openai_with_tools(api_config, system, messages, tools=None, max_loops=5):
+    """Streaming _call_openai_with_tools(): chat/completions with `stream: true`."""
+    import re as _re
+
+    base_url = api_config['base_url'].rstrip('/')
+    url = f"{base_url}/chat/completions"
+    headers = {
+        'Authorization': f"Bearer {api_config['api_key']}",
+        'Content-Type': 'application/json',
+    }
+    model = api_config.get('model', CHAT_CONFIG['model'])
+
+    oai_messages = _openai_messages(system, messages)
+    oai_tools = _openai_tools(tools)
+
+    tool_results_all = []
+
+    for loop in range(max_loops):
+        body = {
+            'model': model,
+            'max_tokens': CHAT_CONFIG.get('max_tokens', 4096),
+            'messages': oai_messages,
+            'tools': oai_tools,
+            'stream': True,
+            'stream_options': {'include_usage': True},
+        }
+        text, calls, visible = [], {}, _think_filter()
+        with llm_request(api_config, url, stream=True, headers=headers, json=body) as r:
+            r.raise_for_status()
+            for chunk in _sse_data(r):
+                record_llm_usage(api_config, chunk.get('usage'))
+                delta = (chunk.get('choices') or [{}])[0].get('delta') or {}
+                if delta.get('content'):
+                    text.append(delta['content'])
+                    shown = visible(delta['content'])
+                    if shown:
+                        yield {'type': 'text', 'delta': shown}
+                for tc in delta.get('tool_calls') or []:
+                    call = calls.setdefault(tc.get('index', 0), {'id': '', 'name': '', 'arguments': ''})
+                    func = tc.get('function') or {}
+                    call['id'] = tc.get('id') or call['id']
+                    call['name'] += func.get('name') or ''
+                    call['arguments'] += func.get('arguments') or ''
+
+        if not calls:
+            final = _re.sub(r'<think>.*?</think>\s*', '', ''.join(text), flags=_re.DOTALL).strip()
+            yield {'type': 'done', 'response': {
+                'content': [{"type": "text", "text": final}],
+                'stop_reason': 'end_turn',
+                'tool_results': tool_results_all,
+            }}
+            return
+
+        oai_messages.append({
+            "role": "assistant",
+            "content": ''.join(text) or None,
+            "tool_calls": [{"id": c['id'], "type": "function",
+                            "function": {"name": c['name'], "arguments": c['arguments'] or '{}'}}
+                           for _, c in sorted(calls.items())],
+        })
+        ordered, inputs = [c for _, c in sorted(calls.items())], []
+        for call in ordered:
+            try:
+                inputs.append((call['name'], json.loads(call['arguments'] or '{}')))
+            except json.JSONDecodeError:
+                inputs.append((call['name'], {}))
+        results = yield from _tool_call_events(inputs, tool_results_all)
+        for call, result in zip(ordered, results):
+            oai_messages.append({"role": "tool", "tool_call_id": call['id'], "content": str(result)})
+
+    yield {'type': 'done', 'response': {
+        'content': [{"type": "text", "text": "I performed several actions but reached the maximum number of steps."}],
+        'stop_reason': 'max_loops',
+        'tool_results': tool_results_all,
+    }}
+
+
+def _stream_anthropic_with_tools(api_config, system, messages, tools=None, max_loops=5):
+    """Streaming _call_anthropic_with_tools(): Messages API with `stream: true`.
+    Content blocks (text, thinking, tool_use) are rebuilt from their deltas so the
+    assistant turn can be sent back verbatim alongside the tool results."""
+    base_url = api_config['base_url'].rstrip('/')
+    url = f"{base_url}/v1/messages"
+    headers = {
+        'x-api-key': api_config['api_key'],
+        'content-type': 'application/json',
+        'anthropic-version': '2023-06-01',
+    }
+    model = api_config.get('model', CHAT_CONFIG['model'])
+
+    anthropic_tools = _anthropic_tools(tools)
+    anthropic_system = _anthropic_system(system)
+    anthropic_messages = [{"role": msg['role'], "content": msg['content']}
+                          for msg in messages if isinstance(msg.get('content'), str)]
+
+    tool_results_all = []
+
+    for loop in range(max_loops):
+        body = {
+            'model': model,
+            'max_tokens': CHAT_CONFIG.get('max_tokens', 4096),
+            'system': anthropic_system,
+            'messages': _anthropic_cached_messages(anthropic_messages),
+            'tools': anthropic_tools,
+            'stream': True,
+        }
+        thinking = CHAT_CONFIG.get('thinking', 'off')
+        if thinking != 'off':
+            thinking_budget = {'minimal': 1024, 'low': 2048, 'medium': 5000, 'high': 10000}.get(thinking, 5000)
+            body['thinking'] = {'type': 'enabled', 'budget_tokens': thinking_budget}
+
+        blocks, partial_json, stop_reason, usage = {}, {}, 'end_turn', {}
+        with llm_request(api_config, url, stream=True, headers=headers, json=body) as r:
+            r.raise_for_status()
+            for event in _sse_data(r):
+                kind = event.get('type')
+                if kind == 'content_block_start':
+                    blocks[event['index']] = dict(event['content_block'])
+                elif kind == 'content_block_delta':
+                    block, delta = blocks[event['index']], event['delta']
+                    if delta['type'] == 'text_delta':
+                        block['text'] = block.get('text', '') + delta['text']
+                        yield {'type': 'text', 'delta': delta['text']}
+                    elif delta['type'] == 'input_json_delta':
+                        partial_json[event['index']] = partial_json.get(event['index'], '') + delta['partial_json']
+                    elif delta['type'] == 'thinking_delta':
+                        block['thinking'] = block.get('thinking', '') + delta['thinking']
+                    elif delta['type'] == 'signature_delta':
+                        block['signature'] = delta['signature']
+                elif kind == 'message_start':
+                    usage.update((event.get('message') or {}).get('usage') or {})
+                elif kind == 'message_delta':
+                    stop_reason = (event.get('delta') or {}).get('stop_reason') or stop_reason
+                    usage.update(event.get('usage') or {})
+                elif kind == 'error':
+                    raise RuntimeError((event.get('error') or {}).get('message', 'stream error'))
+
+        record_llm_usage(api_config, usage)
+        content = [blocks[i] for i in sorted(blocks)]
+        for i, raw in partial_json.items():
+            blocks[i]['input'] = json.loads(raw) if raw else {}
+
+        if not any(b.get('type') == 'tool_use' for b in content):
+            yield {'type': 'done', 'response': {
+                'content': [{"type": "text", "text": '\n'.join(b['text'] for b in content if b.get('type') == 'text')}],
+                'stop_reason': stop_reason,
+                'tool_results': tool_results_all,
+            }}
+            return
+
+        tool_uses = [b for b in content if b.get('type') == 'tool_use']
+        results = yield from _tool_call_events([(b['name'], b.get('input') or {}) for b in tool_uses],
+                                               tool_results_all)
+        tool_use_results = [{
+            "type": "tool_result",
+            "tool_use_id": block['id'],
+            "content": str(result),
+        } for block, result in zip(tool_uses, results)]
+        anthropic_messages.append({"role": "assistant", "content": content})
+        anthropic_messages.append({"role": "user", "content": tool_use_results})
+
+    yield {'type': 'done', 'response': {
+        'content': [{"type": "text", "text": "I performed several actions but reached the maximum number of steps."}],
+        'stop_reason': 'max_loops',
+        'tool_results': tool_results_all,
+    }}
+
+
+# Resumed here, once the LLM helpers the research workers call are defined
+_recover_research_jobs()
+
+
 # ── Run ────────────────────────────────────────────────────────────────────
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+"""SQLite connection layer shared by app.py and notes_tools.py.
+Pure Python — one connection per thread, reused across get_db() calls."""
+
+import os
+import sqlite3
+import threading
+import time
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notes.db')
+
+# Seconds SQLite waits on a locked database before raising "database is locked"
+BUSY_TIMEOUT = float(os.environ.get('NOTES_DB_BUSY_TIMEOUT', '10'))
+# Prepared statements kept per connection (sqlite3's built-in LRU statement cache)
+STATEMENT_CACHE_SIZE = int(os.environ.get('NOTES_DB_STATEMENT_CACHE', '256'))
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {'opens': 0, 'reuses': 0, 'open_wait_ms': 0.0, 'resets': 0}
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection that survives nested `with get_db() as conn:` blocks.
+
+    Only the outermost `with` commits (or rolls back on error); inner blocks
+    opened by helpers such as get_user_team_ids() join the caller's transaction
+    instead of committing it halfway through."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._depth = 0
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            return super().__exit__(exc_type, exc, tb)
+        return False
+
+    def close(self):
+        """No-op: the connection belongs to the thread. Use close_thread_connection()."""
+
+
+def _open():
+    start = time.perf_counter()
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, factory=PooledConnection,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+    elapsed = (time.perf_counter() - start) * 1000
+    with _stats_lock:
+        _stats['opens'] += 1
+        _stats['open_wait_ms'] += elapsed
+    return conn
+
+
+def get_db():
+    """Return this thread's connection, opening and configuring it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = _open()
+        return conn
+    if conn._depth == 0 and conn.in_transaction:
+        # A previous caller left a transaction open — don't let it leak into this one
+        conn.rollback()
+        with _stats_lock:
+            _stats['resets'] += 1
+    with _stats_lock:
+        _stats['reuses'] += 1
+    return conn
+
+
+def close_thread_connection():
+    """Close the calling thread's connection (e.g. before a worker thread exits)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        sqlite3.Connection.close(conn)
+
+
+def stats():
+    """Connection counters: opens, reuses, total ms spent opening, stray-transaction resets."""
+    with _stats_lock:
+        s = dict(_stats)
+    total = s['opens'] + s['reuses']
+    s['open_wait_ms'] = round(s['open_wait_ms'], 2)
+    s['reuse_rate'] = round(s['reuses'] / total, 3) if total else 0.0
+    return s
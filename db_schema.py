@@ -0,0 +1,603 @@
+"""Versioned schema migrations for notes.db.
+Pure Python — app.py runs migrate() at import; `python db_schema.py [db_path]` migrates
+a database and checks that the hot queries' plans still use their indexes."""
+
+import logging
+import sqlite3
+import sys
+
+import db_pool
+from db_pool import get_db
+import notes_tools
+
+logger = logging.getLogger(__name__)
+
+
+# ── Migrations ──────────────────────────────────────────────────────────────
+# Each migration runs once, in order, and bumps schema_version when it finishes.
+# Steps that use executescript() commit as they go, so every migration must be
+# safe to re-run if the process dies halfway through (IF NOT EXISTS, probes).
+
+def _baseline(conn):
+    """Everything init_db() used to run on every start. Probes keep it safe on
+    databases created before schema_version existed."""
+    # FTS tables created before the sync triggers existed are empty — backfill them once
+    fts_backfill = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='db_items_fts_ai'"
+    ).fetchone()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS pages (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT 'Untitled',
+            icon TEXT DEFAULT '',
+            cover TEXT DEFAULT '',
+            parent_id TEXT DEFAULT NULL,
+            workspace TEXT DEFAULT 'docs',
+            sort_order INTEGER DEFAULT 0,
+            is_favorite BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (parent_id) REFERENCES pages(id) ON DELETE SET NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS blocks (
+            id TEXT PRIMARY KEY,
+            page_id TEXT NOT NULL,
+            type TEXT NOT NULL DEFAULT 'text',
+            content TEXT DEFAULT '',
+            properties TEXT DEFAULT '{}',
+            sort_order INTEGER DEFAULT 0,
+            indent_level INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (page_id) REFERENCES pages(id) ON DELETE CASCADE
+        );
+
+        -- Databases (for Projects & Knowledge Base)
+        CREATE TABLE IF NOT EXISTS databases (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT 'Untitled Database',
+            icon TEXT DEFAULT '',
+            workspace TEXT DEFAULT 'projects',
+            description TEXT DEFAULT '',
+            properties_schema TEXT DEFAULT '[]',
+            default_view TEXT DEFAULT 'table',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Database items (rows)
+        CREATE TABLE IF NOT EXISTS db_items (
+            id TEXT PRIMARY KEY,
+            database_id TEXT NOT NULL,
+            title TEXT NOT NULL DEFAULT 'Untitled',
+            icon TEXT DEFAULT '',
+            properties TEXT DEFAULT '{}',
+            page_id TEXT DEFAULT NULL,
+            sort_order INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE,
+            FOREIGN KEY (page_id) REFERENCES pages(id) ON DELETE SET NULL
+        );
+
+        -- Database views
+        CREATE TABLE IF NOT EXISTS db_views (
+            id TEXT PRIMARY KEY,
+            database_id TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT 'Default',
+            type TEXT NOT NULL DEFAULT 'table',
+            config TEXT DEFAULT '{}',
+            sort_order INTEGER DEFAULT 0,
+            FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE
+        );
+
+        -- Project resources (files/directories linked to projects)
+        CREATE TABLE IF NOT EXISTS project_resources (
+            id TEXT PRIMARY KEY,
+            database_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            resource_type TEXT NOT NULL DEFAULT 'directory',
+            qmd_collection TEXT DEFAULT '',
+            indexed_at TIMESTAMP DEFAULT NULL,
+            file_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (database_id) REFERENCES databases(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_res_db ON project_resources(database_id);
+
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL DEFAULT 'default',
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_messages(session_id);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(
+            id, title, content='pages', content_rowid=rowid
+        );
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS blocks_fts USING fts5(
+            id, content, content='blocks', content_rowid=rowid
+        );
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS db_items_fts USING fts5(
+            id, title, content='db_items', content_rowid=rowid
+        );
+
+        -- Keep the external-content FTS tables in sync with their source tables.
+        -- Updates only fire on indexed columns so updated_at/sort_order churn is free.
+        CREATE TRIGGER IF NOT EXISTS pages_fts_ai AFTER INSERT ON pages BEGIN
+            INSERT INTO pages_fts(rowid, id, title) VALUES (new.rowid, new.id, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_fts_ad AFTER DELETE ON pages BEGIN
+            INSERT INTO pages_fts(pages_fts, rowid, id, title) VALUES ('delete', old.rowid, old.id, old.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_fts_au AFTER UPDATE OF id, title ON pages BEGIN
+            INSERT INTO pages_fts(pages_fts, rowid, id, title) VALUES ('delete', old.rowid, old.id, old.title);
+            INSERT INTO pages_fts(rowid, id, title) VALUES (new.rowid, new.id, new.title);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS blocks_fts_ai AFTER INSERT ON blocks BEGIN
+            INSERT INTO blocks_fts(rowid, id, content) VALUES (new.rowid, new.id, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_fts_ad AFTER DELETE ON blocks BEGIN
+            INSERT INTO blocks_fts(blocks_fts, rowid, id, content) VALUES ('delete', old.rowid, old.id, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_fts_au AFTER UPDATE OF id, content ON blocks BEGIN
+            INSERT INTO blocks_fts(blocks_fts, rowid, id, content) VALUES ('delete', old.rowid, old.id, old.content);
+            INSERT INTO blocks_fts(rowid, id, content) VALUES (new.rowid, new.id, new.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS db_items_fts_ai AFTER INSERT ON db_items BEGIN
+            INSERT INTO db_items_fts(rowid, id, title) VALUES (new.rowid, new.id, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS db_items_fts_ad AFTER DELETE ON db_items BEGIN
+            INSERT INTO db_items_fts(db_items_fts, rowid, id, title) VALUES ('delete', old.rowid, old.id, old.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS db_items_fts_au AFTER UPDATE OF id, title ON db_items BEGIN
+            INSERT INTO db_items_fts(db_items_fts, rowid, id, title) VALUES ('delete', old.rowid, old.id, old.title);
+            INSERT INTO db_items_fts(rowid, id, title) VALUES (new.rowid, new.id, new.title);
+        END;
+
+        -- Users
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE DEFAULT '',
+            password_hash TEXT NOT NULL,
+            display_name TEXT DEFAULT '',
+            role TEXT DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Teams
+        CREATE TABLE IF NOT EXISTS teams (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT DEFAULT '',
+            created_by TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        );
+
+        -- Team members
+        CREATE TABLE IF NOT EXISTS team_members (
+            team_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (team_id, user_id),
+            FOREIGN KEY (team_id) REFERENCES teams(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+
+        -- Permissions (granular sharing)
+        CREATE TABLE IF NOT EXISTS permissions (
+            id TEXT PRIMARY KEY,
+            resource_type TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            grantee_type TEXT NOT NULL,
+            grantee_id TEXT NOT NULL,
+            permission TEXT NOT NULL,
+            granted_by TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (granted_by) REFERENCES users(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_perm_resource ON permissions(resource_type, resource_id);
+        CREATE INDEX IF NOT EXISTS idx_perm_grantee ON permissions(grantee_type, grantee_id);
+    """)
+    # Migrations
+    try:
+        conn.execute("SELECT workspace FROM pages LIMIT 1")
+    except sqlite3.OperationalError:
+        conn.execute("ALTER TABLE pages ADD COLUMN workspace TEXT DEFAULT 'docs'")
+    # Add owner columns to pages and databases
+    for table in ('pages', 'databases'):
+        try:
+            conn.execute(f"SELECT owner_id FROM {table} LIMIT 1")
+        except sqlite3.OperationalError:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN owner_id TEXT DEFAULT ''")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN owner_type TEXT DEFAULT 'user'")
+    # Soft delete: trashed pages keep their rows until the purger removes them
+    try:
+        conn.execute("SELECT deleted_at FROM pages LIMIT 1")
+    except sqlite3.OperationalError:
+        conn.execute("ALTER TABLE pages ADD COLUMN deleted_at TIMESTAMP DEFAULT NULL")
+        conn.execute("ALTER TABLE pages ADD COLUMN deleted_root TEXT DEFAULT NULL")
+    # Add owner to chat_messages
+    try:
+        conn.execute("SELECT user_id FROM chat_messages LIMIT 1")
+    except sqlite3.OperationalError:
+        conn.execute("ALTER TABLE chat_messages ADD COLUMN user_id TEXT DEFAULT ''")
+    conn.commit()
+    # Needs the owner columns added above, so it runs after the migrations
+    access_backfill = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='effective_access'"
+    ).fetchone()
+    conn.executescript("""
+        -- Effective access: one row per (user, resource) with the highest permission level
+        -- (1=read, 2=write, 3=delete/full). Maintained by triggers so list filters are one lookup.
+        CREATE TABLE IF NOT EXISTS effective_access (
+            user_id TEXT NOT NULL,
+            resource_type TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            PRIMARY KEY (user_id, resource_type, resource_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_effective_access_resource ON effective_access(resource_type, resource_id);
+        CREATE INDEX IF NOT EXISTS idx_pages_owner ON pages(owner_id);
+        CREATE INDEX IF NOT EXISTS idx_databases_owner ON databases(owner_id);
+        CREATE INDEX IF NOT EXISTS idx_team_members_user ON team_members(user_id);
+        CREATE INDEX IF NOT EXISTS idx_pages_trash ON pages(deleted_at, deleted_root) WHERE deleted_at IS NOT NULL;
+
+        -- Every source of access, unaggregated: ownership, owning-team membership, direct and team grants
+        CREATE VIEW IF NOT EXISTS access_grants AS
+        SELECT owner_id AS user_id, 'page' AS resource_type, id AS resource_id, 3 AS level
+          FROM pages WHERE owner_type='user' AND owner_id != ''
+        UNION ALL
+        SELECT tm.user_id, 'page', p.id, CASE WHEN tm.role IN ('owner','admin') THEN 3 ELSE 2 END
+          FROM pages p JOIN team_members tm ON tm.team_id = p.owner_id WHERE p.owner_type='team'
+        UNION ALL
+        SELECT owner_id, 'database', id, 3
+          FROM databases WHERE owner_type='user' AND owner_id != ''
+        UNION ALL
+        SELECT tm.user_id, 'database', d.id, CASE WHEN tm.role IN ('owner','admin') THEN 3 ELSE 2 END
+          FROM databases d JOIN team_members tm ON tm.team_id = d.owner_id WHERE d.owner_type='team'
+        UNION ALL
+        SELECT grantee_id, resource_type, resource_id,
+               CASE permission WHEN 'read' THEN 1 WHEN 'write' THEN 2 WHEN 'delete' THEN 3 ELSE 0 END
+          FROM permissions WHERE grantee_type='user'
+        UNION ALL
+        SELECT tm.user_id, pm.resource_type, pm.resource_id,
+               CASE pm.permission WHEN 'read' THEN 1 WHEN 'write' THEN 2 WHEN 'delete' THEN 3 ELSE 0 END
+          FROM permissions pm JOIN team_members tm ON tm.team_id = pm.grantee_id WHERE pm.grantee_type='team';
+
+        CREATE TRIGGER IF NOT EXISTS pages_access_ai AFTER INSERT ON pages BEGIN
+            DELETE FROM effective_access WHERE resource_type='page' AND resource_id=new.id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type='page' AND resource_id=new.id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_access_au AFTER UPDATE OF owner_id, owner_type ON pages BEGIN
+            DELETE FROM effective_access WHERE resource_type='page' AND resource_id=new.id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type='page' AND resource_id=new.id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_access_ad AFTER DELETE ON pages BEGIN
+            DELETE FROM effective_access WHERE resource_type='page' AND resource_id=old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_access_ai AFTER INSERT ON databases BEGIN
+            DELETE FROM effective_access WHERE resource_type='database' AND resource_id=new.id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type='database' AND resource_id=new.id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_access_au AFTER UPDATE OF owner_id, owner_type ON databases BEGIN
+            DELETE FROM effective_access WHERE resource_type='database' AND resource_id=new.id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type='database' AND resource_id=new.id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_access_ad AFTER DELETE ON databases BEGIN
+            DELETE FROM effective_access WHERE resource_type='database' AND resource_id=old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS permissions_access_ai AFTER INSERT ON permissions BEGIN
+            DELETE FROM effective_access WHERE resource_type=new.resource_type AND resource_id=new.resource_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type=new.resource_type AND resource_id=new.resource_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS permissions_access_ad AFTER DELETE ON permissions BEGIN
+            DELETE FROM effective_access WHERE resource_type=old.resource_type AND resource_id=old.resource_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type=old.resource_type AND resource_id=old.resource_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS permissions_access_au AFTER UPDATE ON permissions BEGIN
+            DELETE FROM effective_access WHERE resource_type=old.resource_type AND resource_id=old.resource_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type=old.resource_type AND resource_id=old.resource_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+            DELETE FROM effective_access WHERE resource_type=new.resource_type AND resource_id=new.resource_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE resource_type=new.resource_type AND resource_id=new.resource_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS team_members_access_ai AFTER INSERT ON team_members BEGIN
+            DELETE FROM effective_access WHERE user_id=new.user_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE user_id=new.user_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS team_members_access_ad AFTER DELETE ON team_members BEGIN
+            DELETE FROM effective_access WHERE user_id=old.user_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE user_id=old.user_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS team_members_access_au AFTER UPDATE ON team_members BEGIN
+            DELETE FROM effective_access WHERE user_id=old.user_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE user_id=old.user_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+            DELETE FROM effective_access WHERE user_id=new.user_id;
+            INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) FROM access_grants
+                WHERE user_id=new.user_id GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_access_ad AFTER DELETE ON users BEGIN
+            DELETE FROM effective_access WHERE user_id=old.id;
+        END;
+
+        -- Change counters: bumped by triggers so readers can tell cheaply whether anything moved.
+        -- 'page_tree' covers every column the sidebar tree shows plus page visibility.
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO change_counters (name, value) VALUES ('page_tree', 0);
+        CREATE TRIGGER IF NOT EXISTS pages_tree_ai AFTER INSERT ON pages BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name='page_tree';
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_tree_au
+        AFTER UPDATE OF title, icon, parent_id, workspace, sort_order, is_favorite, owner_id, owner_type, deleted_at ON pages BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name='page_tree';
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_tree_ad AFTER DELETE ON pages BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name='page_tree';
+        END;
+        CREATE TRIGGER IF NOT EXISTS effective_access_tree_ai AFTER INSERT ON effective_access
+        WHEN new.resource_type='page' BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name='page_tree';
+        END;
+        CREATE TRIGGER IF NOT EXISTS effective_access_tree_ad AFTER DELETE ON effective_access
+        WHEN old.resource_type='page' BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name='page_tree';
+        END;
+    """)
+    if access_backfill:
+        conn.execute(
+            "INSERT INTO effective_access SELECT user_id, resource_type, resource_id, MAX(level) "
+            "FROM access_grants GROUP BY user_id, resource_type, resource_id HAVING MAX(level) > 0"
+        )
+        conn.commit()
+    if fts_backfill:
+        notes_tools.rebuild_search_index()
+        logger.info("Search index rebuilt")
+
+
+def _hot_path_indexes(conn):
+    """Composite indexes for the per-page, per-parent, per-database and per-session reads."""
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_blocks_page_order ON blocks(page_id, sort_order);
+        CREATE INDEX IF NOT EXISTS idx_pages_parent_order ON pages(parent_id, sort_order);
+        CREATE INDEX IF NOT EXISTS idx_pages_workspace ON pages(workspace, updated_at);
+        CREATE INDEX IF NOT EXISTS idx_db_items_order ON db_items(database_id, sort_order);
+        CREATE INDEX IF NOT EXISTS idx_chat_session_id ON chat_messages(session_id, id);
+        DROP INDEX IF EXISTS idx_chat_session;
+        ANALYZE;
+    """)
+
+
+def _content_change_log(conn):
+    """Trigger-fed log of which pages and databases changed, so content snapshots can be
+    rebuilt per section. Pages are logged for their own and their blocks' writes,
+    databases for their own and their items' writes; old rows prune themselves."""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS content_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            ref TEXT NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS content_changes_prune AFTER INSERT ON content_changes
+        WHEN new.seq % 1000 = 0 BEGIN
+            DELETE FROM content_changes WHERE seq <= new.seq - 10000;
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_content_ai AFTER INSERT ON pages BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_content_au AFTER UPDATE ON pages BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_content_ad AFTER DELETE ON pages BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', old.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_content_ai AFTER INSERT ON blocks BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', new.page_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_content_au AFTER UPDATE ON blocks BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', new.page_id);
+            INSERT INTO content_changes (kind, ref) SELECT 'page', old.page_id WHERE old.page_id IS NOT new.page_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_content_ad AFTER DELETE ON blocks BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('page', old.page_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_content_ai AFTER INSERT ON databases BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_content_au AFTER UPDATE ON databases BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS databases_content_ad AFTER DELETE ON databases BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', old.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS db_items_content_ai AFTER INSERT ON db_items BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', new.database_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS db_items_content_au AFTER UPDATE ON db_items BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', new.database_id);
+            INSERT INTO content_changes (kind, ref) SELECT 'db', old.database_id WHERE old.database_id IS NOT new.database_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS db_items_content_ad AFTER DELETE ON db_items BEGIN
+            INSERT INTO content_changes (kind, ref) VALUES ('db', old.database_id);
+        END;
+    """)
+
+
+def _chat_runs(conn):
+    """Background chat runs: status and final payload survive a restart."""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS chat_runs (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_runs_status ON chat_runs(status);
+    """)
+
+
+def _chat_summaries(conn):
+    """Rolling summary of the chat messages folded out of each session's history."""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL DEFAULT '',
+            upto_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+def _ai_response_cache(conn):
+    """Content-addressed cache of AI inline/block action responses."""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS ai_response_cache (
+            key TEXT PRIMARY KEY,
+            action TEXT NOT NULL DEFAULT '',
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_ai_cache_created ON ai_response_cache(created_at);
+        CREATE INDEX IF NOT EXISTS idx_ai_cache_lru ON ai_response_cache(last_used);
+    """)
+
+
+def _research_jobs(conn):
+    """Background AI research jobs: state and created page survive a restart."""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS research_jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL DEFAULT '',
+            topic TEXT NOT NULL,
+            title TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_research_jobs_status ON research_jobs(status);
+    """)
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'hot-path indexes', _hot_path_indexes),
+    (3, 'content change log', _content_change_log),
+    (4, 'chat runs', _chat_runs),
+    (5, 'chat summaries', _chat_summaries),
+    (6, 'ai response cache', _ai_response_cache),
+    (7, 'research jobs', _research_jobs),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn) -> int:
+    try:
+        row = conn.execute("SELECT version FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def migrate(conn) -> int:
+    """Apply pending migrations. Costs a single SELECT when the schema is current.
+    Returns the number of migrations applied."""
+    current = schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        return 0
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    applied = 0
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        step(conn)
+        conn.execute("DELETE FROM schema_version")
+        conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+        conn.commit()
+        logger.info(f"Applied migration {version}: {name}")
+        applied += 1
+    return applied
+
+
+# ── Query plans ─────────────────────────────────────────────────────────────
+# Hot queries and the index each must use. check_query_plans() fails a query whose
+# plan doesn't mention its index or falls back to a temp b-tree for ORDER BY.
+
+HOT_QUERIES = [
+    ('page blocks', "SELECT * FROM blocks WHERE page_id=? ORDER BY sort_order",
+     ('x',), 'idx_blocks_page_order'),
+    ('block order neighbour', "SELECT MIN(sort_order) FROM blocks WHERE page_id IS ? AND sort_order>?",
+     ('x', 0), 'idx_blocks_page_order'),
+    ('child pages', "SELECT id, title, icon FROM pages WHERE parent_id=? AND deleted_at IS NULL ORDER BY sort_order",
+     ('x',), 'idx_pages_parent_order'),
+    ('workspace pages', "SELECT id, title FROM pages WHERE workspace=? AND deleted_at IS NULL ORDER BY updated_at DESC",
+     ('docs',), 'idx_pages_workspace'),
+    ('database items', "SELECT * FROM db_items WHERE database_id=? ORDER BY sort_order",
+     ('x',), 'idx_db_items_order'),
+    ('chat history', "SELECT role, content FROM chat_messages WHERE session_id=? ORDER BY id",
+     ('x',), 'idx_chat_session_id'),
+    ('chat trim', "DELETE FROM chat_messages WHERE session_id=? AND id<=?",
+     ('x', 0), 'idx_chat_session_id'),
+    ('ai cache eviction', "SELECT key FROM ai_response_cache ORDER BY last_used LIMIT 10",
+     (), 'idx_ai_cache_lru'),
+    ('accessible pages', "SELECT resource_id FROM effective_access WHERE user_id=? AND resource_type='page'",
+     ('x',), 'PRIMARY KEY'),
+    ('resource grants', "SELECT * FROM permissions WHERE resource_type=? AND resource_id=?",
+     ('page', 'x'), 'idx_perm_resource'),
+    ('trash purge', "SELECT id FROM pages WHERE deleted_at IS NOT NULL AND deleted_at <= ? LIMIT 200",
+     ('x',), 'idx_pages_trash'),
+]
+
+
+def check_query_plans(conn) -> list:
+    """EXPLAIN QUERY PLAN every HOT_QUERIES entry: [{'name', 'index', 'ok', 'plan'}]."""
+    results = []
+    for name, sql, params, index in HOT_QUERIES:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        ok = any(index in step for step in plan) and not any('TEMP B-TREE' in step for step in plan)
+        results.append({'name': name, 'index': index, 'ok': ok, 'plan': plan})
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if len(sys.argv) > 1:
+        db_pool.DB_PATH = sys.argv[1]
+    with get_db() as conn:
+        migrate(conn)
+        results = check_query_plans(conn)
+    for r in results:
+        print(f"{'ok  ' if r['ok'] else 'FAIL'} {r['name']:<22} {r['index']:<24} {' | '.join(r['plan'])}")
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
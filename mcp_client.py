@@ -1,19 +1,41 @@
-"""MCP Client for Brain Notes — calls the MCP server via stdio protocol.
-Used by the AI chat agents in app.py to execute tools through the MCP server."""
+"""MCP Client for Brain Notes — executes the AI chat agents' tool calls.
+
+By default tools are dispatched in-process straight onto notes_tools.py, with the
+same argument serialization and error text the MCP server would produce.
+Set MCP_TOOL_MODE=subprocess to call MCP servers over stdio instead, through
+warm sessions kept open by a background event loop.
+
+    python mcp_client.py bench [N]    # time the dispatch modes on read-only tools"""
 
 import asyncio
+import atexit
+import concurrent.futures
+import inspect
 import json
 import logging
 import os
+import sys
+import threading
+import time
 
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+import notes_tools
 
 logger = logging.getLogger(__name__)
 
 # Path to the MCP server script
 MCP_SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mcp_server.py')
 
+# 'inprocess' (default) or 'subprocess' (persistent MCP stdio sessions)
+MCP_TOOL_MODE = os.environ.get('MCP_TOOL_MODE', 'inprocess')
+
+# Persistent sessions (subprocess mode)
+MCP_PYTHON = os.environ.get('MCP_PYTHON', '/opt/homebrew/bin/python3.12')
+MCP_SERVERS_CONFIG = os.environ.get('MCP_SERVERS_CONFIG', '')   # JSON file of extra servers
+MCP_SESSIONS_PER_SERVER = int(os.environ.get('MCP_SESSIONS_PER_SERVER', '2'))
+MCP_HEALTH_INTERVAL = float(os.environ.get('MCP_HEALTH_INTERVAL', '30'))
+MCP_CALL_TIMEOUT = float(os.environ.get('MCP_CALL_TIMEOUT', '120'))
+DEFAULT_SERVER = 'brain-notes'
+
 # Tool name mapping: legacy in-app names → MCP server names
 TOOL_NAME_MAP = {
     'search_content': 'search_notes',
@@ -22,42 +44,253 @@ TOOL_NAME_MAP = {
     'update_project_item': 'update_database_item',
 }
 
+# Tools exposed by mcp_server.py; each wraps the notes_tools function of the same name
+MCP_TOOLS = (
+    'search_notes', 'list_pages', 'get_page', 'list_databases', 'get_database_items',
+    'create_page', 'create_database', 'create_database_item', 'edit_page', 'update_database_item',
+    'delete_page', 'delete_database_item', 'list_resources', 'add_resource', 'remove_resource',
+    'index_resource', 'search_resources', 'get_all_content',
+)
+
 
-def _get_server_params():
-    """Get StdioServerParameters for spawning the MCP server."""
-    return StdioServerParameters(
-        command="/opt/homebrew/bin/python3.12",
-        args=[MCP_SERVER_PATH],
-        cwd=os.path.dirname(os.path.abspath(__file__)),
-    )
+def server_configs() -> dict:
+    """{name: StdioServerParameters kwargs}: the Brain Notes server plus any
+    servers listed in the MCP_SERVERS_CONFIG JSON file."""
+    servers = {DEFAULT_SERVER: {
+        'command': MCP_PYTHON,
+        'args': [MCP_SERVER_PATH],
+        'cwd': os.path.dirname(os.path.abspath(__file__)),
+    }}
+    if MCP_SERVERS_CONFIG:
+        with open(MCP_SERVERS_CONFIG) as f:
+            servers.update(json.load(f))
+    return servers
+
+
+def _get_server_params(name: str = DEFAULT_SERVER):
+    """Get StdioServerParameters for spawning an MCP server."""
+    from mcp import StdioServerParameters
+    return StdioServerParameters(**server_configs()[name])
+
+
+def _result_text(result) -> str:
+    """Extract text from a call_tool result's content."""
+    texts = []
+    for content in result.content:
+        if hasattr(content, 'text'):
+            texts.append(content.text)
+    return '\n'.join(texts) if texts else str(result)
 
 
 async def _call_tool_async(name: str, arguments: dict) -> str:
-    """Call an MCP tool asynchronously via the stdio protocol."""
+    """Call an MCP tool on a freshly spawned server (one process per call)."""
+    from mcp import ClientSession
+    from mcp.client.stdio import stdio_client
+
     server_params = _get_server_params()
 
     async with stdio_client(server_params) as (read, write):
         async with ClientSession(read, write) as session:
             await session.initialize()
-            result = await session.call_tool(name, arguments)
+            return _result_text(await session.call_tool(name, arguments))
 
-            # Extract text from result content
-            texts = []
-            for content in result.content:
-                if hasattr(content, 'text'):
-                    texts.append(content.text)
-            return '\n'.join(texts) if texts else str(result)
 
+# ── Persistent Sessions ─────────────────────────────────────────────────────
+# One background event loop keeps MCP_SESSIONS_PER_SERVER warm stdio sessions
+# open per configured server. Calls from any thread are scheduled onto the loop
+# and go to the least busy ready session; a session multiplexes concurrent
+# requests. Each session pings its server every MCP_HEALTH_INTERVAL seconds and
+# is restarted (with backoff) when the ping fails, the server exits or a call
+# hits a transport error. Tool errors and timeouts leave the session running.
 
-def call_tool(name: str, input_data: dict) -> str:
-    """Call an MCP tool synchronously. Entry point for app.py's AI agents.
-    
-    Handles:
-    - Tool name normalization (legacy → MCP names)
-    - JSON serialization of complex arguments (blocks, properties)
-    - Spawns MCP server process per call via stdio
-    """
-    # Normalize tool name
+_loop = None
+_loop_lock = threading.Lock()
+_servers = {}   # name -> {'sessions': [slot, ...], 'tools': set | None, 'stats': {...}}
+
+
+async def _keep_session(name: str, slot: dict):
+    """Hold one session to server `name` open, restarting it whenever it dies."""
+    from mcp import ClientSession
+    from mcp.client.stdio import stdio_client
+
+    server, delay = _servers[name], 1
+    while not slot['closing']:
+        try:
+            async with stdio_client(_get_server_params(name)) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    slot['session'] = session
+                    slot['ready'].set()
+                    delay = 1
+                    while not slot['closing']:
+                        try:
+                            await asyncio.wait_for(slot['wake'].wait(), MCP_HEALTH_INTERVAL)
+                        except asyncio.TimeoutError:
+                            await asyncio.wait_for(session.send_ping(), 10)
+                            continue
+                        slot['wake'].clear()
+                        break
+        except Exception as e:
+            logger.warning(f"MCP server {name} session failed: {e}")
+        slot['session'] = None
+        slot['ready'].clear()
+        if slot['closing']:
+            return
+        server['stats']['restarts'] += 1
+        server['tools'] = None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+
+def _start_sessions():
+    """Start the background loop and open every configured server's sessions (once)."""
+    global _loop
+    with _loop_lock:
+        if _loop is not None:
+            return _loop
+        _loop = asyncio.new_event_loop()
+        threading.Thread(target=_loop.run_forever, name='mcp-sessions', daemon=True).start()
+
+        async def open_all():
+            for name in server_configs():
+                slots = [{'session': None, 'ready': asyncio.Event(), 'wake': asyncio.Event(),
+                          'closing': False, 'in_flight': 0} for _ in range(MCP_SESSIONS_PER_SERVER)]
+                _servers[name] = {'sessions': slots, 'tools': None, 'stats': {
+                    'calls': 0, 'errors': 0, 'restarts': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0}}
+                for slot in slots:
+                    slot['task'] = asyncio.get_running_loop().create_task(_keep_session(name, slot))
+        asyncio.run_coroutine_threadsafe(open_all(), _loop).result()
+        return _loop
+
+
+def _transport_errors() -> tuple:
+    """Exceptions meaning the session's connection is gone (rather than the call failing)."""
+    import anyio
+    return (OSError, EOFError, anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+
+
+def _has_ready_session(name: str) -> bool:
+    return any(slot['ready'].is_set() for slot in _servers[name]['sessions'])
+
+
+async def _ready_session(name: str) -> dict:
+    """The least busy session of server `name`, waiting for one to come up if needed.
+    Callers bound the wait (see _run)."""
+    slots = _servers[name]['sessions']
+    slot = min(slots, key=lambda s: (not s['ready'].is_set(), s['in_flight']))
+    await slot['ready'].wait()
+    return slot
+
+
+async def _server_tools(name: str) -> set:
+    """Tool names of server `name`, from list_tools (cached until the server restarts)."""
+    server = _servers[name]
+    if server['tools'] is None:
+        slot = await _ready_session(name)
+        server['tools'] = {t.name for t in (await slot['session'].list_tools()).tools}
+    return server['tools']
+
+
+async def _route(name: str) -> str:
+    """The first server that lists tool `name`, else the default server. Servers with
+    no ready session and no cached tool list are skipped rather than waited on."""
+    for candidate in _servers:
+        if _servers[candidate]['tools'] is None and not _has_ready_session(candidate):
+            continue
+        try:
+            if name in await _server_tools(candidate):
+                return candidate
+        except Exception as e:
+            logger.warning(f"MCP server {candidate} list_tools failed: {e}")
+    return DEFAULT_SERVER
+
+
+async def _call_pooled(name: str, arguments: dict) -> str:
+    """Call tool `name` on the first server that lists it, over its least busy session."""
+    server_name = await _route(name)
+    server = _servers[server_name]
+    slot = await _ready_session(server_name)
+    slot['in_flight'] += 1
+    started = time.perf_counter()
+    try:
+        result = await slot['session'].call_tool(name, arguments)
+    except BaseException as e:
+        # BaseException so a call cancelled by _run's timeout is counted too
+        server['stats']['errors'] += 1
+        if isinstance(e, _transport_errors()):
+            slot['wake'].set()      # the connection is broken: restart the session
+        raise
+    finally:
+        slot['in_flight'] -= 1
+        elapsed = (time.perf_counter() - started) * 1000
+        stats = server['stats']
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed
+        stats['last_ms'] = round(elapsed, 2)
+        stats['max_ms'] = round(max(stats['max_ms'], elapsed), 2)
+    return _result_text(result)
+
+
+def _run(coro, timeout: float = MCP_CALL_TIMEOUT):
+    """Run `coro` on the session loop under one overall timeout. If the caller's
+    wait runs out first, the coroutine is cancelled rather than left running."""
+    future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), _start_sessions())
+    try:
+        return future.result(timeout + 5)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+def list_tools() -> dict:
+    """{server: [tool names]} for every configured server (cached per server)."""
+    async def collect():
+        return {name: sorted(await _server_tools(name)) for name in _servers}
+    return _run(collect())
+
+
+def session_stats() -> dict:
+    """Per-server session health and call latency (empty until subprocess mode is used)."""
+    if _loop is None:
+        return {}
+
+    async def collect():
+        result = {}
+        for name, server in _servers.items():
+            stats = server['stats']
+            result[name] = dict(
+                stats, total_ms=round(stats['total_ms'], 2),
+                avg_ms=round(stats['total_ms'] / stats['calls'], 2) if stats['calls'] else None,
+                sessions=len(server['sessions']),
+                ready=sum(s['ready'].is_set() for s in server['sessions']),
+                in_flight=sum(s['in_flight'] for s in server['sessions']),
+                tools=len(server['tools']) if server['tools'] is not None else None)
+        return result
+    return asyncio.run_coroutine_threadsafe(collect(), _loop).result(5)
+
+
+@atexit.register
+def close_sessions():
+    """Close every session so the server processes exit with the app."""
+    if _loop is None:
+        return
+
+    async def close_all():
+        tasks = []
+        for server in _servers.values():
+            for slot in server['sessions']:
+                slot['closing'] = True
+                slot['wake'].set()
+                tasks.append(slot['task'])
+        await asyncio.wait(tasks, timeout=5)
+    try:
+        asyncio.run_coroutine_threadsafe(close_all(), _loop).result(10)
+    except Exception:
+        pass
+
+
+def _prepare(name: str, input_data: dict):
+    """Normalize the tool name and serialize arguments the way MCP tool signatures expect."""
     name = TOOL_NAME_MAP.get(name, name)
 
     # Prepare arguments — MCP tools expect simple types (strings, not dicts/lists)
@@ -67,15 +300,79 @@ def call_tool(name: str, input_data: dict) -> str:
     for key in ('blocks', 'replace_blocks', 'append_blocks', 'properties'):
         if key in arguments and isinstance(arguments[key], (dict, list)):
             arguments[key] = json.dumps(arguments[key])
+    return name, arguments
+
 
+def call_tool_inprocess(name: str, arguments: dict) -> str:
+    """Run an MCP tool directly on notes_tools. Errors come back as the text FastMCP
+    would return: 'Unknown tool: …' or 'Error executing tool …: …'."""
+    if name not in MCP_TOOLS:
+        return f"Unknown tool: {name}"
+    func = getattr(notes_tools, name)
+    signature = inspect.signature(func)
     try:
-        # Run async call in a new event loop (safe from sync Flask context)
-        loop = asyncio.new_event_loop()
-        try:
-            result = loop.run_until_complete(_call_tool_async(name, arguments))
-        finally:
-            loop.close()
-        return result
+        # FastMCP ignores arguments the tool doesn't declare
+        bound = signature.bind(**{k: v for k, v in arguments.items() if k in signature.parameters})
+        return func(*bound.args, **bound.kwargs)
+    except Exception as e:
+        return f"Error executing tool {name}: {e}"
+
+
+def call_tool_subprocess(name: str, arguments: dict) -> str:
+    """Run an MCP tool over a warm stdio session of whichever configured server has it."""
+    return _run(_call_pooled(name, arguments))
+
+
+def call_tool_spawn(name: str, arguments: dict) -> str:
+    """Run an MCP tool by spawning the MCP server for this one call (benchmark baseline)."""
+    # Run async call in a new event loop (safe from sync Flask context)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_call_tool_async(name, arguments))
+    finally:
+        loop.close()
+
+
+def call_tool(name: str, input_data: dict) -> str:
+    """Call an MCP tool synchronously. Entry point for app.py's AI agents.
+
+    Handles:
+    - Tool name normalization (legacy → MCP names)
+    - JSON serialization of complex arguments (blocks, properties)
+    - In-process dispatch, or persistent MCP sessions when MCP_TOOL_MODE=subprocess
+    """
+    name, arguments = _prepare(name, input_data)
+    try:
+        if MCP_TOOL_MODE == 'subprocess':
+            return call_tool_subprocess(name, arguments)
+        return call_tool_inprocess(name, arguments)
     except Exception as e:
         logger.error(f"MCP tool call failed: {name}({arguments}): {e}")
         return f"Error executing {name}: {str(e)}"
+
+
+def benchmark(n: int = 5) -> dict:
+    """Mean milliseconds per call of read-only tools in each mode."""
+    calls = [('list_pages', {}), ('list_databases', {}), ('search_notes', {'query': 'project'})]
+    results = {}
+    modes = (('inprocess', call_tool_inprocess), ('mcp-session', call_tool_subprocess), ('mcp-spawn', call_tool_spawn))
+    for mode, call in modes:
+        started = time.perf_counter()
+        try:
+            for _ in range(n):
+                for name, arguments in calls:
+                    call(*_prepare(name, arguments))
+        except Exception as e:
+            results[mode] = f"unavailable: {e}"
+            continue
+        results[mode] = round((time.perf_counter() - started) * 1000 / (n * len(calls)), 2)
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        for mode, ms in benchmark(n).items():
+            print(f"{mode:<11} {ms} ms/call" if isinstance(ms, float) else f"{mode:<11} {ms}")
+    else:
+        print(__doc__)
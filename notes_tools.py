@@ -3,20 +3,14 @@ Pure Python — no MCP/FastMCP dependency."""
 
 import json
 import os
-import sqlite3
+import re
 import subprocess
+import threading
+import time
 import uuid
 from datetime import datetime, timezone
 
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notes.db')
-
-
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+from db_pool import DB_PATH, get_db
 
 
 def gen_id():
@@ -29,25 +23,66 @@ def now():
 
 # ── Search ──────────────────────────────────────────────────────────────────
 
-def search_notes(query: str) -> str:
-    """Search across all pages, blocks, and database items by keyword."""
+FTS_TABLES = ('pages_fts', 'blocks_fts', 'db_items_fts')
+
+
+def fts_query(query: str, any_word: bool = False) -> str:
+    """Turn free text into an FTS5 expression: every word quoted and prefix-matched.
+    With any_word the words are OR-ed, so bm25 ranks rows by how many they match."""
+    return (' OR ' if any_word else ' ').join(f'"{t}"*' for t in re.findall(r'\w+', query))
+
+
+def fts_search(query: str, page_limit: int = 20, block_limit: int = 20, item_limit: int = 10,
+               mark: tuple = ('**', '**')) -> dict:
+    """bm25-ranked search over pages_fts, blocks_fts and db_items_fts.
+    Returns {'pages': [...], 'blocks': [...], 'items': [...]}; block rows carry a
+    snippet() with matches wrapped in `mark`."""
+    match = fts_query(query)
+    if not match:
+        return {'pages': [], 'blocks': [], 'items': []}
     with get_db() as conn:
         pages = conn.execute(
-            "SELECT id, title, icon, workspace FROM pages WHERE title LIKE ? AND workspace != '_db_item' LIMIT 10",
-            (f'%{query}%',)
+            """SELECT p.id, p.title, p.icon, p.parent_id, p.workspace
+               FROM pages_fts f JOIN pages p ON p.rowid = f.rowid
+               WHERE pages_fts MATCH ? AND p.workspace != '_db_item' AND p.deleted_at IS NULL
+               ORDER BY bm25(pages_fts, 0.0, 1.0) LIMIT ?""",
+            (f'{{title}} : ({match})', page_limit)
         ).fetchall()
         blocks = conn.execute(
-            """SELECT b.page_id, b.content, b.type, p.title FROM blocks b
-               JOIN pages p ON b.page_id = p.id
-               WHERE b.content LIKE ? AND p.workspace != '_db_item' LIMIT 15""",
-            (f'%{query}%',)
+            """SELECT b.page_id, b.type, b.content, p.title, p.icon, p.workspace,
+                      snippet(blocks_fts, 1, ?, ?, '…', 16) AS snippet
+               FROM blocks_fts f JOIN blocks b ON b.rowid = f.rowid
+               JOIN pages p ON p.id = b.page_id
+               WHERE blocks_fts MATCH ? AND p.workspace != '_db_item' AND p.deleted_at IS NULL
+               ORDER BY bm25(blocks_fts, 0.0, 1.0) LIMIT ?""",
+            (mark[0], mark[1], f'{{content}} : ({match})', block_limit)
         ).fetchall()
         items = conn.execute(
-            """SELECT i.id, i.title, d.title as db_title, i.properties
-               FROM db_items i JOIN databases d ON i.database_id = d.id
-               WHERE i.title LIKE ? LIMIT 10""",
-            (f'%{query}%',)
+            """SELECT i.id, i.title, i.icon, i.database_id, i.properties, d.title AS db_title
+               FROM db_items_fts f JOIN db_items i ON i.rowid = f.rowid
+               JOIN databases d ON d.id = i.database_id
+               WHERE db_items_fts MATCH ?
+               ORDER BY bm25(db_items_fts, 0.0, 1.0) LIMIT ?""",
+            (f'{{title}} : ({match})', item_limit)
         ).fetchall()
+    return {'pages': [dict(r) for r in pages], 'blocks': [dict(r) for r in blocks],
+            'items': [dict(r) for r in items]}
+
+
+def rebuild_search_index() -> str:
+    """Rebuild all FTS tables from their content tables and merge their b-trees."""
+    with get_db() as conn:
+        for table in FTS_TABLES:
+            conn.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+            conn.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in FTS_TABLES}
+    return json.dumps({"rebuilt": counts})
+
+
+def search_notes(query: str) -> str:
+    """Search across all pages, blocks, and database items by keyword."""
+    found = fts_search(query, page_limit=10, block_limit=15, item_limit=10)
+    pages, blocks, items = found['pages'], found['blocks'], found['items']
 
     results = []
     if pages:
@@ -57,7 +92,7 @@ def search_notes(query: str) -> str:
     if blocks:
         results.append("\n## Content Matches")
         for b in blocks:
-            snippet = b['content'][:150]
+            snippet = b['snippet']
             results.append(f"- In page \"{b['title']}\" (page_id: `{b['page_id']}`): {snippet}")
     if items:
         results.append("\n## Database Items")
@@ -74,11 +109,13 @@ def list_pages(workspace: str = "all") -> str:
     with get_db() as conn:
         if workspace == "all":
             pages = conn.execute(
-                "SELECT id, title, icon, workspace, parent_id, updated_at FROM pages WHERE workspace != '_db_item' ORDER BY updated_at DESC"
+                "SELECT id, title, icon, workspace, parent_id, updated_at FROM pages "
+                "WHERE workspace != '_db_item' AND deleted_at IS NULL ORDER BY updated_at DESC"
             ).fetchall()
         else:
             pages = conn.execute(
-                "SELECT id, title, icon, workspace, parent_id, updated_at FROM pages WHERE workspace=? ORDER BY updated_at DESC",
+                "SELECT id, title, icon, workspace, parent_id, updated_at FROM pages "
+                "WHERE workspace=? AND deleted_at IS NULL ORDER BY updated_at DESC",
                 (workspace,)
             ).fetchall()
 
@@ -95,7 +132,7 @@ def list_pages(workspace: str = "all") -> str:
 def get_page(page_id: str) -> str:
     """Get full content of a page including all its blocks."""
     with get_db() as conn:
-        page = conn.execute("SELECT * FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT * FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return f"Page not found: {page_id}"
         blocks = conn.execute(
@@ -122,6 +159,9 @@ def list_databases() -> str:
     """List all databases with their schemas."""
     with get_db() as conn:
         dbs = conn.execute("SELECT * FROM databases ORDER BY updated_at DESC").fetchall()
+        counts = dict(conn.execute(
+            "SELECT database_id, COUNT(*) FROM db_items GROUP BY database_id"
+        ).fetchall())
 
     if not dbs:
         return "No databases found."
@@ -130,8 +170,7 @@ def list_databases() -> str:
     for db in dbs:
         schema = json.loads(db['properties_schema']) if db['properties_schema'] else []
         prop_names = ', '.join(f"{p['name']} ({p['type']})" for p in schema)
-        with get_db() as conn:
-            item_count = conn.execute("SELECT COUNT(*) FROM db_items WHERE database_id=?", (db['id'],)).fetchone()[0]
+        item_count = counts.get(db['id'], 0)
         lines.append(f"### {db['title']} ({db['workspace']})")
         lines.append(f"ID: `{db['id']}` | Items: {item_count} | View: {db['default_view']}")
         lines.append(f"Properties: {prop_names or 'none'}")
@@ -268,7 +307,7 @@ def edit_page(page_id: str, title: str = "", icon: str = "",
               replace_blocks: str = "", append_blocks: str = "") -> str:
     """Edit an existing page."""
     with get_db() as conn:
-        page = conn.execute("SELECT id FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT id FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return f"Page not found: {page_id}"
 
@@ -337,16 +376,15 @@ def update_database_item(database_id: str, item_id: str, title: str = "", proper
 # ── Delete ──────────────────────────────────────────────────────────────────
 
 def delete_page(page_id: str) -> str:
-    """Delete a page and all its blocks."""
+    """Move a page and its sub-pages to the trash (restorable until purged)."""
     with get_db() as conn:
-        page = conn.execute("SELECT title FROM pages WHERE id=?", (page_id,)).fetchone()
+        page = conn.execute("SELECT title FROM pages WHERE id=? AND deleted_at IS NULL", (page_id,)).fetchone()
         if not page:
             return f"Page not found: {page_id}"
-        conn.execute("DELETE FROM blocks WHERE page_id=?", (page_id,))
-        conn.execute("DELETE FROM pages WHERE id=?", (page_id,))
+        trashed = trash_page(conn, page_id)
         conn.commit()
 
-    return json.dumps({"deleted": page_id, "title": page['title']})
+    return json.dumps({"deleted": page_id, "title": page['title'], "trashed_pages": len(trashed)})
 
 
 def delete_database_item(database_id: str, item_id: str) -> str:
@@ -365,6 +403,60 @@ def delete_database_item(database_id: str, item_id: str) -> str:
     return json.dumps({"deleted": item_id, "title": item['title']})
 
 
+# ── Trash ───────────────────────────────────────────────────────────────────
+# Deleting a page only stamps deleted_at on its subtree; deleted_root records which
+# delete the page went with so the subtree restores as a unit. Rows are removed
+# later, in chunks, by purge_trash_chunk().
+
+def trash_page(conn, page_id: str) -> list:
+    """Soft-delete a page and its live descendants in one statement. Returns their ids."""
+    rows = conn.execute(
+        """WITH RECURSIVE subtree(id) AS (
+               SELECT ?
+               UNION
+               SELECT p.id FROM pages p JOIN subtree s ON p.parent_id = s.id WHERE p.deleted_at IS NULL
+           )
+           UPDATE pages SET deleted_at=?, deleted_root=?
+           WHERE id IN subtree AND deleted_at IS NULL
+           RETURNING id""",
+        (page_id, now(), page_id)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+def restore_page(conn, page_id: str) -> list:
+    """Bring back everything trashed together with `page_id`. Returns the restored ids.
+    The page moves to the top level if its parent is gone or still in the trash."""
+    rows = conn.execute(
+        "UPDATE pages SET deleted_at=NULL, deleted_root=NULL WHERE deleted_root=? AND deleted_at IS NOT NULL RETURNING id",
+        (page_id,)
+    ).fetchall()
+    if rows:
+        conn.execute(
+            """UPDATE pages SET parent_id=NULL WHERE id=? AND parent_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM pages p WHERE p.id = pages.parent_id AND p.deleted_at IS NULL)""",
+            (page_id,)
+        )
+    return [r[0] for r in rows]
+
+
+def purge_trash_chunk(cutoff: str, limit: int = 200) -> int:
+    """Hard-delete up to `limit` pages trashed at or before `cutoff`, with their blocks and
+    grants, in one short transaction. Returns how many pages were removed."""
+    with get_db() as conn:
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM pages WHERE deleted_at IS NOT NULL AND deleted_at <= ? LIMIT ?", (cutoff, limit)
+        )]
+        if not ids:
+            return 0
+        placeholders = ','.join('?' * len(ids))
+        conn.execute(f"DELETE FROM blocks WHERE page_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM permissions WHERE resource_type='page' AND resource_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM pages WHERE id IN ({placeholders})", ids)
+        conn.commit()
+    return len(ids)
+
+
 # ── Context ─────────────────────────────────────────────────────────────────
 
 # ── Resources ───────────────────────────────────────────────────────────────
@@ -535,38 +627,120 @@ def search_resources(database_id: str, query: str) -> str:
     return '\n'.join(lines)
 
 
-def get_all_content() -> str:
-    """Get a comprehensive overview of ALL content in the notes app."""
-    sections = []
-    with get_db() as conn:
+# The overview is assembled from per-page and per-database sections. The
+# content_changes log (trigger-fed) says which sections went stale since the last
+# build, so an unchanged workspace costs one MAX(seq) read and an edit rebuilds
+# only the sections it touched.
+_snapshot_lock = threading.Lock()
+_snapshot = {'seq': None, 'pages': {}, 'dbs': {}, 'text': None}
+_snapshot_stats = {'hits': 0, 'misses': 0, 'full_rebuilds': 0, 'sections_rebuilt': 0,
+                   'last_rebuild_ms': 0.0, 'total_rebuild_ms': 0.0}
+
+
+def _in_batches(ids, size=500):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _page_sections(conn, page_ids) -> dict:
+    """{page_id: overview section} for live docs pages among page_ids."""
+    sections = {}
+    for batch in _in_batches(page_ids):
+        marks = ','.join('?' * len(batch))
         pages = conn.execute(
-            "SELECT * FROM pages WHERE (workspace='docs' OR workspace IS NULL) ORDER BY updated_at DESC"
+            f"SELECT id, title FROM pages WHERE id IN ({marks}) AND (workspace='docs' OR workspace IS NULL) "
+            "AND deleted_at IS NULL", batch
         ).fetchall()
-        if pages:
-            sections.append("## DOCS (Pages)")
-            for p in pages:
-                blocks = conn.execute(
-                    "SELECT type, content FROM blocks WHERE page_id=? ORDER BY sort_order", (p['id'],)
-                ).fetchall()
-                content = '\n'.join(b['content'] for b in blocks if b['content'] and b['type'] != 'divider')
-                preview = content[:300] + '...' if len(content) > 300 else content
-                sections.append(f"\n### {p['title']} (id: `{p['id']}`)\n{preview or '[Empty page]'}")
-
-        dbs = conn.execute("SELECT * FROM databases ORDER BY updated_at DESC").fetchall()
+        content = {p['id']: [] for p in pages}
+        for b in conn.execute(
+            f"SELECT page_id, content FROM blocks WHERE page_id IN ({marks}) AND content != '' "
+            "AND type != 'divider' ORDER BY page_id, sort_order", batch
+        ):
+            if b['page_id'] in content:
+                content[b['page_id']].append(b['content'])
+        for p in pages:
+            text = '\n'.join(content[p['id']])
+            preview = text[:300] + '...' if len(text) > 300 else text
+            sections[p['id']] = f"\n### {p['title']} (id: `{p['id']}`)\n{preview or '[Empty page]'}"
+    return sections
+
+
+def _db_sections(conn, db_ids) -> dict:
+    """{database_id: overview section} for databases among db_ids."""
+    sections = {}
+    for batch in _in_batches(db_ids):
+        marks = ','.join('?' * len(batch))
+        dbs = conn.execute(f"SELECT * FROM databases WHERE id IN ({marks})", batch).fetchall()
+        items = {db['id']: [] for db in dbs}
+        for item in conn.execute(
+            f"SELECT database_id, id, title, properties FROM db_items WHERE database_id IN ({marks}) "
+            "ORDER BY database_id, sort_order", batch
+        ):
+            items[item['database_id']].append(item)
         for db in dbs:
             schema = json.loads(db['properties_schema']) if db['properties_schema'] else []
-            items = conn.execute(
-                "SELECT * FROM db_items WHERE database_id=? ORDER BY sort_order", (db['id'],)
-            ).fetchall()
+            names = {p['id']: p['name'] for p in schema}
             ws = 'PROJECT' if db['workspace'] == 'projects' else 'KNOWLEDGE BASE'
-            sections.append(f"\n## {ws}: {db['title']} (id: `{db['id']}`)")
-            sections.append(f"Properties: {', '.join(p['name'] + ' (' + p['type'] + ')' for p in schema)}")
-            for item in items:
+            lines = [f"\n## {ws}: {db['title']} (id: `{db['id']}`)",
+                     f"Properties: {', '.join(p['name'] + ' (' + p['type'] + ')' for p in schema)}"]
+            for item in items[db['id']]:
                 props = json.loads(item['properties']) if item['properties'] else {}
-                prop_str = ', '.join(
-                    f"{next((s['name'] for s in schema if s['id'] == k), k)}: {v}"
-                    for k, v in props.items() if v
-                )
-                sections.append(f"  - {item['title']} (id: `{item['id']}`) [{prop_str}]")
+                prop_str = ', '.join(f"{names.get(k, k)}: {v}" for k, v in props.items() if v)
+                lines.append(f"  - {item['title']} (id: `{item['id']}`) [{prop_str}]")
+            sections[db['id']] = '\n'.join(lines)
+    return sections
+
 
-    return '\n'.join(sections) if sections else "No content in the app yet."
+def get_all_content() -> str:
+    """Get a comprehensive overview of ALL content in the notes app."""
+    with _snapshot_lock, get_db() as conn:
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM content_changes").fetchone()[0]
+        if seq == _snapshot['seq']:
+            _snapshot_stats['hits'] += 1
+            return _snapshot['text']
+        _snapshot_stats['misses'] += 1
+        started = time.perf_counter()
+        oldest = conn.execute("SELECT MIN(seq) FROM content_changes").fetchone()[0]
+        page_order = [r[0] for r in conn.execute(
+            "SELECT id FROM pages WHERE (workspace='docs' OR workspace IS NULL) AND deleted_at IS NULL "
+            "ORDER BY updated_at DESC")]
+        db_order = [r[0] for r in conn.execute("SELECT id FROM databases ORDER BY updated_at DESC")]
+        if _snapshot['seq'] is None or (oldest is not None and oldest > _snapshot['seq'] + 1):
+            # First build, or the log was pruned past our position
+            _snapshot_stats['full_rebuilds'] += 1
+            dirty_pages, dirty_dbs = set(page_order), set(db_order)
+            _snapshot['pages'], _snapshot['dbs'] = {}, {}
+        else:
+            changes = conn.execute(
+                "SELECT DISTINCT kind, ref FROM content_changes WHERE seq > ? AND seq <= ?",
+                (_snapshot['seq'], seq)
+            ).fetchall()
+            dirty_pages = {r['ref'] for r in changes if r['kind'] == 'page'}
+            dirty_dbs = {r['ref'] for r in changes if r['kind'] == 'db'}
+        for key, dirty, build in (('pages', dirty_pages, _page_sections), ('dbs', dirty_dbs, _db_sections)):
+            cached = _snapshot[key]
+            for ref in dirty:
+                cached.pop(ref, None)
+            cached.update(build(conn, dirty))
+            _snapshot_stats['sections_rebuilt'] += len(dirty)
+
+        sections = []
+        if page_order:
+            sections.append("## DOCS (Pages)")
+            sections.extend(_snapshot['pages'][p] for p in page_order if p in _snapshot['pages'])
+        sections.extend(_snapshot['dbs'][d] for d in db_order if d in _snapshot['dbs'])
+        _snapshot['text'] = '\n'.join(sections) if sections else "No content in the app yet."
+        _snapshot['seq'] = seq
+        elapsed = (time.perf_counter() - started) * 1000
+        _snapshot_stats['last_rebuild_ms'] = round(elapsed, 2)
+        _snapshot_stats['total_rebuild_ms'] = round(_snapshot_stats['total_rebuild_ms'] + elapsed, 2)
+        return _snapshot['text']
+
+
+def snapshot_stats() -> dict:
+    """Hit rate and rebuild timings of the get_all_content() snapshot cache."""
+    with _snapshot_lock:
+        lookups = _snapshot_stats['hits'] + _snapshot_stats['misses']
+        return dict(_snapshot_stats, seq=_snapshot['seq'], sections=len(_snapshot['pages']) + len(_snapshot['dbs']),
+                    hit_rate=round(_snapshot_stats['hits'] / lookups, 3) if lookups else None)
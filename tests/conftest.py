@@ -0,0 +1,22 @@
+"""Shared fixtures: the app on a throwaway database, and a logged-in admin client."""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_pool
+
+db_pool.DB_PATH = os.path.join(tempfile.mkdtemp(), 'notes.db')
+
+import app as app_module  # noqa: E402  (opens db_pool.DB_PATH at import)
+
+
+@pytest.fixture
+def client():
+    client = app_module.app.test_client()
+    assert client.post('/api/auth/login', json={'username': 'admin', 'password': 'admin'}).status_code == 200
+    return client
@@ -0,0 +1,36 @@
+"""Input validation of POST /api/pages/<id>/blocks/batch."""
+
+import pytest
+
+
+@pytest.fixture
+def page(client):
+    return client.post('/api/pages', json={'title': 'Batch'}).get_json()['id']
+
+
+@pytest.mark.parametrize('body', [
+    [],
+    None,
+    {'ops': 'create'},
+    {'ops': ['create']},
+    {'ops': [{'op': 'rename', 'id': 'x'}]},
+    {'ops': [{'op': 'update', 'content': 'no id'}]},
+    {'ops': [{'op': 'update', 'id': ['x'], 'content': 'a'}]},
+    {'ops': [{'op': 'create', 'content': {'text': 'a'}}]},
+    {'ops': [{'op': 'create', 'type': 1}]},
+    {'ops': [{'op': 'move', 'id': 'x', 'after_id': 3}]},
+    {'ops': [{'op': 'create', 'indent_level': 'deep'}]},
+    {'ops': [{'op': 'create', 'properties': []}]},
+])
+def test_malformed_batch(client, page, body):
+    res = client.post(f'/api/pages/{page}/blocks/batch', json=body)
+    assert res.status_code == 400
+
+
+def test_valid_batch(client, page):
+    ops = [{'op': 'create', 'id': 'blk-a', 'type': 'text', 'content': 'a'},
+           {'op': 'update', 'id': 'blk-a', 'content': 'b', 'indent_level': 1},
+           {'op': 'move', 'id': 'blk-a', 'after_id': None}]
+    res = client.post(f'/api/pages/{page}/blocks/batch', json={'ops': ops})
+    assert res.status_code == 200
+    assert all(r['ok'] for r in res.get_json()['results'])
@@ -0,0 +1,52 @@
+"""Regression checks for POST /api/databases/<id>/items/query."""
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def database(client):
+    schema = [{'id': 'status', 'name': 'Status', 'type': 'select', 'options': []}]
+    res = client.post('/api/databases', json={'title': 'Board', 'workspace': 'wiki', 'properties_schema': schema})
+    db_id = res.get_json()['id']
+    with app.get_db() as conn:
+        conn.execute("UPDATE databases SET properties_schema=? WHERE id=?", (app.json.dumps(schema), db_id))
+        conn.commit()
+    return db_id
+
+
+def test_null_group_without_options(client, database):
+    res = client.post(f'/api/databases/{database}/items/query', json={'group_by': 'status', 'group': None})
+    assert res.status_code == 200
+    assert res.get_json()['items'] == []
+
+
+@pytest.mark.parametrize('limit', ['abc', [1], {'n': 1}])
+def test_invalid_limit(client, database, limit):
+    res = client.post(f'/api/databases/{database}/items/query', json={'limit': limit})
+    assert res.status_code == 400
+
+
+@pytest.mark.parametrize('body', [
+    {'filters': 'status'},
+    {'filters': ['status']},
+    {'filters': [{'property': 'title', 'op': 'eq', 'value': {'a': 1}}]},
+    {'filters': [{'property': 'title', 'op': 'gt', 'value': [1]}]},
+    {'filters': [{'property': 'title', 'op': 'contains', 'value': {}}]},
+    {'filters': [{'property': 'title', 'op': 'in', 'value': 'abc'}]},
+    {'filters': [{'property': 'title', 'op': 'in', 'value': [[1]]}]},
+    {'filters': [{'property': 'title', 'op': ['eq']}]},
+    {'sorts': {'property': 'title'}},
+    {'sorts': ['title']},
+    {'group_by': 'status', 'group': {'name': 'x'}},
+])
+def test_malformed_query(client, database, body):
+    res = client.post(f'/api/databases/{database}/items/query', json=body)
+    assert res.status_code == 400
+
+
+def test_in_filter_list(client, database):
+    body = {'filters': [{'property': 'title', 'op': 'in', 'value': ['a', 'b']}], 'sorts': [{'property': 'title'}]}
+    res = client.post(f'/api/databases/{database}/items/query', json=body)
+    assert res.status_code == 200
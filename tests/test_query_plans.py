@@ -0,0 +1,25 @@
+"""Every db_schema.HOT_QUERIES entry must still use its index on a migrated database."""
+
+import pytest
+
+import db_schema
+from db_pool import get_db
+
+
+@pytest.fixture(scope='module')
+def plans():
+    with get_db() as conn:
+        db_schema.migrate(conn)
+        return {r['name']: r for r in db_schema.check_query_plans(conn)}
+
+
+def test_schema_current():
+    with get_db() as conn:
+        assert db_schema.schema_version(conn) == db_schema.SCHEMA_VERSION
+        assert db_schema.migrate(conn) == 0
+
+
+@pytest.mark.parametrize('name', [name for name, *_ in db_schema.HOT_QUERIES])
+def test_query_uses_index(plans, name):
+    result = plans[name]
+    assert result['ok'], f"{name} does not use {result['index']}: {result['plan']}"